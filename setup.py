@@ -9,11 +9,21 @@ with open('requirements.txt', 'r') as f:
 with open('requirements-dev.txt', 'r') as f:
     TESTS_REQUIRE = f.readlines()
 
-PACKAGES_DATA = {'sii': ['data/*.xsd']}
+PACKAGES_DATA = {'sii': [
+    'data/xsd/*.xsd', 'data/wsdl/*.wsdl',
+    'data/atc/xsd/*.xsd', 'data/atc/wsdl/*.wsdl', 'data/atc/wsdl/*.xsd'
+]}
+
+EXTRAS_REQUIRE = {
+    # sii.aio and sii.atc.aio, python 3 only
+    'async': ['httpx; python_version >= "3"'],
+}
 
 PACKAGE_CLASSIFIERS = [
     'Programming Language :: Python :: 2.7',
+    'Programming Language :: Python :: 3',
     'Programming Language :: Python :: 3.6',
+    'Programming Language :: Python :: 3.11',
 ]
 
 setup(
@@ -28,6 +38,7 @@ setup(
     provides=['sii'],
     install_requires=INSTALL_REQUIRES,
     tests_require=TESTS_REQUIRE,
+    extras_require=EXTRAS_REQUIRE,
     packages=find_packages(exclude=['spec']),
     package_data=PACKAGES_DATA,
     classifiers=PACKAGE_CLASSIFIERS,
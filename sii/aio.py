@@ -0,0 +1,359 @@
+# -*- coding: UTF-8 -*-
+"""Asyncio variants of the SII services.
+
+Operations are sent with zeep's AsyncClient over an httpx transport, so this
+module requires python 3 and httpx (``pip install sii[async]``).
+"""
+
+from collections import OrderedDict
+import asyncio
+import time
+
+import certifi
+from zeep import AsyncClient
+from zeep.exceptions import Fault
+from zeep.helpers import serialize_object
+from zeep.transports import AsyncTransport
+
+from sii.clients import CLIENT_CACHE
+from sii.error_codes import ERROR_CODES
+from sii.response import STATUSES, get_batch_outcomes
+from sii.server import (
+    MAX_ID_CHECKS, MAX_REGISTROS, MAX_RETRIES, A1Resend, IDService,
+    SiiService, SiiDeregisterService, chunks, get_book, get_envelopes,
+    set_elapsed, sort_outcomes
+)
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+DEFAULT_MAX_CONCURRENCY = 50
+
+
+async def send_batch(invoices, get_msg, get_operation, semaphore,
+                     max_registros=MAX_REGISTROS, build_envelopes=None):
+    """Async version of sii.server.send_batch sending envelopes concurrently.
+
+    :param semaphore: asyncio.Semaphore bounding the envelopes in flight
+    :return: list of (invoice, outcome) tuples in the same order as invoices
+    """
+    if build_envelopes is None:
+        results, envelopes = get_envelopes(invoices, get_msg, max_registros)
+    else:
+        results, envelopes = build_envelopes(invoices, max_registros)
+
+    async def send_envelope(invoice, msg_header, chunk):
+        registros = [registro for _, registro in chunk]
+        try:
+            async with semaphore:
+                start = time.time()
+                outcomes = await get_operation(invoice)(msg_header, registros)
+        except Exception as fault:
+            outcomes = [fault] * len(chunk)
+        else:
+            set_elapsed(outcomes, time.time() - start)
+        for (position, _), outcome in zip(chunk, outcomes):
+            results[position] = outcome
+
+    await asyncio.gather(*[
+        send_envelope(*envelope) for envelope in envelopes
+    ])
+    return list(zip(invoices, results))
+
+
+async def send_registro(operation, msg_header, registro, semaphore):
+    """Async version of sii.server.send_registro.
+
+    :param semaphore: asyncio.Semaphore bounding the envelopes in flight
+    """
+    async with semaphore:
+        start = time.time()
+        outcomes = await operation(msg_header, [registro])
+    set_elapsed(outcomes, time.time() - start)
+    return outcomes[0]
+
+
+async def send_batch_with_a1(invoices, get_msg, get_operation, semaphore,
+                             max_registros=MAX_REGISTROS,
+                             catalogue=ERROR_CODES, build_envelopes=None):
+    """Async version of sii.server.send_batch_with_a1."""
+    resend = A1Resend(get_msg, catalogue, build_envelopes)
+    results = await send_batch(
+        invoices, get_msg, get_operation, semaphore, max_registros,
+        resend.get_first_envelopes
+    )
+    positions = resend.get_positions(results)
+    if not positions:
+        return results
+    resent = await send_batch(
+        [results[position][0] for position in positions], resend.get_a1_msg,
+        get_operation, semaphore, max_registros
+    )
+    return resend.set_outcomes(results, positions, resent)
+
+
+async def send_with_retries(send_batch, invoices, max_retries=MAX_RETRIES,
+                            catalogue=ERROR_CODES):
+    """Async version of sii.server.send_with_retries without recover, the
+    invoices in doubt are sent again like the other retryable ones.
+
+    :param send_batch: coroutine function sending a list of invoices
+    """
+    results = OrderedDict((status, []) for status in STATUSES)
+    pending = list(invoices)
+    for attempt in range(max_retries + 1):
+        pending, _ = sort_outcomes(
+            results, await send_batch(pending), attempt, max_retries,
+            catalogue
+        )
+        if not pending:
+            break
+    return results
+
+
+class AsyncServiceMixin(object):
+    """Async transport and bounded concurrency of the async services.
+
+    At most max_concurrency requests of a service are in flight at once, and
+    its httpx client keeps at most as many connections open. Every service
+    has its own transport, as its httpx client is bound to those limits and
+    to the event loop it is used from, so a service must be used from a
+    single event loop. Close it with aclose before the loop is closed.
+    """
+
+    client_class = AsyncClient
+    max_concurrency = DEFAULT_MAX_CONCURRENCY
+    _semaphore = None
+    _transport = None
+    _services = None
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    @property
+    def transport(self):
+        """AsyncTransport shared by the zeep services of this service."""
+        if self._transport is None:
+            self._transport = self.create_transport()
+        return self._transport
+
+    def create_transport(self):
+        if httpx is None:
+            raise RuntimeError(
+                'The async services require httpx, install it with '
+                '`pip install httpx`'
+            )
+        cert = (self.certificate, self.key)
+        verify = False if self.url else certifi.where()
+        limits = httpx.Limits(
+            max_connections=self.max_concurrency,
+            max_keepalive_connections=self.max_concurrency
+        )
+        return AsyncTransport(
+            client=httpx.AsyncClient(cert=cert, verify=verify, limits=limits),
+            wsdl_client=httpx.Client(cert=cert, verify=verify)
+        )
+
+    def get_zeep_service(self, wsdl, port_name, service_name,
+                         binding_name=None, address=None):
+        """Returns the zeep service of a port bound to the transport of this
+        service. Only the parsed WSDL document is shared through
+        CLIENT_CACHE.
+        """
+        if self._services is None:
+            self._services = {}
+        key = (wsdl, port_name, binding_name, address)
+        if key not in self._services:
+            self._services[key] = CLIENT_CACHE.create_service(
+                self.transport, wsdl, port_name, service_name,
+                binding_name, address, client_class=self.client_class
+            )
+        return self._services[key]
+
+    async def call_scheduled(self, invoice, operation, msg_header, msg):
+        """Async version of call_scheduled, the delays of the scheduler are
+        awaited instead of blocking the event loop.
+        """
+        if self.scheduler is None:
+            return await operation(msg_header, msg)
+        key = self.get_scheduler_key(invoice, msg_header)
+        delay = self.scheduler.get_delay(key)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            response = await operation(msg_header, msg)
+        except Exception as error:
+            self.scheduler.on_error(key, error)
+            raise
+        self.scheduler.on_response(key, response)
+        return response
+
+    def send_many(self, *args, **kwargs):
+        raise TypeError(
+            'send_many sends on a thread pool and is not available on the '
+            'async services, use send_batch or gather send coroutines'
+        )
+
+    def deregister_many(self, *args, **kwargs):
+        raise TypeError(
+            'deregister_many sends on a thread pool and is not available on '
+            'the async services, use deregister_batch'
+        )
+
+    def recover(self, *args, **kwargs):
+        raise TypeError(
+            'recover queries the books synchronously and is not available on '
+            'the async services, use a sync service'
+        )
+
+    async def aclose(self):
+        """Closes the httpx clients, the services are rebuilt if the service
+        is used again.
+        """
+        transport = self._transport
+        self._transport = None
+        self._services = None
+        self._semaphore = None
+        self.emitted_service = None
+        self.received_service = None
+        if transport is not None:
+            await transport.aclose()
+            transport.wsdl_client.close()
+
+
+class AsyncSiiService(AsyncServiceMixin, SiiService):
+    """Async version of SiiService.
+
+    send, send_batch and send_with_retries are coroutines, recover and
+    send_many are not available.
+    """
+
+    def __init__(self, certificate, key, url=None, test_mode=False,
+                 use_local_wsdl=True, wsdl_dir=None,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, scheduler=None,
+                 query_cache=None):
+        super(AsyncSiiService, self).__init__(
+            certificate, key, url, test_mode, use_local_wsdl, wsdl_dir,
+            scheduler=scheduler, query_cache=query_cache
+        )
+        self.max_concurrency = max_concurrency
+
+    async def send(self, invoice):
+        return await self.submit(invoice)
+
+    async def submit(self, invoice):
+        """Async version of SiiService.submit returning the SendResult of
+        the registro.
+        """
+        msg_header, msg_invoice = self.get_msg(invoice)
+        return await send_registro(
+            self.get_batch_operation(invoice), msg_header, msg_invoice,
+            self.semaphore
+        )
+
+    async def send_batch(self, invoices, max_registros=MAX_REGISTROS,
+                         resend_as_a1=False):
+        """Async version of SiiService.send_batch, envelopes are sent
+        concurrently up to max_concurrency.
+        """
+        if resend_as_a1:
+            return await send_batch_with_a1(
+                invoices, self.get_msg, self.get_batch_operation,
+                self.semaphore, max_registros, self.error_catalogue,
+                self.build_envelopes
+            )
+        return await send_batch(
+            invoices, self.get_msg, self.get_batch_operation, self.semaphore,
+            max_registros, self.build_envelopes
+        )
+
+    async def send_with_retries(self, invoices, max_registros=MAX_REGISTROS,
+                                max_retries=MAX_RETRIES, resend_as_a1=False):
+        """Async version of SiiService.send_with_retries.
+
+        The invoices whose submission timed out are not recovered, they are
+        sent again: use resend_as_a1 so the ones the SII had stored are
+        resent as A1.
+        """
+        async def send(pending):
+            return await self.send_batch(pending, max_registros, resend_as_a1)
+        return await send_with_retries(
+            send, invoices, max_retries, self.error_catalogue
+        )
+
+    def get_batch_operation(self, invoice):
+        service = self.get_service(invoice)
+        operation = getattr(service, self.batch_operations[get_book(invoice)])
+
+        async def send_registros(header, registros):
+            try:
+                res = await self.call_scheduled(
+                    invoice, operation, header, registros
+                )
+            finally:
+                self.invalidate_queries(header, registros)
+            return get_batch_outcomes(res, registros)
+        return send_registros
+
+
+class AsyncSiiDeregisterService(AsyncSiiService, SiiDeregisterService):
+    """Async version of SiiDeregisterService.
+
+    send and deregister_batch are coroutines sending AnulacionLR requests.
+    """
+
+
+class AsyncIDService(AsyncServiceMixin, IDService):
+    def __init__(self, certificate, key, url=None,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        super(AsyncIDService, self).__init__(certificate, key, url)
+        self.max_concurrency = max_concurrency
+
+    async def ids_validate(self, partners, max_id_checks=MAX_ID_CHECKS):
+        self.validator_service = self.create_validation_service(partners)
+
+        res = []
+        try:
+            if isinstance(partners, list):
+                chunks_res = await asyncio.gather(*[
+                    self.send_validate_chunk(chunk=chunk)
+                    for chunk in chunks(partners, max_id_checks)
+                ])
+                for chunk_res in chunks_res:
+                    res.extend(chunk_res)
+            else:
+                partners['Nif'] = partners.pop('vat')
+                partners['Nombre'] = partners.pop('name')
+                async with self.semaphore:
+                    res = await self.validator_service.VNifV1(
+                        partners['Nif'], partners['Nombre']
+                    )
+            return serialize_object(res)
+        except Fault as fault:
+            self.result = fault
+            if self.result.message != 'Codigo[-1].No identificado':
+                raise fault
+
+    async def send_validate_chunk(self, chunk):
+        for partner in chunk:
+            partner['Nif'] = partner.pop('vat')
+            partner['Nombre'] = partner.pop('name')
+        async with self.semaphore:
+            return await self.validator_service.VNifV2(chunk)
+
+    async def invalid_ids(self, partners, max_id_checks=MAX_ID_CHECKS):
+        res = await self.ids_validate(partners, max_id_checks)
+        invalid_ids = []
+        if isinstance(partners, list):
+            for partner in res:
+                if 'NO IDENTIFICADO' in partner['Resultado']:
+                    invalid_ids.append(partner)
+        else:
+            if isinstance(res, Exception) and res.message == 'Codigo[-1].No identificado':
+                return partners
+        return serialize_object(invalid_ids)
@@ -0,0 +1,162 @@
+# -*- coding: UTF-8 -*-
+"""
+Variants asyncio dels serveis SII ATC
+
+Equivalents a SiiServiceATC i SiiDeregisterServiceATC, però les operacions
+SOAP s'envien amb l'AsyncClient de zeep sobre httpx. Requereix python 3 i
+httpx (pip install sii[async]).
+"""
+
+from sii.aio import (
+    AsyncServiceMixin, DEFAULT_MAX_CONCURRENCY, send_batch, send_batch_with_a1,
+    send_registro
+)
+from sii.atc.plugins.dry_run_plugin import DryRunException
+from sii.atc.server import SiiServiceATC, SiiDeregisterServiceATC
+from sii.response import get_batch_outcomes
+from sii.server import MAX_REGISTROS, get_book
+
+
+class AsyncSiiServiceATC(AsyncServiceMixin, SiiServiceATC):
+    """
+    Servei SII ATC asíncron
+
+    Permet tenir moltes peticions en curs des d'un sol event loop, limitades
+    a max_concurrency peticions simultànies. send_many i deregister_many no
+    hi són disponibles.
+    """
+
+    def __init__(self, certificate, key, url=None, test_mode=False,
+                 dry_run=False, dry_run_verbose=False, persist_xml=None,
+                 use_local_wsdl=None, wsdl_dir=None,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, scheduler=None):
+        """
+        Inicialitza el servei SII ATC asíncron
+
+        Els paràmetres són els de SiiServiceATC més:
+
+        :param max_concurrency: Màxim de peticions simultànies en curs
+        """
+        super(AsyncSiiServiceATC, self).__init__(
+            certificate, key, url=url, test_mode=test_mode, dry_run=dry_run,
+            dry_run_verbose=dry_run_verbose, persist_xml=persist_xml,
+            use_local_wsdl=use_local_wsdl, wsdl_dir=wsdl_dir,
+            scheduler=scheduler
+        )
+        self.max_concurrency = max_concurrency
+
+    async def send(self, invoice):
+        """
+        Envia una factura al SII ATC
+
+        :param invoice: Factura d'OpenERP
+        :return: SendResult del registre, com submit
+        """
+        return await self.submit(invoice)
+
+    async def submit(self, invoice):
+        """
+        Envia una factura al SII ATC sense guardar estat al servei
+
+        :param invoice: Factura d'OpenERP
+        :return: SendResult del registre (en mode dry-run amb la resposta
+                 simulada com a envelope)
+        """
+        msg_header, msg_invoice = self.get_msg(invoice)
+        return await send_registro(
+            self.get_batch_operation(invoice), msg_header, msg_invoice,
+            self.semaphore
+        )
+
+    async def send_batch(self, invoices, max_registros=MAX_REGISTROS,
+                         resend_as_a1=False):
+        """
+        Envia moltes factures al SII ATC agrupant-les en pocs enviaments
+
+        Igual que SiiServiceATC.send_batch, però els enviaments es fan
+        concurrentment fins a max_concurrency.
+
+        :param invoices: Llista de factures d'OpenERP
+        :param max_registros: Màxim de registres per enviament
+        :param resend_as_a1: Si True, les altes (A0) rebutjades per factura
+                             duplicada es tornen a enviar juntes com a A1
+        :return: Llista de tuples (factura, resultat)
+        """
+        if resend_as_a1:
+            return await send_batch_with_a1(
+                invoices, self.get_msg, self.get_batch_operation,
+                self.semaphore, max_registros, self.error_catalogue
+            )
+        return await send_batch(
+            invoices, self.get_msg, self.get_batch_operation, self.semaphore,
+            max_registros
+        )
+
+    def get_batch_operation(self, invoice, operations=None):
+        """
+        Retorna la corutina que envia una Cabecera i una llista de registres
+
+        :param invoice: Factura d'OpenERP
+        :param operations: Diccionari {llibre: operació SOAP} (opcional,
+                           per defecte batch_operations)
+        :return: Corutina (cabecera, registres) -> llista de resultats
+        """
+        operations = operations or self.batch_operations
+        service = self.get_service(invoice)
+        operation = getattr(service, operations[get_book(invoice)])
+
+        async def send_registros(header, registros):
+            try:
+                res = await self.call_scheduled(
+                    invoice, operation, header, registros
+                )
+            except DryRunException as dry_ex:
+                return self.get_dry_run_outcomes(dry_ex, registros)
+            return get_batch_outcomes(res, registros)
+        return send_registros
+
+
+class AsyncSiiDeregisterServiceATC(AsyncSiiServiceATC, SiiDeregisterServiceATC):
+    """
+    Servei asíncron per donar de baixa factures del SII ATC
+    """
+
+    async def deregister(self, invoice):
+        """
+        Dona de baixa una factura del SII ATC
+
+        :param invoice: Factura d'OpenERP
+        :return: SendResult de la baixa, com submit_deregister
+        """
+        return await self.submit_deregister(invoice)
+
+    async def submit_deregister(self, invoice):
+        """
+        Dona de baixa una factura del SII ATC sense guardar estat al servei
+
+        :param invoice: Factura d'OpenERP
+        :return: SendResult de la baixa
+        """
+        msg_header, msg_invoice = self.get_deregister_msg(invoice)
+        return await send_registro(
+            self.get_batch_operation(invoice, self.deregister_operations),
+            msg_header, msg_invoice, self.semaphore
+        )
+
+    async def deregister_batch(self, invoices, max_registros=MAX_REGISTROS):
+        """
+        Dona de baixa moltes factures del SII ATC agrupant-les en pocs
+        enviaments concurrents
+
+        :param invoices: Llista de factures d'OpenERP
+        :param max_registros: Màxim de registres per enviament
+        :return: Llista de tuples (factura, resultat)
+        """
+        def get_operation(invoice):
+            return self.get_batch_operation(
+                invoice, self.deregister_operations
+            )
+        return await send_batch(
+            invoices, self.get_deregister_msg, get_operation, self.semaphore,
+            max_registros
+        )
@@ -0,0 +1,33 @@
+# -*- coding: UTF-8 -*-
+"""
+Catàleg de codis d'error del SII ATC
+
+Els codis de l'ATC segueixen la numeració de l'AEAT (sii.error_codes), però
+l'ATC afegeix errors tècnics propis (família 35xx i 1184) i alguns codis no
+volen dir el mateix, com el 4116, que a l'ATC no és el límit d'enviaments.
+Font:
+sii/data/atc/oficial/VALIDACIONES Y ERRORES.pdf (apartat 3, Códigos de
+error).
+"""
+
+from sii.error_codes import (
+    ERROR_CODES as AEAT_ERROR_CODES, ErrorCatalogue, PERMANENT, RETRYABLE
+)
+
+ATC_CODES = dict(AEAT_ERROR_CODES.codes)
+ATC_CODES.update({
+    3502: RETRYABLE,  # Error tècnic. Error al obtenir les dades de la factura
+    3504: RETRYABLE,  # Error tècnic. Error al obtenir les dades del Cobrament
+                      # Metàl·lic
+    3506: RETRYABLE,  # Error tècnic. Error al obtenir les dades de les
+                      # Agències de Viatges
+    1184: RETRYABLE,  # Error tècnic al obtenir el Número de Registre
+                      # d'Autorització de l'ATC
+    # No són errors tècnics tot i la família o el codi de l'AEAT
+    3503: PERMANENT,  # La factura consultada per al subministrament de
+                      # Pagaments/Cobraments/Immobles no existeix
+    4116: PERMANENT,  # S'ha superat el límit permès de registres per al bloc
+                      # DatosInmueble/DetalleIGIC
+})
+
+ERROR_CODES = ErrorCatalogue(ATC_CODES)
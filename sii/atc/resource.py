@@ -6,11 +6,11 @@ Aquest mòdul genera els objectes per enviar al SII ATC utilitzant IGIC.
 Segueix EXACTAMENT la mateixa estructura que sii/resource.py però adaptat per IGIC.
 """
 import re
-from decimal import Decimal
 from datetime import date, datetime
 
 from sii.atc import __ATC_SII_VERSION__
 from sii.utils import unidecode_str, VAT
+from sii.snapshot import normalize_amounts
 from sii.atc.models import invoices_record
 
 SIGN = {'N': 1, 'R': 1, 'A': -1, 'B': -1, 'RA': 1, 'C': 1, 'G': 1}
@@ -534,30 +534,10 @@ def get_factura_recibida_dict(invoice, rect_sust_opc1=False, rect_sust_opc2=Fals
     return obj
 
 
-def refactor_decimals(invoice):
-    def transform(f):
-        return Decimal(str(f))
-    invoice.amount_total = transform(invoice.amount_total)
-    invoice.amount_untaxed = transform(invoice.amount_untaxed)
-    for inv_tax in invoice.tax_line:
-        inv_tax.tax_amount = transform(inv_tax.tax_amount)
-        inv_tax.base = transform(inv_tax.base)
-        inv_tax.tax_id.amount = transform(inv_tax.tax_id.amount)
-    if invoice.rectifying_id:
-        rectified_invoice = invoice.rectifying_id
-        rectified_invoice.amount_total = transform(rectified_invoice.amount_total)
-        rectified_invoice.amount_untaxed = transform(rectified_invoice.amount_untaxed)
-        for rect_inv_tax in rectified_invoice.tax_line:
-            rect_inv_tax.tax_amount = transform(rect_inv_tax.tax_amount)
-            rect_inv_tax.base = transform(rect_inv_tax.base)
-            rect_inv_tax.tax_id.amount = transform(rect_inv_tax.tax_id.amount)
-
-
 class SIIATC(object):
     """Classe SII per ATC - genera objectes per enviar al SII amb IGIC"""
     def __init__(self, invoice):
-        self.invoice = invoice
-        refactor_decimals(self.invoice)
+        self.invoice = normalize_amounts(invoice)
         tipo_rectificativa = invoice.rectificative_type
         rectificativa_sustitucion_opcion_1 = tipo_rectificativa == 'RA'
         rectificativa_sustitucion_opcion_2 = tipo_rectificativa == 'R'
@@ -624,10 +604,16 @@ class SIIATCDeregister(object):
         else:
             raise Exception('Tipus de factura no reconegut')
 
+    def get_baja_header(self):
+        # La Cabecera de les baixes (CabeceraSiiBaja) no porta TipoComunicacion
+        cabecera = get_header(self.invoice)
+        cabecera.pop('TipoComunicacion')
+        return cabecera
+
     def get_baja_factura_emitida(self):
         obj = {
             'BajaLRFacturasEmitidas': {
-                'Cabecera': get_header(self.invoice),
+                'Cabecera': self.get_baja_header(),
                 'RegistroLRBajaExpedidas': {
                     'PeriodoLiquidacion': {
                         'Ejercicio': get_periodo_ejercicio(self.invoice)[1],
@@ -646,14 +632,17 @@ class SIIATCDeregister(object):
     def get_baja_factura_recibida(self):
         obj = {
             'BajaLRFacturasRecibidas': {
-                'Cabecera': get_header(self.invoice),
+                'Cabecera': self.get_baja_header(),
                 'RegistroLRBajaRecibidas': {
                     'PeriodoLiquidacion': {
                         'Ejercicio': get_periodo_ejercicio(self.invoice)[1],
                         'Periodo': get_periodo_ejercicio(self.invoice)[0]
                     },
                     'IDFactura': {
-                        'IDEmisorFactura': get_partner_info(self.invoice.partner_id, in_invoice=True),
+                        'IDEmisorFactura': get_partner_info(
+                            self.invoice.partner_id, in_invoice=True,
+                            nombre_razon=True
+                        ),
                         'NumSerieFacturaEmisor': self.invoice.origin,
                         'FechaExpedicionFacturaEmisor': convert_date_to_atc_format(self.invoice.origin_date_invoice)
                     }
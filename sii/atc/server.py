@@ -7,17 +7,29 @@ adaptant els serveis existents de l'AEAT per utilitzar els endpoints i
 WSDLs de l'Agència Tributària Canària.
 """
 
+from sii.atc.error_codes import ERROR_CODES
 from sii.atc.resource import SIIATC, SIIATCDeregister
 from sii.atc.plugins import DryRunPlugin, PersistXmlPlugin
 from sii.atc.plugins.dry_run_plugin import DryRunException
-from zeep import Client
+from sii.server import (
+    MAX_REGISTROS, MAX_WORKERS, get_book, send_batch, send_batch_with_a1,
+    send_many, send_registro
+)
+from sii.response import SendResult, get_batch_outcomes
+from sii.clients import CLIENT_CACHE
 from requests import Session
+from zeep import Client
 from zeep.exceptions import Fault
 from zeep.transports import Transport
 from zeep.helpers import serialize_object
 import certifi
 import os
 
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
 
 def get_wsdl_path(filename, wsdl_dir=None):
     """
@@ -44,11 +56,59 @@ def get_wsdl_path(filename, wsdl_dir=None):
 class Service(object):
     """Classe base per serveis"""
     
-    def __init__(self, certificate, key, url=None):
+    # Classe del client zeep (Client o AsyncClient)
+    client_class = Client
+    
+    def __init__(self, certificate, key, url=None, session_registry=None):
         self.certificate = certificate
         self.key = key
         self.url = url
+        self.session_registry = session_registry
         self.result = []
+    
+    def create_transport(self):
+        """
+        Crea el Transport de zeep amb la sessió HTTP del certificat
+        
+        Si el servei té un registre de sessions (SessionRegistry) es
+        reutilitza la sessió compartida del certificat i host, altrament es
+        crea una sessió nova.
+        
+        :return: Transport de zeep
+        """
+        verify = False if self.url else certifi.where()
+        if self.session_registry is not None:
+            host = urlparse(self.url).netloc if self.url else None
+            session = self.session_registry.get_session(
+                self.certificate, self.key, verify, host
+            )
+        else:
+            session = Session()
+            session.cert = (self.certificate, self.key)
+            session.verify = verify
+        return Transport(session=session)
+    
+    def get_client_key(self):
+        """
+        Retorna la clau que identifica aquest client a la cache de serveis
+        
+        :return: Tupla (certificat, clau, registre de sessions)
+        """
+        return self.certificate, self.key, self.session_registry
+    
+    def get_zeep_service(self, wsdl, port_name, service_name,
+                         binding_name=None, address=None):
+        """
+        Retorna el servei zeep d'un port, compartit a CLIENT_CACHE
+        
+        :return: ServiceProxy de zeep
+        """
+        return CLIENT_CACHE.get_service(
+            self.create_transport, wsdl, port_name, service_name,
+            binding_name=binding_name, address=address,
+            certificate=self.get_client_key(),
+            client_class=self.client_class
+        )
 
 
 class SiiServiceATC(Service):
@@ -63,7 +123,8 @@ class SiiServiceATC(Service):
     
     def __init__(self, certificate, key, url=None, test_mode=False,
                  dry_run=False, dry_run_verbose=False, persist_xml=None, 
-                 use_local_wsdl=None, wsdl_dir=None):
+                 use_local_wsdl=None, wsdl_dir=None, session_registry=None,
+                 scheduler=None):
         """
         Inicialitza el servei SII ATC
         
@@ -77,9 +138,16 @@ class SiiServiceATC(Service):
                            - Dict: {'request': path, 'response': path}
         :param use_local_wsdl: Si True, utilitza WSDLs locals. Si None, auto (local si dry_run)
         :param wsdl_dir: Directori personalitzat per WSDLs locals (opcional)
+        :param session_registry: SessionRegistry per compartir les sessions
+                                 HTTP (opcional)
+        :param scheduler: SendScheduler per limitar el ritme d'enviaments
+                          (opcional)
         """
-        super(SiiServiceATC, self).__init__(certificate, key, url)
+        super(SiiServiceATC, self).__init__(
+            certificate, key, url, session_registry
+        )
         self.test_mode = test_mode
+        self.scheduler = scheduler
         self.dry_run = dry_run
         self.dry_run_verbose = dry_run_verbose
         self.persist_xml = persist_xml
@@ -98,19 +166,182 @@ class SiiServiceATC(Service):
         """
         Envia una factura al SII ATC
         
+        Guarda la factura i el resultat al servei i retorna la resposta
+        sencera, submit retorna el SendResult del registre.
+        
         :param invoice: Factura d'OpenERP
         :return: Resposta del servei SOAP serialitzada
         """
         self.invoice = invoice
-        if self.invoice.type.startswith('out_'):
+        self.get_service(invoice)
+        return self.send_invoice()
+    
+    def submit(self, invoice):
+        """
+        Envia una factura al SII ATC sense guardar estat al servei
+        
+        A diferència de send, ni la factura ni el resultat es guarden a
+        self, per tant un mateix servei es pot compartir entre threads.
+        
+        :param invoice: Factura d'OpenERP
+        :return: SendResult del registre (en mode dry-run amb la resposta
+                 simulada com a envelope)
+        :raises Fault: si l'ATC rebutja l'enviament
+        """
+        msg_header, msg_invoice = self.get_msg(invoice)
+        return send_registro(
+            self.get_batch_operation(invoice), msg_header, msg_invoice
+        )
+    
+    def call_scheduled(self, invoice, operation, msg_header, msg):
+        """
+        Crida una operació SOAP a través del scheduler, si n'hi ha
+        
+        :param invoice: Factura d'OpenERP
+        :param operation: Operació SOAP
+        :param msg_header: Cabecera
+        :param msg: Registre o llista de registres
+        :return: Resposta de l'operació
+        """
+        if self.scheduler is None:
+            return operation(msg_header, msg)
+        return self.scheduler.call(
+            self.get_scheduler_key(invoice, msg_header),
+            operation, msg_header, msg
+        )
+    
+    def get_scheduler_key(self, invoice, msg_header):
+        """
+        Retorna la clau (endpoint, Titular) que limita el scheduler
+        
+        :param invoice: Factura d'OpenERP
+        :param msg_header: Cabecera
+        :return: Tupla (endpoint, NIF del titular)
+        """
+        endpoint = (self.url, self.test_mode, get_book(invoice))
+        titular = (msg_header.get('Titular') or {}).get('NIF')
+        return endpoint, titular
+    
+    def get_service(self, invoice):
+        """
+        Retorna el servei SOAP del llibre de la factura, creant-lo si cal
+        
+        :param invoice: Factura d'OpenERP
+        :return: Servei SOAP de factures emeses o rebudes
+        """
+        if get_book(invoice) == 'out':
             if self.emitted_service is None:
-                self.emitted_service = self.create_service()
+                self.emitted_service = self.create_service(invoice)
+            return self.emitted_service
         else:
             if self.received_service is None:
-                self.received_service = self.create_service()
-        return self.send_invoice()
+                self.received_service = self.create_service(invoice)
+            return self.received_service
+    
+    def send_batch(self, invoices, max_registros=MAX_REGISTROS,
+                   resend_as_a1=False):
+        """
+        Envia moltes factures al SII ATC agrupant-les en pocs enviaments
+        
+        Les factures s'agrupen per llibre (emeses/rebudes) i Cabecera, i
+        cada petició SOAP porta una sola Cabecera i fins a max_registros
+        registres (l'XSD en permet 10000).
+        
+        :param invoices: Llista de factures d'OpenERP
+        :param max_registros: Màxim de registres per enviament
+        :param resend_as_a1: Si True, les altes (A0) rebutjades per factura
+                             duplicada es tornen a enviar juntes com a A1
+        :return: Llista de tuples (factura, resultat) en el mateix ordre que
+                 invoices. El resultat és el SendResult de
+                 sii.response.get_registro_outcome (en mode dry-run amb la
+                 resposta simulada com a envelope) o l'excepció si no s'ha
+                 pogut enviar
+        """
+        if resend_as_a1:
+            return send_batch_with_a1(
+                invoices, self.get_msg, self.get_batch_operation,
+                max_registros, self.error_catalogue
+            )
+        return send_batch(
+            invoices, self.get_msg, self.get_batch_operation, max_registros
+        )
     
-    def create_service(self):
+    def send_many(self, invoices, max_workers=MAX_WORKERS, ordered=False):
+        """
+        Envia factures una a una des d'un pool de threads
+        
+        Tots els threads utilitzen submit, per tant es comparteixen els
+        serveis zeep i les sessions HTTP.
+        
+        :param invoices: Llista de factures d'OpenERP
+        :param max_workers: Nombre de threads
+        :param ordered: Si True retorna els resultats en l'ordre de invoices,
+                        altrament a mesura que acaben
+        :return: Generador de tuples (factura, SendResult o excepció)
+        """
+        return send_many(self.submit, invoices, max_workers, ordered)
+    
+    def get_batch_operation(self, invoice, operations=None):
+        """
+        Retorna la funció que envia una Cabecera i una llista de registres
+        amb l'operació SOAP del llibre de la factura
+        
+        :param invoice: Factura d'OpenERP
+        :param operations: Diccionari {llibre: operació SOAP} (opcional,
+                           per defecte batch_operations)
+        :return: Funció (cabecera, registres) -> llista de resultats
+        """
+        operations = operations or self.batch_operations
+        service = self.get_service(invoice)
+        operation = getattr(service, operations[get_book(invoice)])
+        
+        def send_registros(header, registros):
+            try:
+                res = self.call_scheduled(
+                    invoice, operation, header, registros
+                )
+            except DryRunException as dry_ex:
+                return self.get_dry_run_outcomes(dry_ex, registros)
+            return get_batch_outcomes(res, registros)
+        return send_registros
+    
+    def get_dry_run_outcomes(self, dry_ex, registros):
+        """
+        Construeix el resultat de cada registre d'un enviament en mode dry-run
+        
+        Com amb les respostes reals, tots els SendResult comparteixen la
+        resposta simulada de l'enviament com a envelope.
+        
+        :param dry_ex: DryRunException llançada pel DryRunPlugin
+        :param registros: Llista de registres de l'enviament
+        :return: Llista amb un SendResult sense estat per cada registre
+        """
+        envelope = self.get_dry_run_result(dry_ex)
+        return [SendResult(None, envelope=envelope) for _ in registros]
+    
+    def get_dry_run_result(self, dry_ex):
+        """
+        Construeix la resposta simulada d'un enviament en mode dry-run
+        
+        :param dry_ex: DryRunException llançada pel DryRunPlugin
+        :return: Diccionari amb la resposta simulada
+        """
+        # Python 2/3 compatible: evitar UnicodeEncodeError
+        try:
+            # Python 2: convertir a unicode i després a UTF-8
+            msg = unicode(dry_ex).encode('utf-8') if hasattr(str, 'decode') else str(dry_ex)
+        except (NameError, UnicodeDecodeError):
+            # Python 3 o fallback
+            msg = str(dry_ex)
+        
+        return {
+            'successful': True,
+            'dry_run': True,
+            'message': msg,
+            'xml_generated': True
+        }
+    
+    def create_service(self, invoice=None):
         """
         Crea el client SOAP segons el tipus de factura
         
@@ -118,13 +349,11 @@ class SiiServiceATC(Service):
         - WSDLs remots (o locals si dry_run/tests)
         - Endpoints: gobiernodecanarias.org/tributos/atc
         - Namespace diferent
-        """
-        session = Session()
-        session.cert = (self.certificate, self.key)
-        session.verify = False if self.url else certifi.where()
-        transport = Transport(session=session)
         
-        if self.invoice.type.startswith('out_'):
+        :param invoice: Factura d'OpenERP (opcional, per defecte self.invoice)
+        """
+        invoice = invoice or self.invoice
+        if invoice.type.startswith('out_'):
             config = self.out_inv_config.copy()
         else:
             config = self.in_inv_config.copy()
@@ -132,7 +361,7 @@ class SiiServiceATC(Service):
         # Decidir si usar WSDL local o remot
         if self.use_local_wsdl:
             # WSDLs locals per tests/dry-run
-            if self.invoice.type.startswith('out_'):
+            if invoice.type.startswith('out_'):
                 wsdl_url = get_wsdl_path('SuministroFactEmitidas.wsdl', self.wsdl_dir)
             else:
                 wsdl_url = get_wsdl_path('SuministroFactRecibidas.wsdl', self.wsdl_dir)
@@ -172,33 +401,35 @@ class SiiServiceATC(Service):
         if self.dry_run:
             plugins.append(DryRunPlugin(verbose=self.dry_run_verbose))
         
-        client = Client(
-            wsdl=wsdl_url,
-            port_name=port_name,
-            transport=transport,
-            service_name=config['service_name'],
-            plugins=plugins if plugins else None
-        )
-        
-        if not self.url:
-            return client.service
-        
-        # Si hi ha URL (proxy), crear servei amb adreça personalitzada
-        # IMPORTANT: Quan hi ha proxy, només necessitem el nom del servei SOAP
-        # ja que el proxy s'encarrega del path complet
-        # Exemple: proxy = https://proxy:444/atc/test
-        #          type_address = /SiiFactFEV1SOAP
-        #          final = https://proxy:444/atc/test/SiiFactFEV1SOAP
-        
-        # Extreure només el nom del servei del path complet
-        # De: /tributos/middleware/services/sii/SiiFactFEV1SOAP
-        # A:  /SiiFactFEV1SOAP
-        service_name = config['type_address'].split('/')[-1]
-        type_address = '/{}'.format(service_name)
+        address = None
+        if self.url:
+            # Si hi ha URL (proxy), crear servei amb adreça personalitzada
+            # IMPORTANT: Quan hi ha proxy, només necessitem el nom del servei
+            # SOAP ja que el proxy s'encarrega del path complet
+            # Exemple: proxy = https://proxy:444/atc/test
+            #          type_address = /SiiFactFEV1SOAP
+            #          final = https://proxy:444/atc/test/SiiFactFEV1SOAP
+            
+            # Extreure només el nom del servei del path complet
+            # De: /tributos/middleware/services/sii/SiiFactFEV1SOAP
+            # A:  /SiiFactFEV1SOAP
+            service_name = config['type_address'].split('/')[-1]
+            type_address = '/{}'.format(service_name)
+            address = '{0}{1}'.format(self.url, type_address)
         
-        address = '{0}{1}'.format(self.url, type_address)
-        service = client.create_service(config['binding_name'], address)
-        return service
+        if plugins:
+            # Els plugins guarden estat propi (fitxers, dry-run), per tant
+            # el servei no es comparteix però sí el WSDL ja parsejat
+            return CLIENT_CACHE.create_service(
+                self.create_transport(), wsdl_url, port_name,
+                config['service_name'], binding_name=config['binding_name'],
+                address=address, plugins=plugins,
+                client_class=self.client_class
+            )
+        return self.get_zeep_service(
+            wsdl_url, port_name, config['service_name'],
+            binding_name=config['binding_name'], address=address
+        )
     
     def send_invoice(self):
         """
@@ -213,57 +444,60 @@ class SiiServiceATC(Service):
         msg_header, msg_invoice = self.get_msg()
         try:
             if self.invoice.type.startswith('out_'):
-                res = self.emitted_service.SuministroLRFacturasEmitidas(
+                res = self.call_scheduled(
+                    self.invoice,
+                    self.emitted_service.SuministroLRFacturasEmitidas,
                     msg_header, msg_invoice
                 )
             elif self.invoice.type.startswith('in_'):
-                res = self.received_service.SuministroLRFacturasRecibidas(
+                res = self.call_scheduled(
+                    self.invoice,
+                    self.received_service.SuministroLRFacturasRecibidas,
                     msg_header, msg_invoice
                 )
             self.result = res
             return serialize_object(self.result)
         except DryRunException as dry_ex:
             # Mode dry-run: retornar resposta simulada
-            # Python 2/3 compatible: evitar UnicodeEncodeError
-            try:
-                # Python 2: convertir a unicode i després a UTF-8
-                msg = unicode(dry_ex).encode('utf-8') if hasattr(str, 'decode') else str(dry_ex)
-            except (NameError, UnicodeDecodeError):
-                # Python 3 o fallback
-                msg = str(dry_ex)
-            
-            self.result = {
-                'successful': True,
-                'dry_run': True,
-                'message': msg,
-                'xml_generated': True
-            }
+            self.result = self.get_dry_run_result(dry_ex)
             return self.result
         except Exception as e:
             # Python 2/3 compatible: simplement capturar i reraisar
             self.result = e
             raise
     
-    def get_msg(self):
+    def get_msg(self, invoice=None):
         """
         Obté els missatges de capçalera i factura des de SIIATC
         
         DIFERÈNCIA: Utilitza SIIATC en lloc de SII
+        
+        :param invoice: Factura d'OpenERP (opcional, per defecte self.invoice)
         """
-        dict_from_marsh = SIIATC(self.invoice).generate_object()
+        invoice = invoice or self.invoice
+        dict_from_marsh = SIIATC(invoice).generate_object()
         res_header = res_invoices = None
         
-        if self.invoice.type.startswith('out_'):
+        if invoice.type.startswith('out_'):
             suministro = dict_from_marsh['SuministroLRFacturasEmitidas']
             res_header = suministro['Cabecera']
             res_invoices = suministro['RegistroLRFacturasEmitidas']
-        elif self.invoice.type.startswith('in_'):
+        elif invoice.type.startswith('in_'):
             suministro = dict_from_marsh['SuministroLRFacturasRecibidas']
             res_header = suministro['Cabecera']
             res_invoices = suministro['RegistroLRFacturasRecibidas']
         
         return res_header, res_invoices
     
+    # Operacions SOAP per enviaments de molts registres, per llibre
+    batch_operations = {
+        'out': 'SuministroLRFacturasEmitidas',
+        'in': 'SuministroLRFacturasRecibidas'
+    }
+    
+    # Catàleg dels codis d'error de l'ATC
+    error_catalogue = ERROR_CODES
+    
     # Configuració per factures emeses
     # URLs remotes ATC (producció/proves reals):
     # - Producció: https://sede.gobiernodecanarias.org/tributos/middleware/services/sii/
@@ -319,24 +553,87 @@ class SiiDeregisterServiceATC(SiiServiceATC):
     Equivalent a SiiDeregisterService per AEAT
     """
     
-    def get_deregister_msg(self):
+    # Operacions SOAP per baixes de molts registres, per llibre
+    deregister_operations = {
+        'out': 'AnulacionLRFacturasEmitidas',
+        'in': 'AnulacionLRFacturasRecibidas'
+    }
+    
+    def get_deregister_msg(self, invoice=None):
         """
         Obté els missatges per donar de baixa una factura
         
         DIFERÈNCIA: Utilitza SIIATCDeregister en lloc de SIIDeregister
+        
+        :param invoice: Factura d'OpenERP (opcional, per defecte self.invoice)
         """
-        dict_from_marsh = SIIATCDeregister(self.invoice).generate_object()
+        invoice = invoice or self.invoice
+        dict_from_marsh = SIIATCDeregister(invoice).generate_deregister_object()
         res_header = res_invoice = None
         
-        if self.invoice.type.startswith('out_'):
-            res_header = dict_from_marsh['Cabecera']
-            res_invoice = dict_from_marsh['RegistroLRBajaExpedidas']
-        elif self.invoice.type.startswith('in_'):
-            res_header = dict_from_marsh['Cabecera']
-            res_invoice = dict_from_marsh['RegistroLRBajaRecibidas']
+        if invoice.type.startswith('out_'):
+            baja = dict_from_marsh['BajaLRFacturasEmitidas']
+            res_header = baja['Cabecera']
+            res_invoice = baja['RegistroLRBajaExpedidas']
+        elif invoice.type.startswith('in_'):
+            baja = dict_from_marsh['BajaLRFacturasRecibidas']
+            res_header = baja['Cabecera']
+            res_invoice = baja['RegistroLRBajaRecibidas']
         
         return res_header, res_invoice
     
+    def deregister_batch(self, invoices, max_registros=MAX_REGISTROS):
+        """
+        Dona de baixa moltes factures del SII ATC agrupant-les en pocs
+        enviaments
+        
+        Cada petició AnulacionLRFacturas* porta una sola Cabecera i fins a
+        max_registros registres RegistroLRBaja* (l'XSD en permet 10000).
+        
+        :param invoices: Llista de factures d'OpenERP
+        :param max_registros: Màxim de registres per enviament
+        :return: Llista de tuples (factura, resultat), com send_batch
+        """
+        def get_operation(invoice):
+            return self.get_batch_operation(
+                invoice, self.deregister_operations
+            )
+        return send_batch(
+            invoices, self.get_deregister_msg, get_operation, max_registros
+        )
+    
+    def deregister_many(self, invoices, max_workers=MAX_WORKERS,
+                        ordered=False):
+        """
+        Dona de baixa factures una a una des d'un pool de threads
+        
+        :param invoices: Llista de factures d'OpenERP
+        :param max_workers: Nombre de threads
+        :param ordered: Si True retorna els resultats en l'ordre de invoices,
+                        altrament a mesura que acaben
+        :return: Generador de tuples (factura, SendResult o excepció)
+        """
+        return send_many(
+            self.submit_deregister, invoices, max_workers, ordered
+        )
+    
+    def submit_deregister(self, invoice):
+        """
+        Dona de baixa una factura del SII ATC sense guardar estat al servei
+        
+        Equivalent reentrant de deregister, es pot cridar des de molts
+        threads amb el mateix servei.
+        
+        :param invoice: Factura d'OpenERP
+        :return: SendResult de la baixa, com submit
+        :raises Fault: si l'ATC rebutja l'enviament
+        """
+        msg_header, msg_invoice = self.get_deregister_msg(invoice)
+        return send_registro(
+            self.get_batch_operation(invoice, self.deregister_operations),
+            msg_header, msg_invoice
+        )
+    
     def deregister_invoice(self):
         """
         Dona de baixa la factura al servei SOAP
@@ -348,15 +645,23 @@ class SiiDeregisterServiceATC(SiiServiceATC):
         msg_header, msg_invoice = self.get_deregister_msg()
         try:
             if self.invoice.type.startswith('out_'):
-                res = self.emitted_service.AnulacionLRFacturasEmitidas(
+                res = self.call_scheduled(
+                    self.invoice,
+                    self.emitted_service.AnulacionLRFacturasEmitidas,
                     msg_header, msg_invoice
                 )
             elif self.invoice.type.startswith('in_'):
-                res = self.received_service.AnulacionLRFacturasRecibidas(
+                res = self.call_scheduled(
+                    self.invoice,
+                    self.received_service.AnulacionLRFacturasRecibidas,
                     msg_header, msg_invoice
                 )
             self.result = res
             return serialize_object(self.result)
+        except DryRunException as dry_ex:
+            # Mode dry-run: retornar resposta simulada
+            self.result = self.get_dry_run_result(dry_ex)
+            return self.result
         except Exception as fault:
             self.result = fault
             raise fault
@@ -365,14 +670,12 @@ class SiiDeregisterServiceATC(SiiServiceATC):
         """
         Dona de baixa una factura del SII ATC
         
+        Guarda la factura i el resultat al servei i retorna la resposta
+        sencera, submit_deregister retorna el SendResult de la baixa.
+        
         :param invoice: Factura d'OpenERP
         :return: Resposta del servei SOAP serialitzada
         """
         self.invoice = invoice
-        if self.invoice.type.startswith('out_'):
-            if self.emitted_service is None:
-                self.emitted_service = self.create_service()
-        else:
-            if self.received_service is None:
-                self.received_service = self.create_service()
+        self.get_service(invoice)
         return self.deregister_invoice()
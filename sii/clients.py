@@ -0,0 +1,251 @@
+# -*- coding: UTF-8 -*-
+
+from hashlib import sha1
+from io import BytesIO
+from threading import RLock
+import os
+import pickle
+import sys
+import tempfile
+
+from lxml import etree
+from zeep import Client, __version__ as __ZEEP_VERSION__
+from zeep.settings import Settings
+from zeep.transports import Transport
+from zeep.wsdl import Document
+
+from sii import __LIBRARY_VERSION__
+from sii.utils import ensure_private_dir, get_user_cache_dir
+
+# zeep creates a class per XSD type, the modules of these classes can not be
+# imported so they are rebuilt when loading a cached document
+DYNAMIC_MODULES = ('zeep.xsd.dynamic_types', 'zeep.objects')
+DYNAMIC_ATTRIBUTES = ('_xsd_name', '_xsd_type')
+
+
+def get_default_cache_dir():
+    """Returns the directory where parsed WSDL documents are stored.
+
+    It can be set with the SII_WSDL_CACHE_DIR environment variable, by
+    default it is the wsdl directory of the user cache.
+    """
+    return os.environ.get('SII_WSDL_CACHE_DIR') or get_user_cache_dir('wsdl')
+
+
+def get_document_hash(wsdl):
+    """Returns the hash identifying the parsed document of a local WSDL.
+
+    The bundled WSDLs import the XSDs of the sibling xsd directory, so every
+    WSDL/XSD file of both directories is hashed along with the library,
+    zeep and python versions. Returns None for remote locations.
+    """
+    if not wsdl.startswith('file://'):
+        return None
+    wsdl_path = wsdl[len('file://'):]
+    wsdl_dir = os.path.dirname(wsdl_path)
+    digest = sha1()
+    digest.update('{}:{}:{}:{}'.format(
+        __LIBRARY_VERSION__, __ZEEP_VERSION__, sys.version_info[0], wsdl_path
+    ).encode('utf-8'))
+    xsd_dir = os.path.join(os.path.dirname(wsdl_dir), 'xsd')
+    for directory in (wsdl_dir, xsd_dir):
+        if not os.path.isdir(directory):
+            continue
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(('.wsdl', '.xsd')):
+                continue
+            digest.update(filename.encode('utf-8'))
+            with open(os.path.join(directory, filename), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+class DocumentPickler(pickle.Pickler):
+    """Pickles a parsed zeep Document.
+
+    Transport, settings, lxml objects and zeep dynamic classes can not be
+    pickled, they are stored as persistent ids and rebuilt on load.
+    """
+
+    def persistent_id(self, obj):
+        if isinstance(obj, Transport):
+            return ('transport',)
+        if isinstance(obj, Settings):
+            return ('settings',)
+        if isinstance(obj, etree.QName):
+            return ('qname', obj.text)
+        if isinstance(obj, etree._Element):
+            return ('element', etree.tostring(obj))
+        if isinstance(obj, type) and obj.__module__ in DYNAMIC_MODULES:
+            attrs = dict(
+                (name, value) for name, value in vars(obj).items()
+                if name in DYNAMIC_ATTRIBUTES
+            )
+            attrs['__module__'] = obj.__module__
+            return ('class', obj.__name__, obj.__bases__, attrs)
+        return None
+
+
+class DocumentUnpickler(pickle.Unpickler):
+    """Loads a zeep Document pickled with DocumentPickler.
+
+    Every reference to a dynamic class is pickled on its own, so the rebuilt
+    classes are memoized by module, name, bases and XSD qname or type to load
+    a single class per pickled one.
+    """
+
+    def __init__(self, f, transport):
+        pickle.Unpickler.__init__(self, f)
+        self.transport = transport
+        self.settings = Settings()
+        self.classes = {}
+
+    def get_class(self, name, bases, attrs):
+        key = (
+            attrs.get('__module__'), name, bases, attrs.get('_xsd_name'),
+            id(attrs.get('_xsd_type'))
+        )
+        cls = self.classes.get(key)
+        if cls is None:
+            cls = self.classes[key] = type(name, bases, dict(attrs))
+        return cls
+
+    def persistent_load(self, pid):
+        kind = pid[0]
+        if kind == 'transport':
+            return self.transport
+        if kind == 'settings':
+            return self.settings
+        if kind == 'qname':
+            return etree.QName(pid[1])
+        if kind == 'element':
+            return etree.fromstring(pid[1])
+        if kind == 'class':
+            return self.get_class(pid[1], pid[2], pid[3])
+        raise pickle.UnpicklingError('Unknown persistent id {}'.format(kind))
+
+
+class ClientCache(object):
+    """Process-wide cache of parsed WSDL documents and zeep services.
+
+    WSDL documents are parsed once per location and services are shared by
+    every caller using the same (wsdl, port, binding, address, certificate).
+    Parsed documents of local WSDLs are also stored in cache_dir, so new
+    processes load them without parsing the XSDs again. The disk cache is
+    only used when cache_dir is owned by the current user and no one else can
+    access it, set cache_dir to None to disable it.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.documents = {}
+        self.services = {}
+        self.lock = RLock()
+        self.cache_dir = cache_dir
+
+    def get_document(self, wsdl, transport):
+        """Returns the parsed WSDL document of a location."""
+        with self.lock:
+            document = self.documents.get(wsdl)
+            if document is None:
+                document = self.load_document(wsdl, transport)
+                self.documents[wsdl] = document
+            return document
+
+    def get_document_path(self, wsdl):
+        if not self.cache_dir:
+            return None
+        document_hash = get_document_hash(wsdl)
+        if document_hash is None or not ensure_private_dir(self.cache_dir):
+            return None
+        return os.path.join(self.cache_dir, '{}.pickle'.format(document_hash))
+
+    def load_document(self, wsdl, transport):
+        """Loads a document from the disk cache or parses and stores it.
+
+        Any error reading or writing the cache falls back to parsing the WSDL.
+        """
+        try:
+            document_path = self.get_document_path(wsdl)
+        except (IOError, OSError):
+            document_path = None
+        if document_path and os.path.exists(document_path):
+            try:
+                with open(document_path, 'rb') as f:
+                    return DocumentUnpickler(f, transport).load()
+            except Exception:
+                pass
+        document = Document(wsdl, transport)
+        if document_path:
+            self.store_document(document, document_path)
+        return document
+
+    def store_document(self, document, document_path):
+        try:
+            data = BytesIO()
+            DocumentPickler(data, 2).dump(document)
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(tmp_fd, 'wb') as f:
+                f.write(data.getvalue())
+            os.rename(tmp_path, document_path)
+        except Exception:
+            pass
+
+    def get_service(self, create_transport, wsdl, port_name, service_name,
+                    binding_name=None, address=None, certificate=None,
+                    client_class=Client):
+        """Returns a cached zeep service, creating it on the first call.
+
+        :param create_transport: callable returning the Transport of a new
+            service
+        :param wsdl: WSDL location (url or file://)
+        :param port_name: name of the port to bind when address is not set
+        :param service_name: name of the service to bind
+        :param binding_name: QName of the binding used with address
+        :param address: endpoint address overriding the one of the WSDL
+        :param certificate: certificate identifying the client, usually the
+            (certificate, key) pair
+        :param client_class: zeep Client or AsyncClient
+        :return: zeep ServiceProxy
+        """
+        key = (wsdl, port_name, binding_name, address, certificate)
+        with self.lock:
+            service = self.services.get(key)
+            if service is None:
+                service = self.create_service(
+                    create_transport(), wsdl, port_name, service_name,
+                    binding_name, address, client_class=client_class
+                )
+                self.services[key] = service
+            return service
+
+    def create_service(self, transport, wsdl, port_name, service_name,
+                       binding_name=None, address=None, plugins=None,
+                       client_class=Client):
+        """Returns a new zeep service built from the cached WSDL document."""
+        client = client_class(
+            wsdl=self.get_document(wsdl, transport), port_name=port_name,
+            transport=transport, service_name=service_name, plugins=plugins
+        )
+        if not address:
+            return client.service
+        return client.create_service(binding_name, address)
+
+    def discard_services(self, owner):
+        """Drops the services whose certificate holds owner, for instance
+        the SessionRegistry of their transports once it is closed.
+        """
+        with self.lock:
+            for key in list(self.services):
+                certificate = key[4]
+                if not isinstance(certificate, tuple):
+                    certificate = (certificate,)
+                if any(item is owner for item in certificate):
+                    del self.services[key]
+
+    def clear(self):
+        with self.lock:
+            self.documents.clear()
+            self.services.clear()
+
+
+CLIENT_CACHE = ClientCache(cache_dir=get_default_cache_dir())
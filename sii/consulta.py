@@ -0,0 +1,346 @@
+# -*- coding: UTF-8 -*-
+"""Queries of the registros stored in the SII books (ConsultaLR)."""
+
+from collections import namedtuple
+from io import BytesIO
+
+from lxml import etree
+from zeep.helpers import serialize_object
+
+from sii.response import SendResult
+
+CONSULTA_OPERATIONS = {
+    'out': 'ConsultaLRFacturasEmitidas',
+    'in': 'ConsultaLRFacturasRecibidas'
+}
+
+CONSULTA_RECORDS = {
+    'out': 'RegistroRespuestaConsultaLRFacturasEmitidas',
+    'in': 'RegistroRespuestaConsultaLRFacturasRecibidas'
+}
+
+# EstadoRegistro of the books for the registros that are stored
+ESTADOS_ALTA = ('Correcta', 'AceptadaConErrores')
+ESTADO_ANULADA = 'Anulada'
+
+
+def get_consulta_header(msg_header):
+    """Returns the CabeceraConsultaSii of a SuministroLR/BajaLR Cabecera."""
+    return {
+        'IDVersionSii': msg_header['IDVersionSii'],
+        'Titular': msg_header['Titular']
+    }
+
+
+def get_periodo_key(registro):
+    """Returns the (Ejercicio, Periodo) of a registro."""
+    periodo = registro['PeriodoLiquidacion']
+    return periodo['Ejercicio'], periodo['Periodo']
+
+
+def get_consulta_filter(registro, since=None):
+    """Returns the FiltroConsulta of the period of a registro.
+
+    :param registro: SuministroLR/BajaLR registro
+    :param since: date, only registros presented since then are returned
+    """
+    filtro = {'PeriodoLiquidacion': registro['PeriodoLiquidacion']}
+    if since is not None:
+        filtro['FechaPresentacion'] = {'Desde': since.strftime('%d-%m-%Y')}
+    return filtro
+
+
+def iter_consulta(operation, book, msg_header, filtro):
+    """Yields every registro matching a filter following the pagination.
+
+    :param operation: ConsultaLR SOAP operation of the book
+    :param book: 'out' or 'in'
+    :param msg_header: CabeceraConsultaSii
+    :param filtro: FiltroConsulta without ClavePaginacion
+    :return: generator of serialized RegistroRespuestaConsultaLR
+    """
+    filtro = dict(filtro)
+    while True:
+        response = serialize_object(operation(msg_header, filtro))
+        records = response.get(CONSULTA_RECORDS[book]) or []
+        for record in records:
+            yield record
+        if response.get('IndicadorPaginacion') != 'S' or not records:
+            break
+        filtro['ClavePaginacion'] = records[-1]['IDFactura']
+
+
+def get_consulta_outcome(record):
+    """Builds the outcome of a registro found with a ConsultaLR.
+
+    The outcome is a sii.response.SendResult like the ones built by
+    get_registro_outcome, the registro is reported as accepted (with errors
+    when the books say so) and the RegistroRespuestaConsultaLR is kept in
+    'Consulta'.
+    """
+    estado_factura = record.get('EstadoFactura') or {}
+    if estado_factura.get('EstadoRegistro') == 'AceptadaConErrores':
+        estado = 'AceptadoConErrores'
+    else:
+        estado = 'Correcto'
+    return SendResult(
+        estado, (record.get('DatosPresentacion') or {}).get('CSV'),
+        estado_factura.get('CodigoErrorRegistro'),
+        estado_factura.get('DescripcionErrorRegistro'), consulta=record
+    )
+
+
+class ConsultaRecord(namedtuple('ConsultaRecord', [
+    'book', 'ejercicio', 'periodo', 'nif', 'id_otro', 'nombre', 'num_serie',
+    'fecha_expedicion', 'tipo_factura', 'importe_total', 'detalle_iva',
+    'contraparte', 'estado_registro', 'codigo_error', 'estado_cuadre', 'csv',
+    'timestamp_presentacion', 'timestamp_modificacion'
+])):
+    """Compact registro of a ConsultaLR response.
+
+    Values are the texts of the XML, detalle_iva is a tuple of
+    (TipoImpositivo, BaseImponible, Cuota) tuples and id_otro the
+    (CodigoPais, IDType, ID) of issuers without NIF.
+    """
+    __slots__ = ()
+
+    @property
+    def key(self):
+        """Same key as sii.response.get_factura_key."""
+        emisor_id = self.nif or (self.id_otro and self.id_otro[2])
+        return emisor_id, self.num_serie, self.fecha_expedicion
+
+
+def get_clave_paginacion(record):
+    """Returns the ClavePaginacion to query the registros after a record."""
+    emisor = {}
+    if record.book == 'in':
+        emisor['NombreRazon'] = record.nombre
+    if record.nif:
+        emisor['NIF'] = record.nif
+    else:
+        codigo_pais, id_type, id_otro = record.id_otro
+        emisor['IDOtro'] = {
+            'CodigoPais': codigo_pais, 'IDType': id_type, 'ID': id_otro
+        }
+    return {
+        'IDEmisorFactura': emisor,
+        'NumSerieFacturaEmisor': record.num_serie,
+        'FechaExpedicionFacturaEmisor': record.fecha_expedicion
+    }
+
+
+def get_detalle_iva(datos):
+    res = []
+    for detalle in datos.iterfind('.//{*}DetalleIVA'):
+        cuota = detalle.findtext('{*}CuotaRepercutida')
+        if cuota is None:
+            cuota = detalle.findtext('{*}CuotaSoportada')
+        res.append((
+            detalle.findtext('{*}TipoImpositivo'),
+            detalle.findtext('{*}BaseImponible'),
+            cuota
+        ))
+    return tuple(res)
+
+
+def get_id_otro(element):
+    if element is None:
+        return None
+    return (
+        element.findtext('{*}CodigoPais'), element.findtext('{*}IDType'),
+        element.findtext('{*}ID')
+    )
+
+
+def parse_record(element, book, ejercicio, periodo):
+    """Builds the ConsultaRecord of a RegistroRespuestaConsultaLR element."""
+    emisor = element.find('{*}IDFactura/{*}IDEmisorFactura')
+    if book == 'out':
+        datos = element.find('{*}DatosFacturaEmitida')
+    else:
+        datos = element.find('{*}DatosFacturaRecibida')
+    if datos is None:
+        datos = etree.Element('DatosFactura')
+    contraparte = datos.find('{*}Contraparte')
+    contraparte_id = None
+    if contraparte is not None:
+        contraparte_id = (
+            contraparte.findtext('{*}NIF') or
+            contraparte.findtext('{*}IDOtro/{*}ID')
+        )
+    return ConsultaRecord(
+        book=book,
+        ejercicio=ejercicio,
+        periodo=periodo,
+        nif=emisor.findtext('{*}NIF'),
+        id_otro=get_id_otro(emisor.find('{*}IDOtro')),
+        nombre=emisor.findtext('{*}NombreRazon'),
+        num_serie=element.findtext('{*}IDFactura/{*}NumSerieFacturaEmisor'),
+        fecha_expedicion=element.findtext(
+            '{*}IDFactura/{*}FechaExpedicionFacturaEmisor'
+        ),
+        tipo_factura=datos.findtext('{*}TipoFactura'),
+        importe_total=datos.findtext('{*}ImporteTotal'),
+        detalle_iva=get_detalle_iva(datos),
+        contraparte=contraparte_id,
+        estado_registro=element.findtext(
+            '{*}EstadoFactura/{*}EstadoRegistro'
+        ),
+        codigo_error=element.findtext(
+            '{*}EstadoFactura/{*}CodigoErrorRegistro'
+        ),
+        estado_cuadre=element.findtext('{*}EstadoFactura/{*}EstadoCuadre'),
+        csv=element.findtext('{*}DatosPresentacion/{*}CSV'),
+        timestamp_presentacion=element.findtext(
+            '{*}DatosPresentacion/{*}TimestampPresentacion'
+        ),
+        timestamp_modificacion=element.findtext(
+            '{*}EstadoFactura/{*}TimestampUltimaModificacion'
+        )
+    )
+
+
+class ConsultaPage(object):
+    """Incremental parser of a raw ConsultaLR response page.
+
+    Registros are converted to ConsultaRecord and freed as soon as they are
+    parsed, the zeep object tree of the page is never built. After parsing,
+    more tells whether the book has more registros (IndicadorPaginacion) and
+    last is the last record, to build the ClavePaginacion of the next page.
+    """
+
+    def __init__(self, book, ejercicio=None, periodo=None):
+        self.book = book
+        self.ejercicio = ejercicio
+        self.periodo = periodo
+        self.record_name = CONSULTA_RECORDS[book]
+        self.more = False
+        self.last = None
+
+    def parse_record(self, element):
+        return parse_record(element, self.book, self.ejercicio, self.periodo)
+
+    def parse(self, content):
+        """Yields the record of every registro of the page.
+
+        :param content: bytes of the SOAP response
+        """
+        for _, element in etree.iterparse(BytesIO(content), events=('end',)):
+            name = etree.QName(element).localname
+            if name == 'IndicadorPaginacion':
+                self.more = element.text == 'S'
+            elif name == self.record_name:
+                self.last = self.parse_record(element)
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+                yield self.last
+
+
+class InformadaClienteRecord(namedtuple('InformadaClienteRecord', [
+    'nif', 'nombre', 'num_serie', 'fecha_expedicion', 'ejercicio', 'periodo',
+    'cliente', 'cliente_nombre', 'tipo_factura', 'importe_total',
+    'detalle_iva', 'fecha_reg_contable', 'estado_cuadre',
+    'timestamp_estado_cuadre'
+])):
+    """Compact invoice reported by a customer, from the
+    ConsultaLRFactInformadasCliente.
+
+    The invoice is the one the customer holds in its received book, nif is
+    the Titular that issued it and ejercicio/periodo its PeriodoLiquidacion
+    in the customer book.
+    """
+    __slots__ = ()
+
+    @property
+    def key(self):
+        """Same key as ConsultaRecord.key of the emitted book."""
+        return self.nif, self.num_serie, self.fecha_expedicion
+
+
+AgrupadaClienteRecord = namedtuple(
+    'AgrupadaClienteRecord', ['cliente', 'cliente_nombre', 'numero_facturas']
+)
+
+
+def parse_informada_cliente(element):
+    """Builds the InformadaClienteRecord of a
+    RegistroRespuestaConsultaLRFactInformadasCliente element.
+    """
+    datos = element.find('{*}DatosFacturaInformadaCliente')
+    if datos is None:
+        datos = etree.Element('DatosFactura')
+    return InformadaClienteRecord(
+        nif=element.findtext('{*}IDFactura/{*}IDEmisorFactura/{*}NIF'),
+        nombre=element.findtext(
+            '{*}IDFactura/{*}IDEmisorFactura/{*}NombreRazon'
+        ),
+        num_serie=element.findtext('{*}IDFactura/{*}NumSerieFacturaEmisor'),
+        fecha_expedicion=element.findtext(
+            '{*}IDFactura/{*}FechaExpedicionFacturaEmisor'
+        ),
+        ejercicio=element.findtext('{*}PeriodoLiquidacion/{*}Ejercicio'),
+        periodo=element.findtext('{*}PeriodoLiquidacion/{*}Periodo'),
+        cliente=element.findtext('{*}Cliente/{*}NIF'),
+        cliente_nombre=element.findtext('{*}Cliente/{*}NombreRazon'),
+        tipo_factura=datos.findtext('{*}TipoFactura'),
+        importe_total=datos.findtext('{*}ImporteTotal'),
+        detalle_iva=get_detalle_iva(datos),
+        fecha_reg_contable=datos.findtext('{*}FechaRegContable'),
+        estado_cuadre=element.findtext('{*}EstadoFactura/{*}EstadoCuadre'),
+        timestamp_estado_cuadre=element.findtext(
+            '{*}EstadoFactura/{*}TimestampEstadoCuadre'
+        )
+    )
+
+
+def parse_agrupada_cliente(element):
+    """Builds the AgrupadaClienteRecord of a
+    RegistroRespuestaConsultaLRFactInformadasAgrupadasCliente element.
+    """
+    return AgrupadaClienteRecord(
+        cliente=element.findtext('{*}Cliente/{*}NIF'),
+        cliente_nombre=element.findtext('{*}Cliente/{*}NombreRazon'),
+        numero_facturas=int(element.findtext('{*}NumeroFacturas') or 0)
+    )
+
+
+class InformadasClientePage(ConsultaPage):
+    """Incremental parser of a ConsultaLRFactInformadasCliente page."""
+
+    def __init__(self):
+        super(InformadasClientePage, self).__init__('out')
+        self.record_name = 'RegistroRespuestaConsultaLRFactInformadasCliente'
+
+    def parse_record(self, element):
+        return parse_informada_cliente(element)
+
+
+class AgrupadasClientePage(ConsultaPage):
+    """Incremental parser of a ConsultaLRFactInformadasAgrupadasCliente
+    response, which is never paginated.
+    """
+
+    def __init__(self):
+        super(AgrupadasClientePage, self).__init__('out')
+        self.record_name = (
+            'RegistroRespuestaConsultaLRFactInformadasAgrupadasCliente'
+        )
+
+    def parse_record(self, element):
+        return parse_agrupada_cliente(element)
+
+
+def get_clave_paginacion_cliente(record):
+    """Returns the ClavePaginacion to query the invoices reported by the
+    customers after an InformadaClienteRecord.
+    """
+    return {
+        'IDEmisorFactura': {'NombreRazon': record.nombre, 'NIF': record.nif},
+        'NumSerieFacturaEmisor': record.num_serie,
+        'FechaExpedicionFacturaEmisor': record.fecha_expedicion,
+        'Cliente': {
+            'NombreRazon': record.cliente_nombre, 'NIF': record.cliente
+        }
+    }
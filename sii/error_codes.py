@@ -0,0 +1,126 @@
+# -*- coding: UTF-8 -*-
+"""Catalogue of the SII error codes indexed by code.
+
+Every CodigoErrorRegistro (RespuestaSuministro.xsd ErrorDetalleType) and
+Fault code is mapped to the way a client should handle it. Codes are looked
+up in a dict, codes without an explicit entry fall back to the category of
+their family (the thousands digit) as documented by the SII validations:
+
+- 1xxx: the registro is rejected
+- 2xxx: the registro is accepted with errors that must be corrected later
+- 3xxx: the registro is rejected by the state of the books
+- 4xxx: the whole submission is rejected
+"""
+import re
+
+RETRYABLE = 'retryable'
+PERMANENT = 'permanent'
+DUPLICATE = 'duplicate'
+NEEDS_A1 = 'needs_a1'
+WARNING = 'warning'
+CATEGORIES = (RETRYABLE, PERMANENT, DUPLICATE, NEEDS_A1, WARNING)
+
+FAULT_CODE_RE = re.compile(r'Codigo\[(-?\d+)\]')
+
+FAMILIES = {
+    1: PERMANENT,
+    2: WARNING,
+    3: PERMANENT,
+    4: PERMANENT
+}
+
+
+class ErrorCatalogue(object):
+    """Maps SII error codes to categories in O(1).
+
+    :param codes: dict of {code: category} of the codes handled differently
+        than their family
+    :param families: dict of {thousands digit: category}
+    :param default: category of unknown codes
+    """
+
+    def __init__(self, codes, families=None, default=PERMANENT):
+        self.codes = dict(codes)
+        self.families = dict(families or FAMILIES)
+        self.default = default
+
+    def get_category(self, code):
+        """Returns the category of an error code, None if code is empty.
+
+        Codes without an entry in codes get the category of their family and
+        codes without family the default one.
+        """
+        if code is None or code == '':
+            return None
+        code = int(code)
+        category = self.codes.get(code)
+        if category is None:
+            category = self.families.get(code // 1000, self.default)
+        return category
+
+
+# The codes handled differently than their family and the ones that look like
+# they could be retried or resent but can not are listed, any other code falls
+# back to FAMILIES (e.g. an unlisted 41xx code is PERMANENT). Descriptions
+# from RespuestaSuministro.xsd and VALIDACIONES Y ERRORES
+ERROR_CODES = ErrorCatalogue({
+    # Technical errors, the same submission may be accepted later
+    3500: RETRYABLE,  # Error técnico de BBDD. Integridad de la información
+    3501: RETRYABLE,  # Error técnico de BBDD
+    4107: RETRYABLE,  # Error técnico al obtener el CSV
+    4110: RETRYABLE,  # Error al obtener el certificado
+    4112: RETRYABLE,  # Error técnico al comprobar apoderamientos
+    4113: RETRYABLE,  # Error técnico al crear el trámite
+    4115: RETRYABLE,  # Error técnico al comprobar Colaboración Social
+    4116: RETRYABLE,  # Se ha superado el límite de envíos permitido
+    4121: RETRYABLE,  # Error técnico al procesar cuadre
+    4127: RETRYABLE,  # Error técnico al consultar el Censo SII
+    4128: RETRYABLE,  # Error técnico al grabar en bandeja de entrada
+    4129: RETRYABLE,  # Error técnico al identificar la situación de la
+                      # contraparte
+    # Already registered, an A0 has to be sent again as A1
+    3000: NEEDS_A1,  # Factura duplicada
+    # The books already hold what was sent
+    3001: DUPLICATE,  # El registro está ya dado de baja
+    3008: DUPLICATE,  # Ya existe un Cobro en Metálico con esta Contraparte
+    3013: DUPLICATE,  # Ya existe un Registro de Agencia de Viajes con esta
+                      # Contraparte
+    # The registro to modify or deregister is not in the books, resending it
+    # as A1 or as a baja fails again
+    3002: PERMANENT,  # No existe el Registro
+    3003: PERMANENT,  # No se pueden incluir cobros de facturas dadas de baja
+    3006: PERMANENT,  # No se pueden incluir pagos de facturas dadas de baja
+    3010: PERMANENT,  # El Presentador no tiene los permisos necesarios para
+                      # actualizar esta factura
+    3902: PERMANENT,  # La Factura especificada no pertenece al Titular
+                      # registrado en el sistema
+    # The whole submission is rejected, sending it again fails again
+    4102: PERMANENT,  # El XML no cumple el esquema. Falta informar campo
+                      # obligatorio
+    4103: PERMANENT,  # Error no esperado al parsear el XML
+    4104: PERMANENT,  # Error en la cabecera. El valor del campo NIF del
+                      # bloque Titular no está identificado
+    4109: PERMANENT,  # El NIF no está identificado
+    4114: PERMANENT,  # El titular del certificado debe ser el Titular del
+                      # libro de Registro, Colaborador Social, Apoderado o
+                      # Sucesor
+    4117: PERMANENT,  # El XML no cumple el esquema. Se ha superado el
+                      # límite máximo permitido de facturas a registrar
+    4118: PERMANENT,  # El NIF del titular no está autorizado a enviar
+                      # información al sistema
+    # Accepted, the registro has to be corrected with an A1
+    2011: WARNING,  # El NIF de la contraparte no está censado
+})
+
+
+def get_fault_code(fault):
+    """Returns the error code of a SII Fault ("Codigo[4102]...") or None."""
+    match = FAULT_CODE_RE.search(fault.message or '')
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def get_error_category(code, catalogue=ERROR_CODES):
+    """Returns the category of a SII error code."""
+    return catalogue.get_category(code)
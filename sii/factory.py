@@ -25,8 +25,10 @@ Exemple d'ús:
     )
 """
 
+from sii.clients import CLIENT_CACHE
 from sii.server import SiiService, SiiDeregisterService
 from sii.atc.server import SiiServiceATC, SiiDeregisterServiceATC
+from sii.sessions import SessionRegistry
 
 
 class SiiServiceFactory(object):
@@ -39,12 +41,48 @@ class SiiServiceFactory(object):
     Constants:
         AEAT: Codi per l'Agència Tributària Espanyola
         ATC: Codi per l'Agència Tributària Canària
+    
+    Tots els serveis creats pel factory comparteixen les sessions HTTP
+    (keep-alive) del registre session_registry, per certificat i host.
     """
     
     # Constants per identificar tipus de servei
     AEAT = 'aeat'
     ATC = 'atc'
     
+    # Registre de sessions HTTP compartit per tots els serveis del factory
+    session_registry = SessionRegistry()
+    
+    @classmethod
+    def configure_sessions(cls, pool_size=None, max_idle=None):
+        """
+        Configura el registre de sessions HTTP compartit
+        
+        Tanca les sessions actuals, descarta els serveis SOAP de la caché
+        que les utilitzaven i en crea un registre nou. Els serveis creats a
+        partir d'aquest moment utilitzaran el registre nou.
+        
+        :param pool_size: Màxim de connexions obertes per host
+        :type pool_size: int or None
+        :param max_idle: Segons d'inactivitat després dels quals es tanquen
+                         les connexions d'una sessió
+        :type max_idle: int or None
+        :return: El nou registre de sessions
+        :rtype: SessionRegistry
+        
+        Exemple:
+            >>> SiiServiceFactory.configure_sessions(pool_size=20, max_idle=60)
+        """
+        CLIENT_CACHE.discard_services(cls.session_registry)
+        cls.session_registry.close()
+        kwargs = {}
+        if pool_size is not None:
+            kwargs['pool_size'] = pool_size
+        if max_idle is not None:
+            kwargs['max_idle'] = max_idle
+        cls.session_registry = SessionRegistry(**kwargs)
+        return cls.session_registry
+    
     @classmethod
     def create_service(cls, service_type, certificate, key, url=None, test_mode=False):
         """
@@ -81,7 +119,8 @@ class SiiServiceFactory(object):
                 certificate=certificate,
                 key=key,
                 url=url,
-                test_mode=test_mode
+                test_mode=test_mode,
+                session_registry=cls.session_registry
             )
         elif service_type == cls.ATC:
             # IMPORTANT: Si usem proxy (url), sempre usar WSDLs locals
@@ -93,7 +132,8 @@ class SiiServiceFactory(object):
                 key=key,
                 url=url,
                 test_mode=test_mode,
-                use_local_wsdl=use_local_wsdl
+                use_local_wsdl=use_local_wsdl,
+                session_registry=cls.session_registry
             )
         else:
             raise ValueError(
@@ -138,14 +178,16 @@ class SiiServiceFactory(object):
                 certificate=certificate,
                 key=key,
                 url=url,
-                test_mode=test_mode
+                test_mode=test_mode,
+                session_registry=cls.session_registry
             )
         elif service_type == cls.ATC:
             return SiiDeregisterServiceATC(
                 certificate=certificate,
                 key=key,
                 url=url,
-                test_mode=test_mode
+                test_mode=test_mode,
+                session_registry=cls.session_registry
             )
         else:
             raise ValueError(
@@ -0,0 +1,185 @@
+# -*- coding: UTF-8 -*-
+"""Local SQLite mirror of the registros stored in the SII books.
+
+The registros of every (Titular, book, period) are fetched with
+sii.server.ConsultaService and stored indexed by (NIF, NumSerieFacturaEmisor,
+FechaExpedicionFacturaEmisor). Every sync fetches the whole period and
+replaces the stored one: ConsultaLR can only filter by FechaPresentacion,
+the date of the alta, so modifications and bajas of registros presented
+before the last sync would never be fetched by an incremental sync.
+"""
+
+from datetime import date
+from itertools import islice
+import json
+import sqlite3
+
+from sii.consulta import ConsultaRecord
+
+CHUNK_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS registros (
+    titular TEXT NOT NULL,
+    book TEXT NOT NULL,
+    ejercicio TEXT NOT NULL,
+    periodo TEXT NOT NULL,
+    nif TEXT NOT NULL,
+    id_otro TEXT,
+    nombre TEXT,
+    num_serie TEXT NOT NULL,
+    fecha_expedicion TEXT NOT NULL,
+    tipo_factura TEXT,
+    importe_total TEXT,
+    detalle_iva TEXT,
+    contraparte TEXT,
+    estado_registro TEXT,
+    codigo_error TEXT,
+    estado_cuadre TEXT,
+    csv TEXT,
+    timestamp_presentacion TEXT,
+    timestamp_modificacion TEXT,
+    PRIMARY KEY (titular, book, nif, num_serie, fecha_expedicion)
+);
+CREATE INDEX IF NOT EXISTS registros_factura
+    ON registros (nif, num_serie, fecha_expedicion);
+CREATE INDEX IF NOT EXISTS registros_periodo
+    ON registros (titular, book, ejercicio, periodo);
+CREATE TABLE IF NOT EXISTS syncs (
+    titular TEXT NOT NULL,
+    book TEXT NOT NULL,
+    ejercicio TEXT NOT NULL,
+    periodo TEXT NOT NULL,
+    fecha TEXT NOT NULL,
+    PRIMARY KEY (titular, book, ejercicio, periodo)
+);
+"""
+
+COLUMNS = (
+    'titular', 'book', 'ejercicio', 'periodo', 'nif', 'id_otro', 'nombre',
+    'num_serie', 'fecha_expedicion', 'tipo_factura', 'importe_total',
+    'detalle_iva', 'contraparte', 'estado_registro', 'codigo_error',
+    'estado_cuadre', 'csv', 'timestamp_presentacion',
+    'timestamp_modificacion'
+)
+
+INSERT = 'INSERT OR REPLACE INTO registros ({0}) VALUES ({1})'.format(
+    ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))
+)
+
+SELECT = 'SELECT {0} FROM registros'.format(', '.join(COLUMNS[1:]))
+
+
+def get_row(titular, record):
+    """Returns the registros row of a ConsultaRecord."""
+    id_otro = record.id_otro and json.dumps(record.id_otro)
+    return (
+        titular, record.book, record.ejercicio, record.periodo,
+        record.key[0], id_otro, record.nombre, record.num_serie,
+        record.fecha_expedicion, record.tipo_factura, record.importe_total,
+        json.dumps(record.detalle_iva), record.contraparte,
+        record.estado_registro, record.codigo_error, record.estado_cuadre,
+        record.csv, record.timestamp_presentacion,
+        record.timestamp_modificacion
+    )
+
+
+def get_record(row):
+    """Returns the ConsultaRecord of a registros row without the titular."""
+    values = dict(zip(COLUMNS[1:], row))
+    values['nif'] = None if values['id_otro'] else values['nif']
+    values['id_otro'] = values['id_otro'] and tuple(
+        json.loads(values['id_otro'])
+    )
+    values['detalle_iva'] = tuple(
+        tuple(detalle) for detalle in json.loads(values['detalle_iva'])
+    )
+    return ConsultaRecord(**values)
+
+
+class SiiMirror(object):
+    """SQLite mirror of the SII books.
+
+    :param service: sii.server.ConsultaService used to sync
+    :param path: path of the SQLite database, in memory by default
+    """
+
+    def __init__(self, service, path=':memory:'):
+        self.service = service
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def sync(self, book, titular, ejercicio, periodo, today=None):
+        """Fetches every registro of a period and replaces the stored ones.
+
+        The sync is stored in one transaction, nothing changes when the
+        ConsultaLR fails.
+
+        :param book: 'out' or 'in'
+        :param titular: dict with the NombreRazon and NIF of the Titular
+        :param today: date of the sync, today by default
+        :return: number of registros fetched
+        """
+        today = today or date.today()
+        records = self.service.iter_registros(
+            book, titular, ejercicio, periodo
+        )
+        fetched = 0
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM registros WHERE titular = ? AND book = ? AND '
+                'ejercicio = ? AND periodo = ?',
+                (titular['NIF'], book, ejercicio, periodo)
+            )
+            while True:
+                rows = [
+                    get_row(titular['NIF'], record)
+                    for record in islice(records, CHUNK_SIZE)
+                ]
+                if not rows:
+                    break
+                self.connection.executemany(INSERT, rows)
+                fetched += len(rows)
+            self.connection.execute(
+                'INSERT OR REPLACE INTO syncs VALUES (?, ?, ?, ?, ?)',
+                (titular['NIF'], book, ejercicio, periodo, today.isoformat())
+            )
+        return fetched
+
+    def get_last_sync(self, book, titular_nif, ejercicio, periodo):
+        """Returns the date of the last sync of a period, None if never."""
+        row = self.connection.execute(
+            'SELECT fecha FROM syncs WHERE titular = ? AND book = ? AND '
+            'ejercicio = ? AND periodo = ?',
+            (titular_nif, book, ejercicio, periodo)
+        ).fetchone()
+        if row is None:
+            return None
+        year, month, day = row[0].split('-')
+        return date(int(year), int(month), int(day))
+
+    def get_registro(self, nif, num_serie, fecha_expedicion):
+        """Returns the ConsultaRecord of an invoice, None if not mirrored.
+
+        :param nif: NIF (or IDOtro ID) of the issuer
+        :param fecha_expedicion: date in dd-mm-yyyy format
+        """
+        row = self.connection.execute(
+            SELECT + ' WHERE nif = ? AND num_serie = ? AND '
+                     'fecha_expedicion = ?',
+            (nif, num_serie, fecha_expedicion)
+        ).fetchone()
+        return row and get_record(row)
+
+    def iter_registros(self, book, titular_nif, ejercicio, periodo):
+        """Yields the mirrored ConsultaRecord of a period."""
+        cursor = self.connection.execute(
+            SELECT + ' WHERE titular = ? AND book = ? AND ejercicio = ? AND '
+                     'periodo = ?',
+            (titular_nif, book, ejercicio, periodo)
+        )
+        for row in cursor:
+            yield get_record(row)
@@ -645,6 +645,18 @@ class SuministroFacturasEmitidas(MySchema):
     )
 
 
+class RegistroLoteFacturasEmitidas(RegistroFacturas):
+    RegistroLRFacturasEmitidas = fields.List(
+        fields.Nested(FacturaEmitida), required=True
+    )
+
+
+class SuministroLoteFacturasEmitidas(MySchema):
+    SuministroLRFacturasEmitidas = fields.Nested(
+        RegistroLoteFacturasEmitidas, required=True
+    )
+
+
 class DetalleIVADesglose(DetalleIVA):
     CuotaSoportada = fields.Float()
     TipoImpositivo = fields.Float()
@@ -723,3 +735,15 @@ class SuministroFacturasRecibidas(MySchema):
     SuministroLRFacturasRecibidas = fields.Nested(
         RegistroFacturasRecibidas, required=True
     )
+
+
+class RegistroLoteFacturasRecibidas(RegistroFacturas):
+    RegistroLRFacturasRecibidas = fields.List(
+        fields.Nested(FacturaRecibida), required=True
+    )
+
+
+class SuministroLoteFacturasRecibidas(MySchema):
+    SuministroLRFacturasRecibidas = fields.Nested(
+        RegistroLoteFacturasRecibidas, required=True
+    )
@@ -0,0 +1,302 @@
+# -*- coding: UTF-8 -*-
+"""Cache of the raw responses of the ConsultaLR queries.
+
+Responses are keyed by the SOAP operation, the NIF of the Titular and the
+normalized FiltroConsulta, so the same query built with a different item
+order, an int period or empty items hits the same entry. Entries expire
+after ttl seconds, the least recently used ones are evicted when the cache
+exceeds max_size bytes and every query of a (Titular, period) is
+invalidated when invoices of that period are submitted or deregistered.
+"""
+
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from datetime import date
+from hashlib import sha1
+from threading import Lock
+import json
+import os
+import tempfile
+import time
+
+from sii.utils import ensure_private_dir, get_user_cache_dir
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+PERIOD_ITEMS = ('Periodo', 'PeriodoImputacion')
+
+# Python 2 and 3 compatible abc.ABC
+ABC = ABCMeta('ABC', (object,), {})
+
+
+def normalize(value, name=None):
+    """Returns a JSON serializable version of a filter value.
+
+    Empty items are removed, dates are formatted as dd-mm-yyyy and the other
+    values are compared as text, padding the periods to two digits.
+    """
+    if isinstance(value, dict):
+        return dict(
+            (key, normalize(item, key)) for key, item in value.items()
+            if item is not None and item != ''
+        )
+    if isinstance(value, (list, tuple)):
+        return [normalize(item, name) for item in value]
+    if isinstance(value, date):
+        return value.strftime('%d-%m-%Y')
+    text = u'{}'.format(value).strip()
+    if name in PERIOD_ITEMS and text.isdigit():
+        text = text.zfill(2)
+    return text
+
+
+def get_titular_nif(msg_header):
+    titular = msg_header.get('Titular') or msg_header.get('TitularLRFE')
+    return (titular or {}).get('NIF')
+
+
+def get_period_tag(titular_nif, ejercicio, periodo):
+    """Returns the hash shared by the keys of the queries of a period."""
+    tag = normalize([titular_nif, ejercicio, periodo], 'Periodo')
+    return sha1(json.dumps(tag).encode('utf-8')).hexdigest()[:16]
+
+
+def get_filter_period(filtro):
+    """Returns the (Ejercicio, Periodo) queried by a FiltroConsulta."""
+    periodo = filtro.get('PeriodoLiquidacion')
+    if periodo:
+        return periodo.get('Ejercicio'), periodo.get('Periodo')
+    periodo = filtro.get('PeriodoImputacion') or {}
+    return periodo.get('EjercicioImputacion'), periodo.get('PeriodoImputacion')
+
+
+def get_query_key(operation_name, msg_header, filtro):
+    """Returns the cache key of a query, prefixed by its period tag."""
+    titular_nif = get_titular_nif(msg_header)
+    ejercicio, periodo = get_filter_period(filtro)
+    query = json.dumps(
+        [operation_name, normalize(titular_nif), normalize(filtro)],
+        sort_keys=True
+    )
+    return '{}-{}'.format(
+        get_period_tag(titular_nif, ejercicio, periodo),
+        sha1(query.encode('utf-8')).hexdigest()
+    )
+
+
+class QueryCache(ABC):
+    """Base class of the ConsultaLR response caches.
+
+    Subclasses store the bytes of the responses with get, set, delete_prefix
+    and clear.
+
+    :param ttl: seconds a response is valid
+    :param max_size: maximum bytes of the stored responses
+    :param clock: function returning the current time in seconds
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE,
+                 clock=time.time):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+
+    def lookup(self, operation_name, msg_header, filtro):
+        """Returns the cached response of a query, None when missing."""
+        return self.get(get_query_key(operation_name, msg_header, filtro))
+
+    def store(self, operation_name, msg_header, filtro, content):
+        """Caches the response of a query."""
+        if len(content) > self.max_size:
+            return
+        self.set(
+            get_query_key(operation_name, msg_header, filtro), content,
+            self.clock() + self.ttl
+        )
+
+    def invalidate(self, titular_nif, ejercicio, periodo):
+        """Drops every cached query of a period of a Titular."""
+        self.delete_prefix(get_period_tag(titular_nif, ejercicio, periodo))
+
+    def invalidate_registros(self, msg_header, registros):
+        """Drops the cached queries of the periods of submitted registros."""
+        if isinstance(registros, dict):
+            registros = [registros]
+        titular_nif = get_titular_nif(msg_header)
+        periodos = set()
+        for registro in registros:
+            periodo = registro.get('PeriodoLiquidacion') or {}
+            periodos.add((periodo.get('Ejercicio'), periodo.get('Periodo')))
+        for ejercicio, periodo in periodos:
+            self.invalidate(titular_nif, ejercicio, periodo)
+
+    @abstractmethod
+    def get(self, key):
+        """Returns the content stored with key, None when missing."""
+
+    @abstractmethod
+    def set(self, key, content, expires):
+        """Stores the content of key until the expires time."""
+
+    @abstractmethod
+    def delete_prefix(self, prefix):
+        """Drops every entry whose key starts with prefix."""
+
+    @abstractmethod
+    def clear(self):
+        """Drops every entry."""
+
+
+class MemoryQueryCache(QueryCache):
+    """In-process LRU cache of ConsultaLR responses."""
+
+    def __init__(self, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE,
+                 clock=time.time):
+        super(MemoryQueryCache, self).__init__(ttl, max_size, clock)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, content = entry
+            if expires <= self.clock():
+                self.size -= len(content)
+                return None
+            self.entries[key] = entry
+            return content
+
+    def set(self, key, content, expires):
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (expires, content)
+            self.size += len(content)
+            while self.size > self.max_size:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def delete_prefix(self, prefix):
+        with self.lock:
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def get_default_cache_dir():
+    """Returns the directory of the DiskQueryCache, it can be set with the
+    SII_QUERY_CACHE_DIR environment variable, by default it is the query
+    directory of the user cache.
+    """
+    return os.environ.get('SII_QUERY_CACHE_DIR') or get_user_cache_dir('query')
+
+
+class DiskQueryCache(QueryCache):
+    """LRU cache of ConsultaLR responses stored as files, shared by every
+    process using the same directory.
+
+    Every file starts with the expiration time of the response and its
+    modification time is set to the clock when it is read, to evict the
+    least recently used files first. Nothing is read or stored unless
+    cache_dir is owned by the current user and no one else can access it.
+    """
+
+    def __init__(self, cache_dir=None, ttl=DEFAULT_TTL,
+                 max_size=DEFAULT_MAX_SIZE, clock=time.time):
+        super(DiskQueryCache, self).__init__(ttl, max_size, clock)
+        self.cache_dir = cache_dir or get_default_cache_dir()
+        self.lock = Lock()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def is_private(self):
+        try:
+            return ensure_private_dir(self.cache_dir)
+        except (IOError, OSError):
+            return False
+
+    def get(self, key):
+        if not self.is_private():
+            return None
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires = float(f.readline())
+                content = f.read()
+            now = self.clock()
+            if expires <= now:
+                os.remove(path)
+                return None
+            os.utime(path, (now, now))
+        except (IOError, OSError, ValueError):
+            return None
+        return content
+
+    def set(self, key, content, expires):
+        if not self.is_private():
+            return
+        try:
+            tmp_fd, tmp_path = tempfile.mkstemp(
+                dir=self.cache_dir, prefix='.'
+            )
+            with os.fdopen(tmp_fd, 'wb') as f:
+                f.write('{!r}\n'.format(expires).encode('ascii'))
+                f.write(content)
+            now = self.clock()
+            os.utime(tmp_path, (now, now))
+            os.rename(tmp_path, self.get_path(key))
+            self.evict()
+        except (IOError, OSError):
+            pass
+
+    def list_files(self):
+        """Returns the (mtime, size, path) of the cached responses."""
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.'):
+                continue
+            path = self.get_path(name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self):
+        with self.lock:
+            files = sorted(self.list_files())
+            size = sum(file_size for _, file_size, _ in files)
+            for _, file_size, path in files:
+                if size <= self.max_size:
+                    break
+                self.remove(path)
+                size -= file_size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def delete_prefix(self, prefix):
+        if not os.path.isdir(self.cache_dir):
+            return
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix):
+                self.remove(self.get_path(name))
+
+    def clear(self):
+        self.delete_prefix('')
@@ -0,0 +1,133 @@
+# -*- coding: UTF-8 -*-
+"""Reconciliation of the ERP invoices with the registros of the SII books.
+
+The registros (sii.consulta.ConsultaRecord, from sii.mirror.SiiMirror or
+sii.server.ConsultaService) are indexed once by their IDFactura key and
+every invoice is looked up in that index, so a period is reconciled in a
+single pass over the invoices and the registros.
+"""
+
+from decimal import Decimal
+
+from sii.consulta import ESTADO_ANULADA
+from sii.resource import SII
+from sii.response import get_factura_key
+
+MATCHED = 'matched'
+MISSING = 'missing'
+DIFFERING = 'differing'
+EXTRA = 'extra'
+ERROR = 'error'
+STATUSES = (MATCHED, MISSING, DIFFERING, EXTRA, ERROR)
+
+CENTS = Decimal('0.01')
+CUOTAS = ('CuotaRepercutida', 'CuotaSoportada')
+
+
+def get_registro(invoice):
+    """Returns the RegistroLRFacturas* that SII(invoice) generates."""
+    suministro = list(SII(invoice).generate_object().values())[0]
+    for name, value in suministro.items():
+        if name.startswith('RegistroLR'):
+            return value
+
+
+def to_amount(value):
+    """Normalizes an amount (float, Decimal or text) to a string with cents,
+    None for missing amounts.
+    """
+    if value is None or value == '':
+        return None
+    return str(Decimal(str(value)).quantize(CENTS))
+
+
+def iter_detalle_iva(value):
+    """Yields every DetalleIVA of a registro, whatever its desglose."""
+    if isinstance(value, dict):
+        for name, item in value.items():
+            if name == 'DetalleIVA':
+                for detalle in (item if isinstance(item, list) else [item]):
+                    yield detalle
+            else:
+                for detalle in iter_detalle_iva(item):
+                    yield detalle
+    elif isinstance(value, list):
+        for item in value:
+            for detalle in iter_detalle_iva(item):
+                yield detalle
+
+
+def get_detalle_iva_key(detalles):
+    """Returns the comparable key of (TipoImpositivo, BaseImponible, Cuota)
+    tuples, ignoring their order.
+    """
+    return tuple(sorted(
+        tuple(to_amount(value) or '' for value in detalle)
+        for detalle in detalles
+    ))
+
+
+def get_registro_detalle_iva(registro):
+    detalles = []
+    for detalle in iter_detalle_iva(registro):
+        cuota = None
+        for name in CUOTAS:
+            if name in detalle:
+                cuota = detalle[name]
+        detalles.append((
+            detalle.get('TipoImpositivo'), detalle.get('BaseImponible'), cuota
+        ))
+    return detalles
+
+
+def get_differences(registro, record):
+    """Returns the names of the fields of a registro that differ from the
+    ConsultaRecord of the books.
+    """
+    datos = registro.get('FacturaExpedida') or registro.get('FacturaRecibida')
+    differences = []
+    if to_amount(datos.get('ImporteTotal')) != to_amount(record.importe_total):
+        differences.append('ImporteTotal')
+    registro_detalle = get_detalle_iva_key(get_registro_detalle_iva(datos))
+    if registro_detalle != get_detalle_iva_key(record.detalle_iva):
+        differences.append('DetalleIVA')
+    return differences
+
+
+def reconcile(invoices, records, get_registro=get_registro):
+    """Compares the invoices of the ERP with the registros of the books.
+
+    Anulada registros are handled as if they were not in the books.
+
+    :param invoices: iterable of invoices
+    :param records: iterable of sii.consulta.ConsultaRecord
+    :param get_registro: function returning the RegistroLR of an invoice
+    :return: dict of {status: list} with:
+        - matched: (invoice, record) found with the same amounts
+        - missing: (invoice, registro) not found in the books
+        - differing: (invoice, record, names of the fields that differ)
+        - extra: records of the books without invoice
+        - error: (invoice, exception) that could not be generated
+    """
+    registered = {}
+    for record in records:
+        if record.estado_registro != ESTADO_ANULADA:
+            registered[record.key] = record
+    result = dict((status, []) for status in STATUSES)
+    for invoice in invoices:
+        try:
+            registro = get_registro(invoice)
+        except Exception as error:
+            result[ERROR].append((invoice, error))
+            continue
+        record = registered.pop(get_factura_key(registro['IDFactura']), None)
+        if record is None:
+            result[MISSING].append((invoice, registro))
+            continue
+        differences = get_differences(registro, record)
+        if differences:
+            result[DIFFERING].append((invoice, record, differences))
+        else:
+            result[MATCHED].append((invoice, record))
+    result[EXTRA] = list(registered.values())
+    return result
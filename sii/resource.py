@@ -1,10 +1,14 @@
 # coding=utf-8
 import re
 import warnings
+from collections import OrderedDict
+from contextlib import contextmanager
 from decimal import Decimal, localcontext
+from threading import local
 
 from sii import __SII_VERSION__
 from sii.models import invoices_record, invoices_deregister
+from sii.snapshot import get_record_key, normalize_amounts
 from sii.utils import unidecode_str, VAT, FiscalPartner
 from datetime import date
 
@@ -332,6 +336,66 @@ def get_fecha_operacion_rec(invoice):
         return get_fecha_operacion_rec(invoice.rectifying_id)
 
 
+RECTIFIED_TOTALS = local()
+
+
+@contextmanager
+def rectified_totals_memo():
+    """Memoizes get_rectified_totals by invoice (model, id) inside the block,
+    so an invoice rectified many times in a run is only added up once.
+    """
+    if getattr(RECTIFIED_TOTALS, 'memo', None) is not None:
+        yield
+        return
+    RECTIFIED_TOTALS.memo = {}
+    try:
+        yield
+    finally:
+        RECTIFIED_TOTALS.memo = None
+
+
+def get_detalle_iva_rectificada(invoice):
+    """Returns the DetalleIVA of the desglose of a rectified invoice."""
+    if invoice.type.startswith('in_'):
+        is_import = invoice.sii_in_clave_regimen_especial == '13'
+        desglose, _ = get_desglose_factura_recibida(get_iva_values(
+            invoice, in_invoice=True, is_import=is_import
+        ))
+        detalle_iva = desglose.get('DesgloseIVA', {}).get('DetalleIVA')
+        if not detalle_iva:
+            detalle_iva = desglose.get('InversionSujetoPasivo', {}).get(
+                'DetalleIVA', [])
+        return detalle_iva, 'CuotaSoportada'
+    tipo_desglose = get_factura_emitida_tipo_desglose(invoice)['tipo_desglose']
+    detalle_iva = tipo_desglose.get('DesgloseFactura', {}).get(
+        'Sujeta', {}).get('NoExenta', {}).get(
+        'DesgloseIVA', {}).get('DetalleIVA', [])
+    return detalle_iva, 'CuotaRepercutida'
+
+
+def get_rectified_totals(invoice):
+    """Returns the (BaseRectificada, CuotaRectificada) of a rectified invoice.
+
+    Only the desglose of the invoice is computed, the amounts are added up as
+    the floats of the dumped DetalleIVA.
+    """
+    memo = getattr(RECTIFIED_TOTALS, 'memo', None)
+    key = get_record_key(invoice)
+    if memo is not None and key in memo:
+        return memo[key][1]
+    detalle_iva, cuota_key = get_detalle_iva_rectificada(invoice)
+    base_rectificada = 0
+    cuota_rectificada = 0
+    for iva in detalle_iva:
+        base_rectificada += float(iva['BaseImponible'])
+        cuota_rectificada += float(iva.get(cuota_key, 0))
+    totals = (base_rectificada, cuota_rectificada)
+    if memo is not None:
+        # Keep the invoice so its id() is not reused during the run
+        memo[key] = (invoice, totals)
+    return totals
+
+
 def get_fact_rect_sustitucion_fields(invoice, opcion=False):
     """
 
@@ -383,32 +447,9 @@ def get_fact_rect_sustitucion_fields(invoice, opcion=False):
     }
 
     if opcion == 1:
-        factura_rectificada = invoice.rectifying_id
-        fact_rectificadora_dict = SII(factura_rectificada).generate_object()
-        base_rectificada = 0
-        cuota_rectificada = 0
-
-        in_invoice = factura_rectificada.type.startswith('in_')
-        if in_invoice:
-            factura_rect_dict = fact_rectificadora_dict['SuministroLRFacturasRecibidas'][
-                'RegistroLRFacturasRecibidas']['FacturaRecibida']
-            cuota_key = 'CuotaSoportada'
-            desglosefra = factura_rect_dict.get('DesgloseFactura', {})
-            detalle_iva = desglosefra.get('DesgloseIVA', {}).get('DetalleIVA')
-            if not detalle_iva:
-                detalle_iva = desglosefra.get('InversionSujetoPasivo', {}).get(
-                    'DetalleIVA', [])
-        else:
-            factura_rect_dict = fact_rectificadora_dict['SuministroLRFacturasEmitidas'][
-                'RegistroLRFacturasEmitidas']['FacturaExpedida']
-            cuota_key = 'CuotaRepercutida'
-            detalle_iva = factura_rect_dict.get(
-                    'TipoDesglose', {}).get('DesgloseFactura', {}).get(
-                    'Sujeta', {}).get('NoExenta', {}).get(
-                    'DesgloseIVA', {}).get('DetalleIVA', [])
-        for iva in detalle_iva:
-            base_rectificada += iva['BaseImponible']
-            cuota_rectificada += iva.get(cuota_key, 0)
+        base_rectificada, cuota_rectificada = get_rectified_totals(
+            invoice.rectifying_id
+        )
         rectificativa_fields['ImporteRectificacion'] = {
             'BaseRectificada': base_rectificada,
             'CuotaRectificada': cuota_rectificada
@@ -556,16 +597,11 @@ def get_tipus_factura_emitida(article=None, rectificativa=False):
     return result
 
 
-def get_factura_recibida(invoice, rect_sust_opc1=False, rect_sust_opc2=False):
-    in_invoice = True
-    # Factura correspondiente a una importación (informada sin asociar a un DUA)
-    is_import = invoice.sii_in_clave_regimen_especial == '13'
-    iva_values = get_iva_values(
-        invoice, in_invoice=in_invoice, is_import=is_import
-    )
-
+def get_desglose_factura_recibida(iva_values):
+    """Returns the (DesgloseFactura, CuotaDeducible) of a received invoice
+    from its get_iva_values.
+    """
     cuota_deducible = 0
-    importe_total = get_invoice_sign(invoice) * invoice.amount_total
     desglose_factura = {}
     if iva_values['sujeta_a_iva']:
         detalle_iva = []
@@ -613,6 +649,22 @@ def get_factura_recibida(invoice, rect_sust_opc1=False, rect_sust_opc2=False):
             }
         })
 
+    return desglose_factura, cuota_deducible
+
+
+def get_factura_recibida(invoice, rect_sust_opc1=False, rect_sust_opc2=False):
+    in_invoice = True
+    # Factura correspondiente a una importación (informada sin asociar a un DUA)
+    is_import = invoice.sii_in_clave_regimen_especial == '13'
+    iva_values = get_iva_values(
+        invoice, in_invoice=in_invoice, is_import=is_import
+    )
+
+    importe_total = get_invoice_sign(invoice) * invoice.amount_total
+    desglose_factura, cuota_deducible = get_desglose_factura_recibida(
+        iva_values
+    )
+
     fecha_reg_contable = invoice.date_invoice
 
     # 2.39. ¿Cómo debe suministrarse la información correspondiente al primer
@@ -678,96 +730,179 @@ def get_header(invoice):
     return cabecera
 
 
+def get_registro_factura_emitida(invoice,
+                                 rect_sust_opc1=False, rect_sust_opc2=False):
+    return {
+        'PeriodoLiquidacion': {
+            'Ejercicio': invoice.period_id.name[3:7],
+            'Periodo': invoice.period_id.name[0:2]
+        },
+        'IDFactura': {
+            'IDEmisorFactura': {
+                'NIF': VAT.clean_vat(invoice.company_id.partner_id.vat)
+            },
+            'NumSerieFacturaEmisor': invoice.number,
+            'FechaExpedicionFacturaEmisor': invoice.date_invoice
+        },
+        'FacturaExpedida': get_factura_emitida(
+            invoice, rect_sust_opc1, rect_sust_opc2
+        )
+    }
+
+
 def get_factura_emitida_dict(invoice,
                              rect_sust_opc1=False, rect_sust_opc2=False):
     obj = {
         'SuministroLRFacturasEmitidas': {
             'Cabecera': get_header(invoice),
-            'RegistroLRFacturasEmitidas': {
-                'PeriodoLiquidacion': {
-                    'Ejercicio': invoice.period_id.name[3:7],
-                    'Periodo': invoice.period_id.name[0:2]
-                },
-                'IDFactura': {
-                    'IDEmisorFactura': {
-                        'NIF': VAT.clean_vat(invoice.company_id.partner_id.vat)
-                    },
-                    'NumSerieFacturaEmisor': invoice.number,
-                    'FechaExpedicionFacturaEmisor': invoice.date_invoice
-                },
-                'FacturaExpedida': get_factura_emitida(
-                    invoice, rect_sust_opc1, rect_sust_opc2
-                )
-            }
+            'RegistroLRFacturasEmitidas': get_registro_factura_emitida(
+                invoice, rect_sust_opc1, rect_sust_opc2
+            )
         }
     }
 
     return obj
 
 
-def get_factura_recibida_dict(invoice,
-                              rect_sust_opc1=False, rect_sust_opc2=False):
+def get_registro_factura_recibida(invoice,
+                                  rect_sust_opc1=False, rect_sust_opc2=False):
     fiscal_partner = FiscalPartner(invoice)
     if invoice.period_id and invoice.period_id.name:
         period_name = invoice.period_id.name
     else:
         year, month, date = invoice.date_invoice.split('-')
         period_name = '{}/{}'.format(month, year)
+    return {
+        'PeriodoLiquidacion': {
+            'Ejercicio': period_name[3:7],
+            'Periodo': period_name[0:2]
+        },
+        'IDFactura': {
+            'IDEmisorFactura': get_partner_info(
+                fiscal_partner, in_invoice=True
+            ),
+            'NumSerieFacturaEmisor': invoice.origin,
+            'FechaExpedicionFacturaEmisor': invoice.origin_date_invoice
+        },
+        'FacturaRecibida': get_factura_recibida(
+            invoice, rect_sust_opc1, rect_sust_opc2
+        )
+    }
+
+
+def get_factura_recibida_dict(invoice,
+                              rect_sust_opc1=False, rect_sust_opc2=False):
     obj = {
         'SuministroLRFacturasRecibidas': {
             'Cabecera': get_header(invoice),
-            'RegistroLRFacturasRecibidas': {
-                'PeriodoLiquidacion': {
-                    'Ejercicio': period_name[3:7],
-                    'Periodo': period_name[0:2]
-                },
-                'IDFactura': {
-                    'IDEmisorFactura': get_partner_info(
-                        fiscal_partner, in_invoice=True
-                    ),
-                    'NumSerieFacturaEmisor': invoice.origin,
-                    'FechaExpedicionFacturaEmisor': invoice.origin_date_invoice
-                },
-                'FacturaRecibida': get_factura_recibida(
-                    invoice, rect_sust_opc1, rect_sust_opc2
-                )
-            }
+            'RegistroLRFacturasRecibidas': get_registro_factura_recibida(
+                invoice, rect_sust_opc1, rect_sust_opc2
+            )
         }
     }
 
     return obj
 
 
-def refactor_decimals(invoice):
-    def transform(f):
-        return Decimal(str(f))
+def get_validation_errors_list(errors):
+    error_messages = []
 
-    invoice.amount_total = transform(invoice.amount_total)
-    invoice.amount_untaxed = transform(invoice.amount_untaxed)
+    for key, values in errors.items():
+        if isinstance(values, dict):
+            error_messages += get_validation_errors_list(values)
+        else:
+            error_messages += ['{}: {}'.format(key, val) for val in values]
 
-    for inv_tax in invoice.tax_line:
-        inv_tax.tax_amount = transform(inv_tax.tax_amount)
-        inv_tax.base = transform(inv_tax.base)
-        inv_tax.tax_id.amount = transform(inv_tax.tax_id.amount)
+    return error_messages
 
-    if invoice.rectifying_id:
-        rectified_invoice = invoice.rectifying_id
 
-        rectified_invoice.amount_total = transform(
-            rectified_invoice.amount_total)
-        rectified_invoice.amount_untaxed = transform(
-            rectified_invoice.amount_untaxed)
+def get_book(invoice):
+    if invoice.type.startswith('in'):
+        return 'in'
+    elif invoice.type.startswith('out'):
+        return 'out'
+    raise AttributeError(
+        'Valor desconocido en el tipo de factura: {}'.format(invoice.type)
+    )
 
-        for rect_inv_tax in rectified_invoice.tax_line:
-            rect_inv_tax.tax_amount = transform(rect_inv_tax.tax_amount)
-            rect_inv_tax.base = transform(rect_inv_tax.base)
-            rect_inv_tax.tax_id.amount = transform(rect_inv_tax.tax_id.amount)
+
+def get_batch_key(invoice):
+    """Returns the (company, book, TipoComunicacion) of an invoice, the
+    invoices with the same key share a Cabecera.
+    """
+    partner = invoice.company_id.partner_id
+    return (
+        (partner.vat, partner.name), get_book(invoice),
+        bool(invoice.sii_registered)
+    )
+
+
+BATCH_BOOKS = {
+    'out': (
+        'SuministroLRFacturasEmitidas', 'RegistroLRFacturasEmitidas',
+        get_registro_factura_emitida,
+        invoices_record.SuministroLoteFacturasEmitidas
+    ),
+    'in': (
+        'SuministroLRFacturasRecibidas', 'RegistroLRFacturasRecibidas',
+        get_registro_factura_recibida,
+        invoices_record.SuministroLoteFacturasRecibidas
+    )
+}
+
+
+def get_batch_envelope(book, cabecera, registros):
+    suministro, registro_name, _, _ = BATCH_BOOKS[book]
+    return {suministro: {'Cabecera': cabecera, registro_name: registros}}
+
+
+def generate_batch_group(book, cabecera, invoices, registros):
+    """Validates and dumps the registros of a group in one pass.
+
+    :return: (object, invoices, errors) with the dumped SuministroLR of the
+        valid registros, their invoices and the (invoice, exception) of the
+        invalid ones
+    """
+    suministro, registro_name, _, model = BATCH_BOOKS[book]
+    model = model()
+    errors = model.validate(get_batch_envelope(book, cabecera, registros))
+    errors = errors.get(suministro) or {}
+    registro_errors = errors.pop(registro_name, {})
+    if errors or not isinstance(registro_errors, dict):
+        if not isinstance(registro_errors, dict):
+            errors[registro_name] = registro_errors
+        registro_errors = dict(
+            (position, errors) for position in range(len(invoices))
+        )
+    failed = []
+    valid_invoices = []
+    valid_registros = []
+    for position, invoice in enumerate(invoices):
+        if position in registro_errors:
+            failed.append((invoice, Exception(
+                'Errors were found while trying to validate the data:',
+                get_validation_errors_list(registro_errors[position])
+            )))
+        else:
+            valid_invoices.append(invoice)
+            valid_registros.append(registros[position])
+    if not valid_registros:
+        return None, [], failed
+    res = model.dump(get_batch_envelope(book, cabecera, valid_registros))
+    if res.errors:
+        error = Exception(
+            'Errors were found while trying to generate the dump:',
+            res.errors
+        )
+        return None, [], failed + [
+            (invoice, error) for invoice in valid_invoices
+        ]
+    return res.data, valid_invoices, failed
 
 
 class SII(object):
     def __init__(self, invoice):
-        self.invoice = invoice
-        refactor_decimals(self.invoice)
+        self.invoice = normalize_amounts(invoice)
         tipo_rectificativa = invoice.rectificative_type
         rectificativa_sustitucion_opcion_1 = tipo_rectificativa == 'RA'
         rectificativa_sustitucion_opcion_2 = tipo_rectificativa == 'R'
@@ -792,16 +927,62 @@ class SII(object):
                 )
             )
 
-    def get_validation_errors_list(self, errors):
-        error_messages = []
-
-        for key, values in errors.items():
-            if isinstance(values, dict):
-                error_messages += self.get_validation_errors_list(values)
-            else:
-                error_messages += ['{}: {}'.format(key, val) for val in values]
-
-        return error_messages
+    @staticmethod
+    def get_validation_errors_list(errors):
+        return get_validation_errors_list(errors)
+
+    @staticmethod
+    def generate_objects(invoices, max_registros=None):
+        """Builds the SuministroLR objects of many invoices.
+
+        Invoices are grouped by company, book and TipoComunicacion. The
+        Cabecera of every group is built once and all its registros are
+        validated and dumped together. The amounts of every invoice are
+        normalized once and the totals of the rectified invoices are memoized
+        during the call (see rectified_totals_memo).
+
+        :param invoices: iterable of invoices
+        :param max_registros: maximum number of registros per object
+        :return: (objects, errors). objects is a list of (invoices, object)
+            tuples, object being like the result of generate_object with the
+            list of registros of those invoices. errors is a list of
+            (invoice, exception) tuples with the invoices that could not be
+            built or validated
+        """
+        groups = OrderedDict()
+        errors = []
+        views = {}
+        with rectified_totals_memo():
+            for invoice in invoices:
+                try:
+                    key = get_batch_key(invoice)
+                    get_registro = BATCH_BOOKS[key[1]][2]
+                    registro = get_registro(
+                        normalize_amounts(invoice, views),
+                        rect_sust_opc1=invoice.rectificative_type == 'RA',
+                        rect_sust_opc2=invoice.rectificative_type == 'R'
+                    )
+                    group = groups.get(key)
+                    if group is None:
+                        group = groups[key] = (get_header(invoice), [], [])
+                except Exception as e:
+                    errors.append((invoice, e))
+                    continue
+                group[1].append(invoice)
+                group[2].append(registro)
+
+        objects = []
+        for key, (cabecera, group_invoices, registros) in groups.items():
+            size = max_registros or len(registros)
+            for start in range(0, len(registros), size):
+                obj, obj_invoices, failed = generate_batch_group(
+                    key[1], cabecera, group_invoices[start:start + size],
+                    registros[start:start + size]
+                )
+                if obj is not None:
+                    objects.append((obj_invoices, obj))
+                errors.extend(failed)
+        return objects, errors
 
     def validate_invoice(self):
 
@@ -891,9 +1072,14 @@ def get_baja_factura_emitida_dict(invoice):
 
 
 class SIIDeregister(SII):
+    """Builds the BajaLR of an invoice.
+
+    Only the fields identifying the invoice are read, the registro of the
+    alta and its amounts are never built.
+    """
 
     def __init__(self, invoice):
-        super(SIIDeregister, self).__init__(invoice)
+        self.invoice = invoice
         if invoice.type.startswith('in'):
             self.invoice_deregister_model = (
                 invoices_deregister.BajaFacturasRecibidas()
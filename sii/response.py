@@ -0,0 +1,364 @@
+# -*- coding: UTF-8 -*-
+
+from collections import Counter, namedtuple
+from io import BytesIO
+
+from lxml import etree
+from zeep.exceptions import Fault, TransportError
+from zeep.helpers import serialize_object
+
+from sii.error_codes import (
+    ERROR_CODES, RETRYABLE as RETRYABLE_CATEGORY, get_fault_code
+)
+from sii.throttle import is_transient_error
+
+ACCEPTED = 'accepted'
+ACCEPTED_WITH_ERRORS = 'accepted_with_errors'
+RETRYABLE = 'retryable'
+REJECTED = 'rejected'
+STATUSES = (ACCEPTED, ACCEPTED_WITH_ERRORS, RETRYABLE, REJECTED)
+
+
+def get_factura_key(id_factura):
+    """Returns a hashable key identifying an invoice from its IDFactura block.
+
+    The key is built from the issuer identifier, the invoice number and the
+    issue date, which is what AEAT echoes back in every RespuestaLinea.
+    """
+    emisor = id_factura.get('IDEmisorFactura') or {}
+    emisor_id = emisor.get('NIF')
+    if not emisor_id:
+        emisor_id = (emisor.get('IDOtro') or {}).get('ID')
+    return (
+        emisor_id,
+        id_factura.get('NumSerieFacturaEmisor'),
+        id_factura.get('FechaExpedicionFacturaEmisor')
+    )
+
+
+class ResponseLine(namedtuple('ResponseLine', [
+    'key', 'estado_registro', 'codigo_error', 'descripcion_error', 'csv'
+])):
+    """Compact RespuestaLinea read by parse_response.
+
+    key is the get_factura_key of its IDFactura and codigo_error an int.
+    """
+    __slots__ = ()
+
+
+class ParsedResponse(namedtuple('ParsedResponse', [
+    'estado_envio', 'csv', 'tiempo_espera_envio', 'lines'
+])):
+    """SuministroLR/BajaLR response read by parse_response.
+
+    get returns the items of the serialized response, so it can be used
+    wherever a serialized response is expected.
+    """
+    __slots__ = ()
+
+    ITEMS = {
+        'EstadoEnvio': 'estado_envio',
+        'CSV': 'csv',
+        'TiempoEsperaEnvio': 'tiempo_espera_envio',
+        'RespuestaLinea': 'lines'
+    }
+
+    def get(self, name, default=None):
+        attribute = self.ITEMS.get(name)
+        if attribute is None:
+            return default
+        return getattr(self, attribute)
+
+
+def get_text(element, path):
+    return element.findtext(path) or None
+
+
+def parse_response_line(element):
+    """Builds the ResponseLine of a RespuestaLinea element."""
+    emisor = element.find('{*}IDFactura/{*}IDEmisorFactura')
+    emisor_id = None
+    if emisor is not None:
+        emisor_id = (
+            get_text(emisor, '{*}NIF') or get_text(emisor, '{*}IDOtro/{*}ID')
+        )
+    codigo_error = get_text(element, '{*}CodigoErrorRegistro')
+    return ResponseLine(
+        key=(
+            emisor_id,
+            get_text(element, '{*}IDFactura/{*}NumSerieFacturaEmisor'),
+            get_text(element, '{*}IDFactura/{*}FechaExpedicionFacturaEmisor')
+        ),
+        estado_registro=get_text(element, '{*}EstadoRegistro'),
+        codigo_error=codigo_error and int(codigo_error),
+        descripcion_error=get_text(element, '{*}DescripcionErrorRegistro'),
+        csv=get_text(element, '{*}CSV')
+    )
+
+
+def parse_response(content):
+    """Reads a raw SuministroLR/BajaLR SOAP response with lxml.
+
+    The envelope is parsed incrementally and every RespuestaLinea is freed
+    once it is converted to a ResponseLine, instead of building the zeep
+    object tree and serializing it.
+
+    :param content: bytes of the SOAP response
+    :return: ParsedResponse
+    """
+    envelope = {}
+    lines = []
+    for _, element in etree.iterparse(BytesIO(content), events=('end',)):
+        name = etree.QName(element).localname
+        if name == 'RespuestaLinea':
+            lines.append(parse_response_line(element))
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        elif name in ParsedResponse.ITEMS:
+            parent = etree.QName(element.getparent()).localname
+            if parent != 'RespuestaLinea':
+                envelope[name] = element.text
+    tiempo_espera = envelope.get('TiempoEsperaEnvio')
+    return ParsedResponse(
+        estado_envio=envelope.get('EstadoEnvio'),
+        csv=envelope.get('CSV'),
+        tiempo_espera_envio=tiempo_espera and int(tiempo_espera),
+        lines=lines
+    )
+
+
+def check_raw_response(response):
+    """Raises the Fault or TransportError of a raw SOAP response."""
+    if response.status_code == 200:
+        return
+    try:
+        message = etree.fromstring(response.content).findtext('.//faultstring')
+    except etree.XMLSyntaxError:
+        message = None
+    if message:
+        raise Fault(message)
+    raise TransportError(
+        status_code=response.status_code, content=response.content
+    )
+
+
+def get_line_key(line):
+    """Returns the get_factura_key of a RespuestaLinea or ResponseLine."""
+    if isinstance(line, ResponseLine):
+        return line.key
+    return get_factura_key(line.get('IDFactura') or {})
+
+
+class DuplicatedRegistroError(ValueError):
+    """Raised for the registros whose IDFactura is repeated in an envelope
+    or in its response, their RespuestaLinea can not be told apart.
+    """
+
+
+def map_response_lines(response, registros):
+    """Maps every RespuestaLinea of a response to the registro it answers.
+
+    Lines are matched by the key of their IDFactura only. Registros without
+    line get None and registros with a repeated key a DuplicatedRegistroError.
+
+    :param response: serialized SuministroLR/BajaLR response or
+        ParsedResponse
+    :param registros: list of registros sent in the same envelope
+    :return: list with the RespuestaLinea, None or DuplicatedRegistroError
+        of each registro, in the same order as registros
+    """
+    keys = [get_factura_key(registro['IDFactura']) for registro in registros]
+    duplicated = set(key for key, count in Counter(keys).items() if count > 1)
+    lines_by_key = {}
+    for line in response.get('RespuestaLinea') or []:
+        key = get_line_key(line)
+        if key in lines_by_key:
+            duplicated.add(key)
+        lines_by_key[key] = line
+    res = []
+    for key in keys:
+        if key in duplicated:
+            res.append(DuplicatedRegistroError(
+                'Duplicated IDFactura {} in the envelope'.format(key)
+            ))
+        else:
+            res.append(lines_by_key.get(key))
+    return res
+
+
+class SendResult(object):
+    """Outcome of a registro sent in a SuministroLR/BajaLR envelope.
+
+    The response of the envelope is shared by reference by the results of
+    all its registros, pickled results only keep its EstadoEnvio. The items
+    of the serialized outcomes can still be read as result['EstadoRegistro']
+    or result.get('CSV'). Results are equal when their line fields are.
+
+    :param elapsed: seconds the envelope took to be answered
+    :param attempts: number of times the registro was sent
+    """
+    __slots__ = (
+        'estado_registro', 'csv', 'codigo_error', 'descripcion_error',
+        'envelope', 'line', 'elapsed', 'attempts', 'consulta',
+        'tipo_comunicacion', '_estado_envio'
+    )
+    LINE_FIELDS = (
+        'estado_registro', 'csv', 'codigo_error', 'descripcion_error',
+        'consulta', 'tipo_comunicacion'
+    )
+
+    ITEMS = {
+        'EstadoEnvio': 'estado_envio',
+        'CSV': 'csv',
+        'EstadoRegistro': 'estado_registro',
+        'CodigoErrorRegistro': 'codigo_error',
+        'DescripcionErrorRegistro': 'descripcion_error',
+        'RespuestaLinea': 'line',
+        'Consulta': 'consulta',
+        'TipoComunicacion': 'tipo_comunicacion'
+    }
+    OPTIONAL_ITEMS = ('Consulta', 'TipoComunicacion')
+
+    def __init__(self, estado_registro, csv=None, codigo_error=None,
+                 descripcion_error=None, envelope=None, line=None,
+                 elapsed=None, attempts=1, consulta=None,
+                 tipo_comunicacion=None):
+        self.estado_registro = estado_registro
+        self.csv = csv
+        self.codigo_error = codigo_error
+        self.descripcion_error = descripcion_error
+        self.envelope = envelope
+        self.line = line
+        self.elapsed = elapsed
+        self.attempts = attempts
+        self.consulta = consulta
+        self.tipo_comunicacion = tipo_comunicacion
+        self._estado_envio = None
+
+    @property
+    def estado_envio(self):
+        if self.envelope is None:
+            return self._estado_envio
+        return self.envelope.get('EstadoEnvio')
+
+    def keys(self):
+        return [
+            name for name in self.ITEMS
+            if name not in self.OPTIONAL_ITEMS
+            or getattr(self, self.ITEMS[name]) is not None
+        ]
+
+    def __contains__(self, name):
+        return name in self.keys()
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        return getattr(self, self.ITEMS[name])
+
+    def get(self, name, default=None):
+        if name not in self:
+            return default
+        return self[name]
+
+    def __getstate__(self):
+        state = dict(
+            (name, getattr(self, name)) for name in self.__slots__
+            if name != 'envelope'
+        )
+        state['_estado_envio'] = self.estado_envio
+        return state
+
+    def __setstate__(self, state):
+        self.envelope = None
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __eq__(self, other):
+        if not isinstance(other, SendResult):
+            return NotImplemented
+        return all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.LINE_FIELDS
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<SendResult {} {} {}>'.format(
+            self.estado_registro, self.codigo_error, self.csv
+        )
+
+
+def get_registro_outcome(response, line):
+    """Builds the outcome of a single registro of a multi-registro envelope.
+
+    :param response: serialized SuministroLR/BajaLR response or
+        ParsedResponse
+    :param line: RespuestaLinea or ResponseLine of the registro (may be None)
+    :return: SendResult with the envelope state and the registro state
+    """
+    if isinstance(line, ResponseLine):
+        return SendResult(
+            line.estado_registro, response.get('CSV'), line.codigo_error,
+            line.descripcion_error, envelope=response, line=line
+        )
+    line = line or {}
+    return SendResult(
+        line.get('EstadoRegistro'), response.get('CSV'),
+        line.get('CodigoErrorRegistro'), line.get('DescripcionErrorRegistro'),
+        envelope=response, line=line or None
+    )
+
+
+def serialize_response(response):
+    """Returns a ParsedResponse as is and serializes zeep responses."""
+    if isinstance(response, ParsedResponse):
+        return response
+    return serialize_object(response)
+
+
+def get_batch_outcomes(response, registros):
+    """Returns the outcome of every registro sent in an envelope, or the
+    DuplicatedRegistroError of the registros that can not be matched.
+    """
+    response = serialize_response(response)
+    return [
+        line if isinstance(line, DuplicatedRegistroError)
+        else get_registro_outcome(response, line)
+        for line in map_response_lines(response, registros)
+    ]
+
+
+def classify_outcome(outcome, catalogue=ERROR_CODES):
+    """Returns the status of a registro from its outcome.
+
+    :param outcome: SendResult built by get_registro_outcome, a dict with
+        the same items or the exception raised while building or sending the
+        registro
+    :param catalogue: sii.error_codes.ErrorCatalogue of the error codes
+    :return: ACCEPTED, ACCEPTED_WITH_ERRORS, RETRYABLE or REJECTED
+    """
+    if isinstance(outcome, Fault):
+        code = get_fault_code(outcome)
+        if catalogue.get_category(code) == RETRYABLE_CATEGORY:
+            return RETRYABLE
+        return REJECTED
+    if isinstance(outcome, Exception):
+        return RETRYABLE if is_transient_error(outcome) else REJECTED
+    estado = outcome.get('EstadoRegistro')
+    if estado == 'Correcto':
+        return ACCEPTED
+    if estado == 'AceptadoConErrores':
+        return ACCEPTED_WITH_ERRORS
+    if estado == 'Incorrecto':
+        code = outcome.get('CodigoErrorRegistro')
+        if catalogue.get_category(code) == RETRYABLE_CATEGORY:
+            return RETRYABLE
+        return REJECTED
+    # The envelope was answered without a line for the registro
+    return RETRYABLE
@@ -1,14 +1,51 @@
 # -*- coding: UTF-8 -*-
 
-from sii.resource import SII, SIIDeregister
-from zeep import Client
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from sii import __SII_VERSION__
+from sii.clients import CLIENT_CACHE
+from sii.consulta import (
+    CONSULTA_OPERATIONS, ESTADO_ANULADA, ESTADOS_ALTA, AgrupadasClientePage,
+    ConsultaPage, InformadasClientePage, get_clave_paginacion,
+    get_clave_paginacion_cliente, get_consulta_filter, get_consulta_header,
+    get_consulta_outcome, get_periodo_key, iter_consulta
+)
+from sii.error_codes import ERROR_CODES, NEEDS_A1
+from sii.resource import BATCH_BOOKS, SII, SIIDeregister
+from sii.response import (
+    RETRYABLE, STATUSES, SendResult, check_raw_response, classify_outcome,
+    get_batch_outcomes, get_factura_key, parse_response, serialize_response
+)
+from sii.throttle import is_transient_error
 from requests import Session
+from datetime import date
+from functools import partial
+from itertools import islice
+from zeep import Client
 from zeep.exceptions import Fault
 from zeep.transports import Transport
 from zeep.helpers import serialize_object
+from threading import Event
 import certifi
+import os
+import time
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+try:
+    from queue import Full, Queue
+except ImportError:
+    from Queue import Full, Queue
 
 MAX_ID_CHECKS = 9999
+MAX_REGISTROS = 10000
+MAX_WORKERS = 10
+MAX_RETRIES = 3
+QUEUE_TIMEOUT = 0.1
 
 
 def chunks(l, n):
@@ -17,17 +54,450 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
+def get_wsdl_path(filename, wsdl_dir=None):
+    """Returns the file:// url of a local WSDL, by default one of sii/data/wsdl.
+    """
+    if wsdl_dir is None:
+        wsdl_dir = os.path.join(os.path.dirname(__file__), 'data', 'wsdl')
+    wsdl_path = os.path.join(wsdl_dir, filename)
+    if not os.path.exists(wsdl_path):
+        raise IOError('WSDL file not found: {}'.format(wsdl_path))
+    return 'file://{}'.format(os.path.abspath(wsdl_path))
+
+
+def get_book(invoice):
+    """Returns 'out' for emitted invoices and 'in' for received ones."""
+    return 'out' if invoice.type.startswith('out_') else 'in'
+
+
+def get_header_key(header):
+    """Returns a hashable key of a Cabecera to group registros by it."""
+    titular = header.get('Titular') or {}
+    return (
+        header.get('IDVersionSii'),
+        titular.get('NIF'),
+        titular.get('NombreRazon'),
+        header.get('TipoComunicacion')
+    )
+
+
+def get_envelopes(invoices, get_msg, max_registros=MAX_REGISTROS):
+    """Groups invoices by book and Cabecera in multi-registro envelopes.
+
+    :param invoices: list of invoices
+    :param get_msg: callable returning the (Cabecera, registro) of an invoice
+    :param max_registros: maximum number of registros per envelope
+    :return: tuple with the list of results, holding the exception raised
+        while building the invoices that could not be built, and the list of
+        envelopes as (invoice, Cabecera, [(position, registro), ...]) tuples
+    """
+    results = [None] * len(invoices)
+    groups = OrderedDict()
+    for position, invoice in enumerate(invoices):
+        try:
+            msg_header, msg_invoice = get_msg(invoice)
+        except Exception as e:
+            results[position] = e
+            continue
+        key = (get_book(invoice), get_header_key(msg_header))
+        group = groups.setdefault(key, {
+            'invoice': invoice, 'header': msg_header, 'registros': []
+        })
+        group['registros'].append((position, msg_invoice))
+
+    envelopes = []
+    for group in groups.values():
+        for chunk in chunks(group['registros'], max_registros):
+            envelopes.append((group['invoice'], group['header'], chunk))
+    return results, envelopes
+
+
+def get_object_envelopes(invoices, max_registros=MAX_REGISTROS):
+    """Version of get_envelopes building the SuministroLR registros of all
+    the invoices together with SII.generate_objects.
+    """
+    results = [None] * len(invoices)
+    positions = {}
+    for position, invoice in enumerate(invoices):
+        positions.setdefault(id(invoice), []).append(position)
+
+    def pop_position(invoice):
+        return positions[id(invoice)].pop(0)
+
+    objects, errors = SII.generate_objects(invoices, max_registros)
+    for invoice, error in errors:
+        results[pop_position(invoice)] = error
+    envelopes = []
+    for obj_invoices, obj in objects:
+        suministro, registro_name = BATCH_BOOKS[get_book(obj_invoices[0])][:2]
+        registros = obj[suministro][registro_name]
+        envelopes.append((
+            obj_invoices[0], obj[suministro]['Cabecera'], [
+                (pop_position(invoice), registro)
+                for invoice, registro in zip(obj_invoices, registros)
+            ]
+        ))
+    return results, envelopes
+
+
+def send_batch(invoices, get_msg, get_operation, max_registros=MAX_REGISTROS,
+               build_envelopes=None):
+    """Sends invoices grouped by book and Cabecera in multi-registro envelopes.
+
+    :param invoices: list of invoices
+    :param get_msg: callable returning the (Cabecera, registro) of an invoice
+    :param get_operation: callable returning, for an invoice, the callable
+        that sends a Cabecera and a list of registros and returns the outcome
+        of every registro
+    :param max_registros: maximum number of registros per envelope
+    :param build_envelopes: callable returning the (results, envelopes) of
+        (invoices, max_registros) as get_envelopes, by default get_envelopes
+        with get_msg
+    :return: list of (invoice, outcome) tuples in the same order as invoices.
+        The outcome is the exception raised while building or sending the
+        invoice when it could not be sent
+    """
+    if build_envelopes is None:
+        results, envelopes = get_envelopes(invoices, get_msg, max_registros)
+    else:
+        results, envelopes = build_envelopes(invoices, max_registros)
+    for invoice, msg_header, chunk in envelopes:
+        operation = get_operation(invoice)
+        registros = [registro for _, registro in chunk]
+        start = time.time()
+        try:
+            outcomes = operation(msg_header, registros)
+        except Exception as fault:
+            outcomes = [fault] * len(chunk)
+        set_elapsed(outcomes, time.time() - start)
+        for (position, _), outcome in zip(chunk, outcomes):
+            results[position] = outcome
+    return list(zip(invoices, results))
+
+
+def send_registro(operation, msg_header, registro):
+    """Sends a single registro in its own envelope.
+
+    :param operation: callable sending a Cabecera and a list of registros
+        and returning the outcome of every registro, as the ones returned by
+        get_operation in send_batch
+    :return: outcome of the registro, the errors of the submission are raised
+    """
+    start = time.time()
+    outcomes = operation(msg_header, [registro])
+    set_elapsed(outcomes, time.time() - start)
+    return outcomes[0]
+
+
+def set_elapsed(outcomes, elapsed):
+    """Sets the time an envelope took on the SendResult of its registros."""
+    for outcome in outcomes:
+        if isinstance(outcome, SendResult):
+            outcome.elapsed = elapsed
+
+
+def needs_a1(msg_header, outcome, catalogue=ERROR_CODES):
+    """Returns True when an A0 registro was rejected because the invoice is
+    already registered, so it has to be sent as A1.
+    """
+    if not isinstance(outcome, (SendResult, dict)):
+        return False
+    if msg_header.get('TipoComunicacion') != 'A0':
+        return False
+    code = outcome.get('CodigoErrorRegistro')
+    return catalogue.get_category(code) == NEEDS_A1
+
+
+class A1Resend(object):
+    """Keeps the messages of the first submission of send_batch_with_a1 to
+    resend the A0 registros rejected as duplicated as A1.
+    """
+
+    def __init__(self, get_msg, catalogue=ERROR_CODES, build_envelopes=None):
+        self.get_msg = get_msg
+        self.catalogue = catalogue
+        self.build_envelopes = build_envelopes
+        self.messages = {}
+
+    def get_first_msg(self, invoice):
+        self.messages[id(invoice)] = self.get_msg(invoice)
+        return self.messages[id(invoice)]
+
+    def get_first_envelopes(self, invoices, max_registros):
+        """Builds the envelopes of the first submission keeping the message
+        of every invoice.
+        """
+        if self.build_envelopes is None:
+            return get_envelopes(invoices, self.get_first_msg, max_registros)
+        results, envelopes = self.build_envelopes(invoices, max_registros)
+        for _, msg_header, chunk in envelopes:
+            for position, registro in chunk:
+                self.messages[id(invoices[position])] = msg_header, registro
+        return results, envelopes
+
+    def get_a1_msg(self, invoice):
+        msg_header, msg_invoice = self.messages[id(invoice)]
+        return dict(msg_header, TipoComunicacion='A1'), msg_invoice
+
+    def get_positions(self, results):
+        """Returns the positions of the results to resend as A1."""
+        return [
+            position for position, (invoice, outcome) in enumerate(results)
+            if id(invoice) in self.messages
+            and needs_a1(self.messages[id(invoice)][0], outcome,
+                         self.catalogue)
+        ]
+
+    def set_outcomes(self, results, positions, resent):
+        """Replaces the results of positions by the resent ones."""
+        for position, (invoice, outcome) in zip(positions, resent):
+            if isinstance(outcome, SendResult):
+                outcome.tipo_comunicacion = 'A1'
+                outcome.attempts += 1
+            elif isinstance(outcome, dict):
+                outcome['TipoComunicacion'] = 'A1'
+            results[position] = (invoice, outcome)
+        return results
+
+
+def send_batch_with_a1(invoices, get_msg, get_operation,
+                       max_registros=MAX_REGISTROS, catalogue=ERROR_CODES,
+                       build_envelopes=None):
+    """Sends invoices in batches resending the duplicated A0 ones as A1.
+
+    Registros sent as A0 (alta) and rejected as already registered, usually
+    because the sii_registered flag of the invoice was stale, are collected
+    and resent together as A1 (modificación) in shared envelopes, reusing the
+    messages built for the first submission. Their outcome gets a
+    'TipoComunicacion': 'A1' item and counts both attempts, so callers can
+    fix the flag.
+
+    See send_batch for the parameters and the returned list.
+    """
+    resend = A1Resend(get_msg, catalogue, build_envelopes)
+    results = send_batch(
+        invoices, get_msg, get_operation, max_registros,
+        resend.get_first_envelopes
+    )
+    positions = resend.get_positions(results)
+    if not positions:
+        return results
+    resent = send_batch(
+        [results[position][0] for position in positions], resend.get_a1_msg,
+        get_operation, max_registros
+    )
+    return resend.set_outcomes(results, positions, resent)
+
+
+def is_in_doubt(outcome):
+    """Returns True when the submission of a registro failed without an
+    answer (timeouts, connection errors, HTTP 5xx), so the SII may or may not
+    have stored it.
+    """
+    return isinstance(outcome, Exception) and is_transient_error(outcome)
+
+
+def send_with_retries(send_batch, invoices, max_retries=MAX_RETRIES,
+                      catalogue=ERROR_CODES, recover=None):
+    """Sends invoices in batches resubmitting only the retryable registros.
+
+    Every round sends the invoices whose registro was rejected with a
+    technical error (see sii.response.classify_outcome) in new batches, the
+    accepted and permanently rejected ones are never sent again.
+
+    :param send_batch: callable sending a list of invoices and returning the
+        list of (invoice, outcome) tuples
+    :param invoices: list of invoices
+    :param max_retries: maximum number of resubmissions
+    :param catalogue: sii.error_codes.ErrorCatalogue of the error codes
+    :param recover: callable like send_batch used instead of it for the
+        invoices in doubt (see is_in_doubt), usually SiiService.recover
+    :return: dict of {status: [(invoice, outcome), ...]} with every status of
+        sii.response.STATUSES. Invoices still failing after max_retries are
+        left as RETRYABLE with their last outcome
+    """
+    results = OrderedDict((status, []) for status in STATUSES)
+    pending = list(invoices)
+    in_doubt = []
+    for attempt in range(max_retries + 1):
+        round_results = []
+        if pending:
+            round_results.extend(send_batch(pending))
+        if in_doubt:
+            round_results.extend(recover(in_doubt))
+        pending, in_doubt = sort_outcomes(
+            results, round_results, attempt, max_retries, catalogue,
+            recover is not None
+        )
+        if not pending and not in_doubt:
+            break
+    return results
+
+
+def sort_outcomes(results, round_results, attempt, max_retries,
+                  catalogue=ERROR_CODES, recoverable=False):
+    """Files the outcomes of a round of send_with_retries in results.
+
+    :param recoverable: keep apart the invoices in doubt
+    :return: (pending, in_doubt) lists of the invoices to send again and the
+        ones to recover
+    """
+    pending, in_doubt = [], []
+    for invoice, outcome in round_results:
+        if isinstance(outcome, SendResult):
+            outcome.attempts += attempt
+        status = classify_outcome(outcome, catalogue)
+        if status != RETRYABLE or attempt == max_retries:
+            results[status].append((invoice, outcome))
+        elif recoverable and is_in_doubt(outcome):
+            in_doubt.append(invoice)
+        else:
+            pending.append(invoice)
+    return pending, in_doubt
+
+
+def get_future_result(future):
+    """Returns the result of a future or the exception it raised."""
+    try:
+        return future.result()
+    except Exception as e:
+        return e
+
+
+def send_many(send, invoices, max_workers=MAX_WORKERS, ordered=False):
+    """Sends invoices one by one on a thread pool.
+
+    At most max_workers * 2 invoices are submitted and not yielded yet, the
+    next ones are submitted as results are yielded, so memory does not
+    depend on the number of invoices.
+
+    :param send: callable sending one invoice
+    :param invoices: iterable of invoices
+    :param max_workers: number of threads
+    :param ordered: yield the results in the order of invoices instead of as
+        they complete
+    :return: generator of (invoice, result) tuples, where result is the
+        exception raised by send when it failed
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    invoices = iter(invoices)
+    futures = OrderedDict()
+    try:
+        while True:
+            for invoice in islice(invoices, max_workers * 2 - len(futures)):
+                futures[executor.submit(send, invoice)] = invoice
+            if not futures:
+                break
+            if ordered:
+                done = [next(iter(futures))]
+            else:
+                finished = wait(futures, return_when=FIRST_COMPLETED).done
+                done = [future for future in futures if future in finished]
+            for future in done:
+                yield futures.pop(future), get_future_result(future)
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def iter_concurrently(sources, max_workers=MAX_WORKERS,
+                      max_queued=MAX_REGISTROS):
+    """Yields the items of several generators consumed on a thread pool.
+
+    Items are yielded as they are produced, interleaving the sources, and at
+    most max_queued items wait to be consumed, so memory does not depend on
+    the size of the sources.
+
+    :param sources: list of callables returning an iterable
+    :param max_workers: number of threads
+    :param max_queued: maximum number of items produced but not yielded
+    :raises: the first exception raised by a source, after stopping the rest
+    """
+    items = Queue(max_queued)
+    stop = Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=QUEUE_TIMEOUT)
+                return True
+            except Full:
+                pass
+        return False
+
+    def consume(source):
+        try:
+            for item in source():
+                if not put((False, item)):
+                    return
+        except Exception as e:
+            put((True, e))
+        finally:
+            put((True, None))
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = [executor.submit(consume, source) for source in sources]
+    try:
+        pending = len(futures)
+        while pending:
+            done, item = items.get()
+            if not done:
+                yield item
+            elif item is None:
+                pending -= 1
+            else:
+                raise item
+    finally:
+        stop.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
 class Service(object):
-    def __init__(self, certificate, key, url=None):
+    client_class = Client
+
+    def __init__(self, certificate, key, url=None, session_registry=None):
         self.certificate = certificate
         self.key = key
         self.url = url
+        self.session_registry = session_registry
         self.result = []
 
+    def create_transport(self):
+        verify = False if self.url else certifi.where()
+        if self.session_registry is not None:
+            host = urlparse(self.url).netloc if self.url else None
+            session = self.session_registry.get_session(
+                self.certificate, self.key, verify, host
+            )
+        else:
+            session = Session()
+            session.cert = (self.certificate, self.key)
+            session.verify = verify
+        return Transport(session=session)
+
+    def get_client_key(self):
+        """Returns the key identifying this client in the services cache."""
+        return self.certificate, self.key, self.session_registry
+
+    def get_zeep_service(self, wsdl, port_name, service_name,
+                         binding_name=None, address=None):
+        """Returns the zeep service of a port, shared through CLIENT_CACHE."""
+        return CLIENT_CACHE.get_service(
+            self.create_transport, wsdl, port_name, service_name,
+            binding_name=binding_name, address=address,
+            certificate=self.get_client_key(),
+            client_class=self.client_class
+        )
+
 
 class IDService(Service):
-    def __init__(self, certificate, key, url=None):
-        super(IDService, self).__init__(certificate, key, url)
+    def __init__(self, certificate, key, url=None, session_registry=None):
+        super(IDService, self).__init__(
+            certificate, key, url, session_registry
+        )
         self.validator_service = None
 
     def ids_validate(self, partners, max_id_checks=MAX_ID_CHECKS):
@@ -80,18 +550,13 @@ class IDService(Service):
             binding_name = '{http://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/burt/jdit/ws/VNifV2.wsdl}VNifV2SoapBinding'
             service_name = 'VNifV2Service'
             wsdl = self.wsdl_files['ids_validator_v2']
-        session = Session()
-        session.cert = (self.certificate, self.key)
-        session.verify = False if self.url else certifi.where()
-        transport = Transport(session=session)
-
-        client = Client(wsdl=wsdl, port_name=port_name, transport=transport,
-                        service_name=service_name)
-        if not self.url:
-            return client.service
-        address = '{0}{1}'.format(self.url, type_address)
-        service = client.create_service(binding_name, address)
-        return service
+        address = None
+        if self.url:
+            address = '{0}{1}'.format(self.url, type_address)
+        return self.get_zeep_service(
+            wsdl, port_name, service_name, binding_name=binding_name,
+            address=address
+        )
 
     wsdl_files = {
         'ids_validator_v1': 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/burt/jdit/ws/VNifV1.wsdl',
@@ -100,82 +565,341 @@ class IDService(Service):
 
 
 class SiiService(Service):
-    def __init__(self, certificate, key, url=None, test_mode=False):
-        super(SiiService, self).__init__(certificate, key, url)
+    def __init__(self, certificate, key, url=None, test_mode=False,
+                 use_local_wsdl=True, wsdl_dir=None, session_registry=None,
+                 scheduler=None, query_cache=None, raw_responses=False):
+        super(SiiService, self).__init__(
+            certificate, key, url, session_registry
+        )
         self.test_mode = test_mode
+        self.scheduler = scheduler
+        self.query_cache = query_cache
+        self.raw_responses = raw_responses
+        self.use_local_wsdl = use_local_wsdl
+        self.wsdl_dir = wsdl_dir
         self.emitted_service = None
         self.received_service = None
         self.url = url
         self.invoice = None
 
     def send(self, invoice):
+        """Sends an invoice storing it and its result on the service.
+
+        Returns the whole serialized response, use submit to get the
+        SendResult of the registro.
+        """
         self.invoice = invoice
-        if self.invoice.type.startswith('out_'):
+        self.get_service(invoice)
+        return self.send_invoice()
+
+    def submit(self, invoice):
+        """Sends an invoice and returns the sii.response.SendResult of its
+        registro, raising the Fault or transport error of the submission.
+
+        Unlike send, neither the invoice nor the result are stored on the
+        service, so a single service can be shared by many threads.
+        """
+        msg_header, msg_invoice = self.get_msg(invoice)
+        return send_registro(
+            self.get_batch_operation(invoice), msg_header, msg_invoice
+        )
+
+    def get_operation(self, service, name):
+        """Returns a SuministroLR/BajaLR operation of a zeep service.
+
+        With raw_responses the operation reads the raw SOAP response with
+        sii.response.parse_response and returns a ParsedResponse, skipping
+        the zeep object tree and serialize_object.
+        """
+        operation = getattr(service, name)
+        if not self.raw_responses:
+            return operation
+
+        def call_raw(msg_header, msg):
+            with service._client.settings(raw_response=True):
+                response = operation(msg_header, msg)
+            check_raw_response(response)
+            return parse_response(response.content)
+        return call_raw
+
+    def call_submission(self, invoice, operation, msg_header, msg):
+        """Calls a SuministroLR/BajaLR operation and drops the cached queries
+        of the periods of its registros, even when the call fails as the
+        registros may have been stored anyway.
+        """
+        try:
+            return self.call_scheduled(invoice, operation, msg_header, msg)
+        finally:
+            self.invalidate_queries(msg_header, msg)
+
+    def invalidate_queries(self, msg_header, registros):
+        if self.query_cache is not None:
+            self.query_cache.invalidate_registros(msg_header, registros)
+
+    def call_scheduled(self, invoice, operation, msg_header, msg):
+        """Calls a SOAP operation through the scheduler, if any."""
+        if self.scheduler is None:
+            return operation(msg_header, msg)
+        return self.scheduler.call(
+            self.get_scheduler_key(invoice, msg_header),
+            operation, msg_header, msg
+        )
+
+    def get_scheduler_key(self, invoice, msg_header):
+        """Returns the (endpoint, Titular) throttled by the scheduler."""
+        return self.get_book_scheduler_key(get_book(invoice), msg_header)
+
+    def get_book_scheduler_key(self, book, msg_header):
+        endpoint = (self.url, self.test_mode, book)
+        titular = msg_header.get('Titular') or msg_header.get('TitularLRFE')
+        return endpoint, (titular or {}).get('NIF')
+
+    def get_service(self, invoice):
+        return self.get_book_service(get_book(invoice))
+
+    def get_book_service(self, book):
+        """Returns the zeep service of a book ('out' or 'in')."""
+        if book == 'out':
             if self.emitted_service is None:
-                self.emitted_service = self.create_service()
+                self.emitted_service = self.create_service(book=book)
+            return self.emitted_service
         else:
             if self.received_service is None:
-                self.received_service = self.create_service()
-        return self.send_invoice()
+                self.received_service = self.create_service(book=book)
+            return self.received_service
+
+    def send_batch(self, invoices, max_registros=MAX_REGISTROS,
+                   resend_as_a1=False):
+        """Sends many invoices packing up to max_registros per envelope.
+
+        Invoices are grouped by book (emitted/received) and Cabecera, so every
+        SOAP request carries a single Cabecera and its registros.
+
+        :param invoices: list of invoices
+        :param max_registros: maximum number of registros per envelope
+        :param resend_as_a1: resend together as A1 the A0 registros rejected
+            as duplicated, see sii.server.send_batch_with_a1
+        :return: list of (invoice, outcome) tuples in the same order as
+            invoices. The outcome is the sii.response.SendResult built by
+            sii.response.get_registro_outcome or the exception raised while
+            building or sending the invoice
+        """
+        if resend_as_a1:
+            return send_batch_with_a1(
+                invoices, self.get_msg, self.get_batch_operation,
+                max_registros, self.error_catalogue, self.build_envelopes
+            )
+        return send_batch(
+            invoices, self.get_msg, self.get_batch_operation, max_registros,
+            self.build_envelopes
+        )
+
+    def build_envelopes(self, invoices, max_registros=MAX_REGISTROS):
+        """Builds the envelopes of send_batch with SII.generate_objects, see
+        sii.server.get_object_envelopes.
+        """
+        return get_object_envelopes(invoices, max_registros)
+
+    def send_with_retries(self, invoices, max_registros=MAX_REGISTROS,
+                          max_retries=MAX_RETRIES, resend_as_a1=False):
+        """Sends invoices in batches resubmitting only the retryable ones.
+
+        Invoices whose submission timed out are checked with recover instead
+        of being sent blindly again. Use a scheduler to wait between the
+        resubmissions after technical errors. See sii.server.send_with_retries
+        for the returned dict.
+        """
+        since = date.today()
+
+        def send(pending):
+            return self.send_batch(pending, max_registros, resend_as_a1)
+
+        def recover(pending):
+            return self.recover(pending, max_registros, since)
+        return send_with_retries(
+            send, invoices, max_retries, self.error_catalogue, recover
+        )
+
+    def recover(self, invoices, max_registros=MAX_REGISTROS, since=None):
+        """Resends the invoices in doubt that the SII did not store.
+
+        After a timeout the invoices may or may not have been registered.
+        The registros that need it (see needs_consulta) are looked up with a
+        single ConsultaLR per book, Titular and period, following the
+        pagination. The stored ones get their outcome from the books (see
+        sii.consulta.get_consulta_outcome) and only the missing ones are sent
+        again in batches.
+
+        :param invoices: list of invoices
+        :param max_registros: maximum number of registros per envelope
+        :param since: date of the lost submission, narrows the consulta to the
+            registros presented since then
+        :return: list of (invoice, outcome) tuples as send_batch, the outcome
+            is the exception raised by the consulta when it failed
+        """
+        results = [None] * len(invoices)
+        messages = {}
+        groups = OrderedDict()
+        missing = []
+        for position, invoice in enumerate(invoices):
+            try:
+                msg_header, msg_invoice = self.get_msg(invoice)
+            except Exception as e:
+                results[position] = e
+                continue
+            messages[id(invoice)] = msg_header, msg_invoice
+            if self.needs_consulta(msg_header):
+                key = (
+                    get_book(invoice), get_header_key(msg_header),
+                    get_periodo_key(msg_invoice)
+                )
+                groups.setdefault(key, []).append(position)
+            else:
+                missing.append(position)
+
+        for positions in groups.values():
+            invoice = invoices[positions[0]]
+            msg_header, msg_invoice = messages[id(invoice)]
+            try:
+                stored = self.query_registros(
+                    invoice, msg_header,
+                    self.get_consulta_filter(msg_invoice, since)
+                )
+            except Exception as e:
+                for position in positions:
+                    results[position] = e
+                continue
+            for position in positions:
+                registro = messages[id(invoices[position])][1]
+                record = stored.get(get_factura_key(registro['IDFactura']))
+                if record is not None and self.is_stored(record):
+                    results[position] = get_consulta_outcome(record)
+                else:
+                    missing.append(position)
+
+        if missing:
+            missing.sort()
+            resent = send_batch(
+                [invoices[position] for position in missing],
+                lambda invoice: messages[id(invoice)],
+                self.get_batch_operation, max_registros
+            )
+            for position, (_, outcome) in zip(missing, resent):
+                results[position] = outcome
+        return list(zip(invoices, results))
+
+    def query_registros(self, invoice, msg_header, filtro):
+        """Returns the registros of the book of the invoice matching filtro.
+
+        :return: dict of {sii.response.get_factura_key: registro}
+        """
+        book = get_book(invoice)
+        operation = getattr(
+            self.get_service(invoice), self.consulta_operations[book]
+        )
+
+        def query(cabecera, filtro):
+            return self.call_scheduled(invoice, operation, cabecera, filtro)
+        records = iter_consulta(
+            query, book, get_consulta_header(msg_header), filtro
+        )
+        return dict(
+            (get_factura_key(record['IDFactura']), record)
+            for record in records
+        )
+
+    def needs_consulta(self, msg_header):
+        """Only altas (A0) have to be looked up before sending them again,
+        resending a modification (A1) is harmless.
+        """
+        return msg_header.get('TipoComunicacion') == 'A0'
+
+    def get_consulta_filter(self, registro, since=None):
+        return get_consulta_filter(registro, since)
+
+    def is_stored(self, record):
+        """Returns True when a registro of the books holds the submission."""
+        estado = (record.get('EstadoFactura') or {}).get('EstadoRegistro')
+        return estado in ESTADOS_ALTA
+
+    def send_many(self, invoices, max_workers=MAX_WORKERS, ordered=False):
+        """Sends invoices one by one on a thread pool.
 
-    def create_service(self):
-        session = Session()
-        session.cert = (self.certificate, self.key)
-        session.verify = False if self.url else certifi.where()
-        transport = Transport(session=session)
-        if self.invoice.type.startswith('out_'):
+        Every thread uses the reentrant submit, so the zeep services and
+        their HTTP sessions are shared and the outcomes are the SendResult
+        of submit. See sii.server.send_many.
+        """
+        return send_many(self.submit, invoices, max_workers, ordered)
+
+    def get_batch_operation(self, invoice):
+        service = self.get_service(invoice)
+        operation = self.get_operation(
+            service, self.batch_operations[get_book(invoice)]
+        )
+
+        def send_registros(header, registros):
+            res = self.call_submission(
+                invoice, operation, header, registros
+            )
+            return get_batch_outcomes(res, registros)
+        return send_registros
+
+    def create_service(self, invoice=None, book=None):
+        if book is None:
+            book = get_book(invoice or self.invoice)
+        if book == 'out':
             config = self.out_inv_config.copy()
         else:
             config = self.in_inv_config.copy()
+        if self.use_local_wsdl:
+            wsdl = get_wsdl_path(config['wsdl_file'], self.wsdl_dir)
+        else:
+            wsdl = config['wsdl']
         port_name = config['port_name']
         if self.test_mode:
             port_name += 'Pruebas'
 
-        client = Client(wsdl=config['wsdl'], port_name=port_name,
-                        transport=transport, service_name=config['service_name']
-                        )
-        if not self.url:
-            return client.service
-        address = '{0}{1}'.format(self.url, config['type_address'])
-        service = client.create_service(config['binding_name'], address)
-        return service
+        address = None
+        if self.url:
+            address = '{0}{1}'.format(self.url, config['type_address'])
+        return self.get_zeep_service(
+            wsdl, port_name, config['service_name'],
+            binding_name=config['binding_name'], address=address
+        )
 
     def send_invoice(self):
         msg_header, msg_invoice = self.get_msg()
         try:
             if self.invoice.type.startswith('out_'):
-                res = self.emitted_service.SuministroLRFacturasEmitidas(
+                res = self.call_submission(
+                    self.invoice,
+                    self.get_operation(
+                        self.emitted_service, 'SuministroLRFacturasEmitidas'
+                    ),
                     msg_header, msg_invoice)
             elif self.invoice.type.startswith('in_'):
-                res = self.received_service.SuministroLRFacturasRecibidas(
+                res = self.call_submission(
+                    self.invoice,
+                    self.get_operation(
+                        self.received_service, 'SuministroLRFacturasRecibidas'
+                    ),
                     msg_header, msg_invoice)
             self.result = res
-            return serialize_object(self.result)
+            return serialize_response(self.result)
         except Exception as fault:
             self.result = fault
             raise fault
 
-    # def list_invoice(self, invoice):
-    #     msg_header, msg_invoice = self.get_msg(invoice)
-    #     try:
-    #         if invoice.type == 'in_invoice':
-    #             res = self.received_service.ConsultaLRFacturasRecibidas(
-    #                 msg_header, msg_invoice)
-    #             if res['EstadoEnvio'] == 'Correcto':
-    #                 self.result['sii_sent'] = True
-    #             self.result['sii_return'] = res
-    #     except Exception as fault:
-    #         self.result['sii_return'] = fault
-
-    def get_msg(self):
-        dict_from_marsh = SII(self.invoice).generate_object()
+    def get_msg(self, invoice=None):
+        invoice = invoice or self.invoice
+        dict_from_marsh = SII(invoice).generate_object()
         res_header = res_invoices = None
-        if self.invoice.type.startswith('out_'):
+        if invoice.type.startswith('out_'):
             res_header = dict_from_marsh['SuministroLRFacturasEmitidas'][
                 'Cabecera']
             res_invoices = dict_from_marsh['SuministroLRFacturasEmitidas'][
                 'RegistroLRFacturasEmitidas']
-        elif self.invoice.type.startswith('in_'):
+        elif invoice.type.startswith('in_'):
             res_header = dict_from_marsh['SuministroLRFacturasRecibidas'][
                 'Cabecera']
             res_invoices = dict_from_marsh['SuministroLRFacturasRecibidas'][
@@ -183,8 +907,18 @@ class SiiService(Service):
 
         return res_header, res_invoices
 
+    batch_operations = {
+        'out': 'SuministroLRFacturasEmitidas',
+        'in': 'SuministroLRFacturasRecibidas'
+    }
+
+    consulta_operations = CONSULTA_OPERATIONS
+
+    error_catalogue = ERROR_CODES
+
     out_inv_config = {
         'wsdl': 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/ssii_1_1_bis/fact/ws/SuministroFactEmitidas.wsdl',
+        'wsdl_file': 'SuministroFactEmitidas.wsdl',
         'port_name': 'SuministroFactEmitidas',
         'binding_name': '{https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/ssii/fact/ws/SuministroFactEmitidas.wsdl}siiBinding',
         'type_address': '/wlpl/SSII-FACT/ws/fe/SiiFactFEV1SOAP',
@@ -193,6 +927,7 @@ class SiiService(Service):
 
     in_inv_config = {
         'wsdl': 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/ssii_1_1_bis/fact/ws/SuministroFactRecibidas.wsdl',
+        'wsdl_file': 'SuministroFactRecibidas.wsdl',
         'port_name': 'SuministroFactRecibidas',
         'binding_name': '{https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/ssii/fact/ws/SuministroFactRecibidas.wsdl}siiBinding',
         'type_address': '/wlpl/SSII-FACT/ws/fr/SiiFactFRV1SOAP',
@@ -202,12 +937,25 @@ class SiiService(Service):
 
 class SiiDeregisterService(SiiService):
 
-    def get_msg(self):
+    def deregister_batch(self, invoices, max_registros=MAX_REGISTROS):
+        """Deregisters many invoices packing up to max_registros bajas per
+        envelope. See SiiService.send_batch for the returned outcomes.
+        """
+        return self.send_batch(invoices, max_registros)
+
+    def build_envelopes(self, invoices, max_registros=MAX_REGISTROS):
+        """Bajas are built one invoice at a time, generate_objects only
+        builds SuministroLR objects.
+        """
+        return get_envelopes(invoices, self.get_msg, max_registros)
+
+    def get_msg(self, invoice=None):
+        invoice = invoice or self.invoice
         dict_from_marsh = (
-            SIIDeregister(self.invoice).generate_object()
+            SIIDeregister(invoice).generate_object()
         )
         res_header = res_invoice = None
-        if self.invoice.type.startswith('out_'):
+        if invoice.type.startswith('out_'):
             res_header = (
                 dict_from_marsh['BajaLRFacturasEmitidas']['Cabecera']
             )
@@ -215,7 +963,7 @@ class SiiDeregisterService(SiiService):
                 dict_from_marsh['BajaLRFacturasEmitidas']
                 ['RegistroLRBajaExpedidas']
             )
-        elif self.invoice.type.startswith('in_'):
+        elif invoice.type.startswith('in_'):
             res_header = (
                 dict_from_marsh['BajaLRFacturasRecibidas']['Cabecera']
             )
@@ -226,27 +974,185 @@ class SiiDeregisterService(SiiService):
 
         return res_header, res_invoice
 
+    batch_operations = {
+        'out': 'AnulacionLRFacturasEmitidas',
+        'in': 'AnulacionLRFacturasRecibidas'
+    }
+
+    def needs_consulta(self, msg_header):
+        return True
+
+    def get_consulta_filter(self, registro, since=None):
+        # FechaPresentacion is the date of the alta, not of the baja
+        return get_consulta_filter(registro)
+
+    def is_stored(self, record):
+        estado = (record.get('EstadoFactura') or {}).get('EstadoRegistro')
+        return estado == ESTADO_ANULADA
+
     def deregister_invoice(self):
         msg_header, msg_invoice = self.get_msg()
         try:
             if self.invoice.type.startswith('out_'):
-                res = self.emitted_service.AnulacionLRFacturasEmitidas(
+                res = self.call_submission(
+                    self.invoice,
+                    self.get_operation(
+                        self.emitted_service, 'AnulacionLRFacturasEmitidas'
+                    ),
                     msg_header, msg_invoice)
             elif self.invoice.type.startswith('in_'):
-                res = self.received_service.AnulacionLRFacturasRecibidas(
+                res = self.call_submission(
+                    self.invoice,
+                    self.get_operation(
+                        self.received_service, 'AnulacionLRFacturasRecibidas'
+                    ),
                     msg_header, msg_invoice)
             self.result = res
-            return serialize_object(self.result)
+            return serialize_response(self.result)
         except Exception as fault:
             self.result = fault
             raise fault
 
     def send(self, invoice):
+        """Deregisters an invoice storing it and its result on the service.
+
+        Returns the whole serialized response, use submit to get the
+        SendResult of the baja.
+        """
         self.invoice = invoice
-        if self.invoice.type.startswith('out_'):
-            if self.emitted_service is None:
-                self.emitted_service = self.create_service()
-        else:
-            if self.received_service is None:
-                self.received_service = self.create_service()
+        self.get_service(invoice)
         return self.deregister_invoice()
+
+
+class ConsultaService(SiiService):
+    """Streams the registros stored in the SII books.
+
+    Pages are requested with zeep raw_response and parsed incrementally by
+    sii.consulta.ConsultaPage, so only one page of bytes and one registro are
+    held in memory whatever the size of the period. Pages are cached in the
+    query_cache (sii.query_cache) when it is set.
+    """
+
+    def iter_registros(self, book, titular, ejercicio, periodo, filtro=None):
+        """Yields every registro of a period as a ConsultaRecord.
+
+        :param book: 'out' for ConsultaLRFacturasEmitidas, 'in' for
+            ConsultaLRFacturasRecibidas
+        :param titular: dict with the NombreRazon and NIF of the Titular
+        :param ejercicio: year of the period, i.e. '2017'
+        :param periodo: month of the period, i.e. '01', or '0A'
+        :param filtro: extra items of the FiltroConsulta, i.e.
+            FechaPresentacion or Contraparte
+        """
+        msg_header = {'IDVersionSii': __SII_VERSION__, 'Titular': titular}
+        filtro = dict(filtro or {})
+        filtro['PeriodoLiquidacion'] = {
+            'Ejercicio': ejercicio, 'Periodo': periodo
+        }
+        while True:
+            page = ConsultaPage(book, ejercicio, periodo)
+            for record in page.parse(self.get_page(book, msg_header, filtro)):
+                yield record
+            if not page.more or page.last is None:
+                break
+            filtro['ClavePaginacion'] = get_clave_paginacion(page.last)
+
+    def iter_informadas_cliente(self, titular, ejercicio, periodo,
+                                filtro=None):
+        """Yields the invoices issued by the Titular that its customers
+        reported in a PeriodoImputacion, as InformadaClienteRecord.
+
+        :param titular: dict with the NombreRazon and NIF of the Titular
+        :param filtro: extra items of the FiltroConsulta, i.e. Cliente,
+            EstadoCuadre or FechaExpedicion
+        """
+        msg_header = {'IDVersionSii': __SII_VERSION__, 'TitularLRFE': titular}
+        filtro = dict(filtro or {})
+        filtro['PeriodoImputacion'] = {
+            'EjercicioImputacion': ejercicio, 'PeriodoImputacion': periodo
+        }
+        while True:
+            page = InformadasClientePage()
+            content = self.get_page(
+                'out', msg_header, filtro, 'ConsultaLRFactInformadasCliente'
+            )
+            for record in page.parse(content):
+                yield record
+            if not page.more or page.last is None:
+                break
+            filtro['ClavePaginacion'] = get_clave_paginacion_cliente(
+                page.last
+            )
+
+    def iter_agrupadas_cliente(self, titular, ejercicio, periodo,
+                               filtro=None):
+        """Yields the number of invoices reported by every customer in a
+        PeriodoImputacion, as AgrupadaClienteRecord.
+        """
+        msg_header = {'IDVersionSii': __SII_VERSION__, 'TitularLRFE': titular}
+        filtro = dict(filtro or {})
+        filtro['PeriodoImputacion'] = {
+            'EjercicioImputacion': ejercicio, 'PeriodoImputacion': periodo
+        }
+        content = self.get_page(
+            'out', msg_header, filtro,
+            'ConsultaLRFactInformadasAgrupadasCliente'
+        )
+        for record in AgrupadasClientePage().parse(content):
+            yield record
+
+    def iter_informadas_cliente_periodos(self, titular, periodos,
+                                         filtro=None,
+                                         max_workers=MAX_WORKERS):
+        """Yields the invoices reported by the customers in several periods,
+        fetching the periods concurrently.
+
+        :param periodos: list of (EjercicioImputacion, PeriodoImputacion)
+        :return: generator of InformadaClienteRecord, the records of
+            different periods are interleaved
+        """
+        sources = [
+            partial(
+                self.iter_informadas_cliente, titular, ejercicio, periodo,
+                filtro
+            )
+            for ejercicio, periodo in periodos
+        ]
+        return iter_concurrently(sources, max_workers)
+
+    def get_page(self, book, msg_header, filtro, operation_name=None):
+        """Returns the raw SOAP response of a ConsultaLR page, from the
+        query_cache when it is set and holds the page.
+
+        :param operation_name: SOAP operation, the ConsultaLRFacturas* of the
+            book by default
+        :raises Fault: when the SII returns a SOAP fault
+        :raises TransportError: on other HTTP errors
+        """
+        operation_name = operation_name or self.consulta_operations[book]
+        if self.query_cache is not None:
+            content = self.query_cache.lookup(
+                operation_name, msg_header, filtro
+            )
+            if content is not None:
+                return content
+        content = self.fetch_page(book, msg_header, filtro, operation_name)
+        if self.query_cache is not None:
+            self.query_cache.store(operation_name, msg_header, filtro, content)
+        return content
+
+    def fetch_page(self, book, msg_header, filtro, operation_name):
+        service = self.get_book_service(book)
+        operation = getattr(service, operation_name)
+
+        def query(cabecera, filtro):
+            with service._client.settings(raw_response=True):
+                response = operation(cabecera, filtro)
+            check_raw_response(response)
+            return response.content
+        if self.scheduler is None:
+            return query(msg_header, filtro)
+        return self.scheduler.call(
+            self.get_book_scheduler_key(book, msg_header),
+            query, msg_header, filtro
+        )
@@ -0,0 +1,117 @@
+# -*- coding: UTF-8 -*-
+
+from threading import RLock
+import time
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_IDLE = 300
+
+
+class TrackedAdapter(HTTPAdapter):
+    """HTTPAdapter that reports every request it sends to on_send.
+
+    :param on_send: callable called with True before sending a request and
+        with False once it is answered or fails
+    """
+
+    def __init__(self, on_send, **kwargs):
+        self.on_send = on_send
+        super(TrackedAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.on_send(True)
+        try:
+            return super(TrackedAdapter, self).send(request, **kwargs)
+        finally:
+            self.on_send(False)
+
+
+class SessionRegistry(object):
+    """Registry of keep-alive HTTP sessions shared between services.
+
+    Sessions are keyed by (certificate, key, verify, host), so the emitted,
+    received and deregister services of a certificate reuse the same TLS
+    connections. Every request sent by a session is tracked, connections
+    of sessions without requests in flight that have not sent any in
+    max_idle seconds are closed, the session itself is kept and reconnects
+    on its next use.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, max_idle=DEFAULT_MAX_IDLE):
+        """
+        :param pool_size: maximum number of connections kept per host
+        :param max_idle: seconds after which idle connections are closed,
+            None to never close them
+        """
+        self.pool_size = pool_size
+        self.max_idle = max_idle
+        self.sessions = {}
+        self.last_used = {}
+        self.in_flight = {}
+        self.lock = RLock()
+
+    def create_session(self, session_key):
+        certificate, key, verify, _ = session_key
+        session = Session()
+        session.cert = (certificate, key)
+        session.verify = verify
+        adapter = TrackedAdapter(
+            lambda started: self.track(session_key, started),
+            pool_connections=self.pool_size, pool_maxsize=self.pool_size
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get_session(self, certificate, key, verify, host=None):
+        """Returns the shared session of a certificate and host.
+
+        :param certificate: path to the certificate
+        :param key: path to the private key
+        :param verify: verify parameter of requests
+        :param host: host of the endpoint, None for the endpoints declared in
+            the WSDL
+        :return: requests Session
+        """
+        session_key = (certificate, key, verify, host)
+        with self.lock:
+            self.evict_idle()
+            session = self.sessions.get(session_key)
+            if session is None:
+                session = self.create_session(session_key)
+                self.sessions[session_key] = session
+                self.last_used[session_key] = time.time()
+            return session
+
+    def track(self, session_key, started):
+        """Records a request of a session, started or finished."""
+        with self.lock:
+            self.last_used[session_key] = time.time()
+            in_flight = self.in_flight.get(session_key, 0)
+            self.in_flight[session_key] = in_flight + (1 if started else -1)
+            if started:
+                self.evict_idle()
+
+    def evict_idle(self):
+        """Closes the connections of the sessions idle for max_idle seconds.
+        """
+        if self.max_idle is None:
+            return
+        limit = time.time() - self.max_idle
+        with self.lock:
+            for session_key, last_used in list(self.last_used.items()):
+                if last_used < limit and not self.in_flight.get(session_key):
+                    self.sessions[session_key].close()
+                    del self.last_used[session_key]
+
+    def close(self):
+        """Closes every session of the registry."""
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+            self.last_used.clear()
+            self.in_flight.clear()
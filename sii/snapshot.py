@@ -0,0 +1,480 @@
+# -*- coding: UTF-8 -*-
+"""Immutable snapshots of the invoices read by the SII builders.
+
+An InvoiceSnapshot holds only the fields that sii.resource.SII and
+sii.atc.resource.SIIATC read, with the same names as the OpenERP browse
+records, so it can be passed to them instead of the invoice. Related
+records (company, partners, taxes...) are snapshots too and are shared by
+every invoice that points to them. Amounts are stored as Decimal, so the
+builders do not normalize them again.
+
+Snapshots are built from browse records with from_browse, or for many
+invoices at once with SnapshotReader, which reads every model with a single
+read per level instead of loading each relation of each invoice lazily.
+
+Invoices that are not snapshots are normalized with normalize_amounts, which
+returns a read-only view with the amounts as Decimal and leaves the invoice
+untouched.
+"""
+
+from copy import deepcopy
+from decimal import Decimal
+
+from sii.utils import VAT
+
+
+class Snapshot(object):
+    """Base class of the snapshots.
+
+    FIELDS are read as they are, AMOUNTS are converted to Decimal and
+    RELATIONS maps the relational fields to the snapshot class of the
+    related records. The X2MANY relations hold a tuple of snapshots.
+    METHODS maps the fields storing the result of a method of the record to
+    the (method name, keyword arguments) it is called with.
+    """
+    __slots__ = ()
+
+    FIELDS = ()
+    AMOUNTS = ()
+    RELATIONS = {}
+    X2MANY = ()
+    METHODS = {}
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values.get(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(
+            '{} is immutable'.format(self.__class__.__name__)
+        )
+
+    def __delattr__(self, name):
+        raise AttributeError(
+            '{} is immutable'.format(self.__class__.__name__)
+        )
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        return '<{} {}>'.format(
+            self.__class__.__name__, getattr(self, 'id', None)
+        )
+
+
+class CountrySnapshot(Snapshot):
+    FIELDS = ('code', 'is_eu_member')
+    __slots__ = ('id', 'code', 'is_eu_member')
+
+
+class PartnerSnapshot(Snapshot):
+    FIELDS = ('name', 'vat', 'aeat_registered', 'auto_vat_type')
+    RELATIONS = {'country_id': CountrySnapshot}
+    __slots__ = (
+        'id', 'name', 'vat', 'aeat_registered', 'auto_vat_type', 'country_id'
+    )
+
+    @property
+    def country(self):
+        return self.country_id
+
+    def sii_get_vat_type(self):
+        return VAT.sii_get_vat_type(
+            self.vat, self.aeat_registered, self.auto_vat_type
+        )
+
+
+class CompanySnapshot(Snapshot):
+    RELATIONS = {'partner_id': PartnerSnapshot}
+    __slots__ = ('id', 'partner_id')
+
+
+class PeriodSnapshot(Snapshot):
+    FIELDS = ('name', 'date_start')
+    __slots__ = ('id', 'name', 'date_start')
+
+
+class ArticleSnapshot(Snapshot):
+    FIELDS = ('tipo_factura', 'tipo_rectificativa')
+    __slots__ = ('id', 'tipo_factura', 'tipo_rectificativa')
+
+
+class JournalSnapshot(Snapshot):
+    FIELDS = ('name',)
+    RELATIONS = {'article': ArticleSnapshot}
+    __slots__ = ('id', 'name', 'article')
+
+
+class FiscalPositionSnapshot(Snapshot):
+    FIELDS = ('name',)
+    __slots__ = ('id', 'name')
+
+
+class ComunidadAutonomaSnapshot(Snapshot):
+    FIELDS = ('codi', 'name')
+    __slots__ = ('id', 'codi', 'name')
+
+
+class StateSnapshot(Snapshot):
+    RELATIONS = {'comunitat_autonoma': ComunidadAutonomaSnapshot}
+    __slots__ = ('id', 'comunitat_autonoma')
+
+
+class AddressSnapshot(Snapshot):
+    FIELDS = ('ref_catastral',)
+    RELATIONS = {'state_id': StateSnapshot}
+    __slots__ = ('id', 'ref_catastral', 'state_id')
+
+
+class TaxSnapshot(Snapshot):
+    FIELDS = ('name', 'type', 'description')
+    AMOUNTS = ('amount',)
+    __slots__ = ('id', 'name', 'type', 'description', 'amount')
+
+
+class TaxLineSnapshot(Snapshot):
+    FIELDS = ('name',)
+    AMOUNTS = ('base', 'tax_amount')
+    RELATIONS = {'tax_id': TaxSnapshot}
+    __slots__ = ('id', 'name', 'base', 'tax_amount', 'tax_id')
+
+
+class InvoiceSnapshot(Snapshot):
+    """Snapshot of an account.invoice.
+
+    The get_* methods of the ERP invoice used by the builders are called
+    once when snapshotting and return the stored results.
+    """
+    FIELDS = (
+        'type', 'number', 'origin', 'date_invoice', 'origin_date_invoice',
+        'rectificative_type', 'sii_registered', 'sii_description',
+        'sii_in_clave_regimen_especial', 'sii_out_clave_regimen_especial',
+        'sii_atc_sent', 'sii_atc_state', 'fiscal_name', 'fiscal_vat',
+        'issued_by_others'
+    )
+    AMOUNTS = ('amount_total', 'amount_untaxed', 'amount_tax')
+    RELATIONS = {
+        'period_id': PeriodSnapshot,
+        'company_id': CompanySnapshot,
+        'partner_id': PartnerSnapshot,
+        'journal_id': JournalSnapshot,
+        'fiscal_position': FiscalPositionSnapshot,
+        'address_contact_id': AddressSnapshot,
+        'tax_line': TaxLineSnapshot
+    }
+    X2MANY = ('tax_line',)
+    METHODS = {
+        'values_taxes_non_current_tax_rate': (
+            'get_values_taxes_non_current_tax_rate', {}
+        ),
+        'notify_issued_by_others': ('get_notify_issued_by_others', {}),
+        'out_clave_regimen_especial_atc': (
+            'get_clave_regimen_especial_atc', {'is_out_invoice': True}
+        ),
+        'in_clave_regimen_especial_atc': (
+            'get_clave_regimen_especial_atc', {'is_out_invoice': False}
+        )
+    }
+    __slots__ = (
+        'id', 'type', 'number', 'origin', 'date_invoice',
+        'origin_date_invoice', 'rectificative_type', 'sii_registered',
+        'sii_description', 'sii_in_clave_regimen_especial',
+        'sii_out_clave_regimen_especial', 'sii_atc_sent', 'sii_atc_state',
+        'fiscal_name', 'fiscal_vat', 'issued_by_others', 'amount_total',
+        'amount_untaxed', 'amount_tax', 'address_contact_id', 'company_id',
+        'fiscal_position', 'journal_id', 'partner_id', 'period_id',
+        'rectifying_id', 'tax_line', 'values_taxes_non_current_tax_rate',
+        'notify_issued_by_others', 'out_clave_regimen_especial_atc',
+        'in_clave_regimen_especial_atc'
+    )
+
+    def get_values_taxes_non_current_tax_rate(self):
+        # The builders update the registro with it, do not share the dicts
+        return deepcopy(self.values_taxes_non_current_tax_rate)
+
+    def get_notify_issued_by_others(self):
+        return self.notify_issued_by_others
+
+    def get_clave_regimen_especial_atc(self, is_out_invoice=True):
+        if is_out_invoice:
+            return self.out_clave_regimen_especial_atc
+        return self.in_clave_regimen_especial_atc
+
+
+# The rectified invoice is an invoice too
+InvoiceSnapshot.RELATIONS['rectifying_id'] = InvoiceSnapshot
+
+SNAPSHOT_CLASSES = (
+    CountrySnapshot, PartnerSnapshot, CompanySnapshot, PeriodSnapshot,
+    ArticleSnapshot, JournalSnapshot, FiscalPositionSnapshot,
+    ComunidadAutonomaSnapshot, StateSnapshot, AddressSnapshot, TaxSnapshot,
+    TaxLineSnapshot, InvoiceSnapshot
+)
+
+
+def to_amount(value):
+    if value is None or value is False:
+        return value
+    return Decimal(str(value))
+
+
+def get_record_key(record):
+    """Returns the key of a record in the memos of a run: its (model, id)
+    or its id() when it is not stored in the database.
+    """
+    record_id = getattr(record, 'id', None)
+    if record_id is None:
+        return ('object', id(record))
+    return (getattr(record, '_name', None), record_id)
+
+
+class AmountsView(object):
+    """Read-only view of a record with some of its attributes replaced.
+
+    The replaced values are returned by the view and every other attribute
+    (and method) is read from the record, which is never written.
+    """
+    __slots__ = ('_record', '_values')
+
+    def __init__(self, record, values):
+        object.__setattr__(self, '_record', record)
+        object.__setattr__(self, '_values', values)
+
+    def __getattr__(self, name):
+        if name in AmountsView.__slots__:
+            raise AttributeError(name)
+        if name in self._values:
+            return self._values[name]
+        return getattr(self._record, name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('AmountsView is read-only')
+
+    def __delattr__(self, name):
+        raise AttributeError('AmountsView is read-only')
+
+    def __repr__(self):
+        return '<AmountsView {!r}>'.format(self._record)
+
+
+def normalize_amounts(invoice, views=None):
+    """Returns the invoice with the amounts read by the builders as Decimal.
+
+    amount_total, amount_untaxed and the base, tax_amount and tax_id.amount
+    of the tax lines are converted once, for the invoice and the invoices it
+    rectifies, into an AmountsView. Snapshots and views are returned as they
+    are, since their amounts are already normalized.
+
+    :param invoice: invoice to normalize
+    :param views: dict shared between calls to reuse the views of the
+        invoices already normalized, keyed by get_record_key
+    :return: AmountsView of the invoice
+    """
+    if not invoice or isinstance(invoice, (Snapshot, AmountsView)):
+        return invoice
+    if views is None:
+        views = {}
+    key = get_record_key(invoice)
+    if key in views:
+        return views[key][1]
+    tax_line = tuple(
+        AmountsView(inv_tax, {
+            'base': to_amount(inv_tax.base),
+            'tax_amount': to_amount(inv_tax.tax_amount),
+            'tax_id': AmountsView(inv_tax.tax_id, {
+                'amount': to_amount(inv_tax.tax_id.amount)
+            })
+        })
+        for inv_tax in invoice.tax_line
+    )
+    view = AmountsView(invoice, {
+        'amount_total': to_amount(invoice.amount_total),
+        'amount_untaxed': to_amount(invoice.amount_untaxed),
+        'tax_line': tax_line,
+        'rectifying_id': normalize_amounts(invoice.rectifying_id, views)
+    })
+    # Keep the invoice so its id() is not reused while normalizing
+    views[key] = (invoice, view)
+    return view
+
+
+def from_browse(record, snapshot_class=InvoiceSnapshot, snapshots=None):
+    """Snapshots a browse record (or any object with the same attributes).
+
+    :param record: record to snapshot, usually an account.invoice
+    :param snapshot_class: Snapshot class of the record
+    :param snapshots: dict shared between calls to reuse the snapshots of
+        the records already seen
+    :return: snapshot_class instance, None for empty records
+    """
+    if not record:
+        return None
+    if snapshots is None:
+        snapshots = {}
+    record_id = getattr(record, 'id', None)
+    if record_id is None:
+        key = (snapshot_class, 'object', id(record))
+    else:
+        key = (snapshot_class, record_id)
+    if key in snapshots:
+        return snapshots[key][1]
+    values = {'id': record_id}
+    for name in snapshot_class.FIELDS:
+        values[name] = getattr(record, name, None)
+    for name in snapshot_class.AMOUNTS:
+        values[name] = to_amount(getattr(record, name, None))
+    for name, (method_name, kwargs) in snapshot_class.METHODS.items():
+        method = getattr(record, method_name, None)
+        values[name] = method(**kwargs) if method else None
+    for name, related_class in snapshot_class.RELATIONS.items():
+        related = getattr(record, name, None)
+        if name in snapshot_class.X2MANY:
+            values[name] = tuple(
+                from_browse(item, related_class, snapshots)
+                for item in related or []
+            )
+        else:
+            values[name] = from_browse(related, related_class, snapshots)
+    snapshot = snapshot_class(**values)
+    # Keep the record so its id() is not reused while snapshotting
+    snapshots[key] = (record, snapshot)
+    return snapshot
+
+
+class SnapshotReader(object):
+    """Builds the snapshots of many invoices with bulk OpenERP reads.
+
+    Every level of relations is loaded with a single read per model, so the
+    number of reads depends on the depth of the relations and not on the
+    number of invoices. The METHODS of the snapshots are called once per
+    record. The models of the relations are taken from
+    fields_get.
+
+    :param pool: OpenERP pool
+    :param cursor: database cursor
+    :param uid: user id
+    :param context: OpenERP context of the reads
+    """
+
+    def __init__(self, pool, cursor, uid, context=None):
+        self.pool = pool
+        self.cursor = cursor
+        self.uid = uid
+        self.context = context
+        self.relations = {}
+
+    def read(self, model, ids, fields):
+        values = self.pool.get(model).read(
+            self.cursor, self.uid, list(ids), list(fields), self.context
+        )
+        return dict((item['id'], item) for item in values)
+
+    def call(self, model, method_name, record_id, kwargs):
+        """Calls a method of a record as its browse record does, returns
+        None when the model does not have it.
+        """
+        method = getattr(self.pool.get(model), method_name, None)
+        if method is None:
+            return None
+        return method(
+            self.cursor, self.uid, [record_id], context=self.context,
+            **kwargs
+        )
+
+    def get_relation(self, model, field):
+        """Returns the model of a relational field."""
+        key = (model, field)
+        if key not in self.relations:
+            definition = self.pool.get(model).fields_get(
+                self.cursor, self.uid, [field], self.context
+            )
+            self.relations[key] = definition[field]['relation']
+        return self.relations[key]
+
+    def get_snapshots(self, invoice_ids, model='account.invoice'):
+        """Returns the InvoiceSnapshot of every invoice, in the same order.
+
+        :param invoice_ids: list of account.invoice ids
+        """
+        records = {}
+        pending = {(model, InvoiceSnapshot): set(invoice_ids)}
+        while pending:
+            next_pending = {}
+            for (model_name, snapshot_class), ids in pending.items():
+                loaded = records.setdefault(model_name, {})
+                ids = ids - set(loaded)
+                if not ids:
+                    continue
+                fields = (
+                    snapshot_class.FIELDS + snapshot_class.AMOUNTS +
+                    tuple(snapshot_class.RELATIONS)
+                )
+                loaded.update(self.read(model_name, ids, fields))
+                for name, related_class in snapshot_class.RELATIONS.items():
+                    related_model = self.get_relation(model_name, name)
+                    related_ids = next_pending.setdefault(
+                        (related_model, related_class), set()
+                    )
+                    for record_id in ids:
+                        related_ids.update(get_related_ids(
+                            loaded[record_id].get(name),
+                            name in snapshot_class.X2MANY
+                        ))
+            pending = dict(
+                (key, ids) for key, ids in next_pending.items() if ids
+            )
+
+        snapshots = {}
+        return [
+            self.build(
+                records, snapshots, model, InvoiceSnapshot, invoice_id
+            )
+            for invoice_id in invoice_ids
+        ]
+
+    def build(self, records, snapshots, model, snapshot_class, record_id):
+        key = (model, record_id)
+        if key in snapshots:
+            return snapshots[key]
+        values = records[model][record_id]
+        snapshot_values = {'id': record_id}
+        for name in snapshot_class.FIELDS:
+            snapshot_values[name] = values.get(name)
+        for name in snapshot_class.AMOUNTS:
+            snapshot_values[name] = to_amount(values.get(name))
+        for name, (method_name, kwargs) in snapshot_class.METHODS.items():
+            snapshot_values[name] = self.call(
+                model, method_name, record_id, kwargs
+            )
+        for name, related_class in snapshot_class.RELATIONS.items():
+            related_model = self.get_relation(model, name)
+            x2many = name in snapshot_class.X2MANY
+            related = tuple(
+                self.build(
+                    records, snapshots, related_model, related_class,
+                    related_id
+                )
+                for related_id in get_related_ids(values.get(name), x2many)
+            )
+            if x2many:
+                snapshot_values[name] = related
+            else:
+                snapshot_values[name] = related[0] if related else None
+        snapshots[key] = snapshot_class(**snapshot_values)
+        return snapshots[key]
+
+
+def get_related_ids(value, x2many=False):
+    """Returns the ids of a relational value, many2one fields are read as
+    (id, name) or False and x2many ones as lists of ids.
+    """
+    if not value:
+        return []
+    if x2many:
+        return list(value)
+    return [value[0]]
@@ -0,0 +1,175 @@
+# -*- coding: UTF-8 -*-
+"""Throttling of the submissions sent to the SII.
+
+A SendScheduler spaces the submissions of every (endpoint, Titular) with a
+token bucket, waits the TiempoEsperaEnvio returned by the AEAT before the
+next submission and backs off exponentially after HTTP 5xx errors,
+timeouts and Faults with a retryable code, such as 4116 (too many
+submissions).
+"""
+
+from threading import Lock
+import time
+
+from requests.exceptions import ConnectionError, Timeout
+from zeep.exceptions import Fault, TransportError
+
+from sii.error_codes import ERROR_CODES, RETRYABLE, get_fault_code
+
+DEFAULT_RATE = 5
+DEFAULT_BURST = 10
+MIN_BACKOFF = 1
+MAX_BACKOFF = 300
+
+
+def get_wait_time(response):
+    """Returns the TiempoEsperaEnvio of a response, None when it has none."""
+    try:
+        wait_time = response['TiempoEsperaEnvio']
+    except (KeyError, IndexError, TypeError, AttributeError):
+        # sii.response.ParsedResponse
+        wait_time = getattr(response, 'tiempo_espera_envio', None)
+    if wait_time is None:
+        return None
+    return int(wait_time)
+
+
+def is_transient_error(error):
+    """Returns True for the errors worth retrying later: timeouts, connection
+    errors and HTTP 5xx responses.
+    """
+    if isinstance(error, (Timeout, ConnectionError)):
+        return True
+    if isinstance(error, TransportError):
+        return error.status_code >= 500
+    return False
+
+
+def should_back_off(error, catalogue=ERROR_CODES):
+    """Returns True for the transient errors and the Faults whose code is
+    retryable in catalogue.
+    """
+    if isinstance(error, Fault):
+        code = get_fault_code(error)
+        return catalogue.get_category(code) == RETRYABLE
+    return is_transient_error(error)
+
+
+class TokenBucket(object):
+    """Token bucket refilled with rate tokens per second up to capacity.
+
+    Tokens are reserved: when the bucket is empty the balance goes negative
+    and the caller is told how long to wait for its token, so concurrent
+    callers queue up instead of all waking up at once.
+    """
+
+    def __init__(self, rate, capacity, now):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.timestamp = now
+
+    def refill(self, now):
+        elapsed = max(now - self.timestamp, 0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.timestamp = now
+
+    def reserve(self, now):
+        """Takes a token and returns the seconds to wait until it is due."""
+        self.refill(now)
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def block(self, now, seconds):
+        """Empties the bucket so the next token is due in seconds."""
+        self.refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class SendScheduler(object):
+    """Schedules the submissions of every (endpoint, Titular).
+
+    Thread safe, a single scheduler is meant to be shared by every service
+    sending to the same endpoints.
+
+    :param rate: submissions per second allowed per key
+    :param burst: submissions allowed at once after being idle
+    :param min_backoff: seconds to wait after the first transient error
+    :param max_backoff: maximum seconds to wait after transient errors
+    :param catalogue: sii.error_codes.ErrorCatalogue of the Fault codes
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 min_backoff=MIN_BACKOFF, max_backoff=MAX_BACKOFF,
+                 clock=time.time, sleep=time.sleep, catalogue=ERROR_CODES):
+        self.rate = rate
+        self.burst = burst
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.catalogue = catalogue
+        self.buckets = {}
+        self.backoff = {}
+        self.lock = Lock()
+
+    def get_bucket(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst, now)
+            self.buckets[key] = bucket
+        return bucket
+
+    def get_delay(self, key):
+        """Reserves a submission of key and returns the seconds to wait."""
+        with self.lock:
+            now = self.clock()
+            return self.get_bucket(key, now).reserve(now)
+
+    def wait(self, key):
+        delay = self.get_delay(key)
+        if delay > 0:
+            self.sleep(delay)
+
+    def on_response(self, key, response):
+        """Resets the backoff of key and honours the TiempoEsperaEnvio."""
+        wait_time = get_wait_time(response)
+        with self.lock:
+            self.backoff.pop(key, None)
+            if wait_time:
+                now = self.clock()
+                self.get_bucket(key, now).block(now, wait_time)
+
+    def on_error(self, key, error):
+        """Backs off key exponentially after a transient error or a Fault
+        with a retryable code.
+        """
+        if not should_back_off(error, self.catalogue):
+            return
+        with self.lock:
+            backoff = self.backoff.get(key)
+            if backoff is None:
+                backoff = self.min_backoff
+            else:
+                backoff = min(backoff * 2, self.max_backoff)
+            self.backoff[key] = backoff
+            now = self.clock()
+            self.get_bucket(key, now).block(now, backoff)
+
+    def call(self, key, operation, *args):
+        """Calls operation once a submission of key is allowed.
+
+        :param key: (endpoint, Titular) of the submission
+        :param operation: callable sending the submission
+        :return: the response of operation
+        """
+        self.wait(key)
+        try:
+            response = operation(*args)
+        except Exception as error:
+            self.on_error(key, error)
+            raise
+        self.on_response(key, response)
+        return response
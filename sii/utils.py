@@ -1,5 +1,8 @@
 # -*- coding: UTF-8 -*-
 
+import os
+import stat
+
 from unidecode import unidecode
 from stdnum import es
 
@@ -9,6 +12,36 @@ def unidecode_str(s):
         s = s.decode('utf-8')
     return unidecode(s)
 
+
+def get_user_cache_dir(name):
+    """Returns the cache directory `name` of the current user.
+
+    It is placed in XDG_CACHE_HOME, by default ~/.cache/sii/<name>.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache'
+    )
+    return os.path.join(cache_home, 'sii', name)
+
+
+def ensure_private_dir(path):
+    """Creates a directory only accessible by the current user.
+
+    Returns False when the directory already exists and it is a symlink, it
+    is owned by another user or other users can access it, so the files
+    found there must not be trusted.
+    """
+    if not os.path.lexists(path):
+        os.makedirs(path, 0o700)
+    path_stat = os.lstat(path)
+    if not stat.S_ISDIR(path_stat.st_mode):
+        return False
+    if path_stat.st_mode & 0o077:
+        return False
+    getuid = getattr(os, 'getuid', None)
+    return getuid is None or path_stat.st_uid == getuid()
+
+
 class FiscalPartner(object):
     def __init__(self, invoice=None, name=None, vat=None,
                  aeat_registered=None, partner_country=None,
@@ -0,0 +1,228 @@
+# coding=utf-8
+
+from expects import *
+from mamba import *
+from sii.response import ACCEPTED, REJECTED, SendResult
+from sii.throttle import SendScheduler
+from spec.testing_services import FakeClock, FakeSiiOperations, get_invoices
+import sys
+
+# Los servicios asíncronos sólo existen en python 3
+if sys.version_info[0] >= 3:
+    import asyncio
+    import os
+    import shutil
+    import tempfile
+    import httpx
+    from zeep.transports import AsyncTransport
+    from sii.aio import AsyncSiiService, AsyncSiiDeregisterService
+    from sii.atc.aio import AsyncSiiServiceATC, AsyncSiiDeregisterServiceATC
+    from spec.testing_data_atc import DataGeneratorATC
+
+    def run(coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    class FakeAsyncSiiOperations(FakeSiiOperations):
+        """Servicio falso asíncrono que cuenta las peticiones en curso"""
+
+        def __init__(self, rejected=None, transient=None):
+            super(FakeAsyncSiiOperations, self).__init__(rejected, transient)
+            self.in_flight = 0
+            self.max_in_flight = 0
+
+        def respond(self, cabecera, registros):
+            self.calls.append((cabecera, registros))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            future = asyncio.ensure_future(
+                asyncio.sleep(0.01, result=self.response(registros))
+            )
+            future.add_done_callback(self.done)
+            return future
+
+        def done(self, future):
+            self.in_flight -= 1
+
+        SuministroLRFacturasEmitidas = respond
+        SuministroLRFacturasRecibidas = respond
+        AnulacionLRFacturasEmitidas = respond
+        AnulacionLRFacturasRecibidas = respond
+
+    class UncertifiedAsyncSiiService(AsyncSiiService):
+        """Servicio asíncrono con los límites del original sin certificado"""
+
+        def create_transport(self):
+            limits = httpx.Limits(max_connections=self.max_concurrency)
+            return AsyncTransport(client=httpx.AsyncClient(limits=limits))
+
+    def get_max_connections(service):
+        return service.transport.client._transport._pool._max_connections
+
+    with description('El servicio asíncrono'):
+
+        with before.each:
+            self.service = AsyncSiiService(
+                'cert.pem', 'key.pem', max_concurrency=2
+            )
+            self.emitted = FakeAsyncSiiOperations()
+            self.service.emitted_service = self.emitted
+
+        with it('debe enviar una factura'):
+            invoice = get_invoices(1)[0]
+
+            res = run(self.service.send(invoice))
+
+            expect(res).to(be_a(SendResult))
+            expect(res['EstadoEnvio']).to(equal('Correcto'))
+            expect(res['EstadoRegistro']).to(equal('Correcto'))
+            expect(self.emitted.calls).to(have_len(1))
+
+        with it('debe enviar las facturas en lote'):
+            invoices = get_invoices(3)
+            self.emitted.rejected = [invoices[2].number]
+
+            results = run(self.service.send_batch(invoices))
+
+            expect([inv for inv, _ in results]).to(equal(invoices))
+            expect(
+                [outcome['EstadoRegistro'] for _, outcome in results]
+            ).to(equal(['Correcto', 'Correcto', 'Incorrecto']))
+            expect(self.emitted.calls).to(have_len(1))
+
+        with it('no debe superar el máximo de peticiones simultáneas'):
+            invoices = get_invoices(6)
+
+            run(self.service.send_batch(invoices, max_registros=1))
+
+            expect(self.emitted.calls).to(have_len(6))
+            expect(self.emitted.max_in_flight).to(equal(2))
+
+        with it('debe dar de baja las facturas en lote'):
+            service = AsyncSiiDeregisterService('cert.pem', 'key.pem')
+            service.emitted_service = self.emitted
+            invoices = get_invoices(2)
+
+            results = run(service.deregister_batch(invoices))
+
+            cabecera, registros = self.emitted.calls[0]
+            expect(cabecera).not_to(have_key('TipoComunicacion'))
+            expect(registros).to(have_len(2))
+            expect(results).to(have_len(2))
+
+        with it('no debe compartir el cliente entre servicios con otros límites'):
+            invoice = get_invoices(1)[0]
+            few = UncertifiedAsyncSiiService(
+                'cert.pem', 'key.pem', max_concurrency=2
+            )
+            many = UncertifiedAsyncSiiService(
+                'cert.pem', 'key.pem', max_concurrency=50
+            )
+
+            expect(few.get_service(invoice)).not_to(
+                be(many.get_service(invoice))
+            )
+            expect(get_max_connections(few)).to(equal(2))
+            expect(get_max_connections(many)).to(equal(50))
+            run(few.aclose())
+            run(many.aclose())
+
+        with it('debe reenviar sólo los registros con errores técnicos'):
+            invoices = get_invoices(3)
+            self.emitted.rejected = [invoices[0].number]
+            self.emitted.transient = [invoices[1].number]
+
+            results = run(self.service.send_with_retries(invoices))
+
+            expect(self.emitted.calls).to(have_len(2))
+            expect(self.emitted.calls[1][1]).to(have_len(1))
+            expect([inv for inv, _ in results[ACCEPTED]]).to(
+                contain_only(*invoices[1:])
+            )
+            expect([inv for inv, _ in results[REJECTED]]).to(
+                equal(invoices[:1])
+            )
+
+        with it('debe reenviar las duplicadas juntas como A1'):
+            invoices = get_invoices(3)
+            self.emitted.rejected = {invoices[1].number: 3000}
+
+            run(self.service.send_batch(invoices, resend_as_a1=True))
+
+            expect(self.emitted.calls).to(have_len(2))
+            cabecera, registros = self.emitted.calls[1]
+            expect(cabecera['TipoComunicacion']).to(equal('A1'))
+            expect(registros).to(have_len(1))
+
+        with it('debe esperar al scheduler sin bloquear el event loop'):
+            clock = FakeClock()
+            scheduler = SendScheduler(rate=100, burst=1, clock=clock)
+            service = AsyncSiiService(
+                'cert.pem', 'key.pem', scheduler=scheduler
+            )
+            service.emitted_service = self.emitted
+            invoices = get_invoices(2)
+
+            run(service.send_batch(invoices, max_registros=1))
+
+            expect(self.emitted.calls).to(have_len(2))
+            expect(scheduler.buckets).to(have_len(1))
+            expect(clock.sleeps).to(be_empty)
+
+        with it('no debe permitir los envíos síncronos del servicio'):
+            invoices = get_invoices(1)
+
+            expect(lambda: self.service.send_many(invoices)).to(
+                raise_error(TypeError)
+            )
+            expect(lambda: self.service.recover(invoices)).to(
+                raise_error(TypeError)
+            )
+
+    with description('El servei asíncron de l\'ATC en mode dry-run'):
+
+        with before.each:
+            self.temp_dir = tempfile.mkdtemp()
+            self.cert_file = os.path.join(self.temp_dir, 'cert.pem')
+            self.key_file = os.path.join(self.temp_dir, 'key.pem')
+            for path in (self.cert_file, self.key_file):
+                with open(path, 'w') as f:
+                    f.write('DUMMY')
+
+        with after.each:
+            shutil.rmtree(self.temp_dir)
+
+        with it('retorna un SendResult amb la resposta simulada'):
+            service = AsyncSiiServiceATC(
+                self.cert_file, self.key_file, dry_run=True
+            )
+            invoice = DataGeneratorATC().get_out_invoice()
+
+            async def send():
+                try:
+                    return await service.send(invoice)
+                finally:
+                    await service.aclose()
+            result = run(send())
+
+            expect(result).to(be_a(SendResult))
+            expect(result.envelope['dry_run']).to(be_true)
+
+        with it('retorna un SendResult en donar de baixa'):
+            service = AsyncSiiDeregisterServiceATC(
+                self.cert_file, self.key_file, dry_run=True
+            )
+            invoice = DataGeneratorATC().get_in_invoice()
+
+            async def deregister():
+                try:
+                    return await service.deregister(invoice)
+                finally:
+                    await service.aclose()
+            result = run(deregister())
+
+            expect(result).to(be_a(SendResult))
+            expect(result.envelope['dry_run']).to(be_true)
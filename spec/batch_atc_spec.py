@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Test dels enviaments de molts registres per SII ATC
+
+Utilitza els WSDLs locals i el mode dry-run per validar l'XML generat
+sense fer cap petició real.
+"""
+from expects import *
+from mamba import description, context, it, before, after
+import os
+import tempfile
+import shutil
+from lxml import etree
+
+from sii.atc.server import SiiServiceATC, SiiDeregisterServiceATC
+from spec.testing_data_atc import DataGeneratorATC
+
+
+def get_invoices(number, invoice_type='out'):
+    invoices = []
+    for i in range(number):
+        data_gen = DataGeneratorATC()
+        data_gen.invoice_number = 'ATC' + str(i).zfill(5)
+        if invoice_type == 'out':
+            invoices.append(data_gen.get_out_invoice())
+        else:
+            invoices.append(data_gen.get_in_invoice())
+    return invoices
+
+
+def count_elements(xml_file, name):
+    doc = etree.parse(xml_file)
+    return len(doc.xpath('//*[local-name()="{}"]'.format(name)))
+
+
+with description('Enviaments de molts registres per SII ATC') as self:
+
+    with before.each:
+        self.temp_dir = tempfile.mkdtemp(prefix='sii_atc_batch_')
+        self.request_file = os.path.join(self.temp_dir, 'request.xml')
+        self.cert_file = os.path.join(self.temp_dir, 'cert.pem')
+        self.key_file = os.path.join(self.temp_dir, 'key.pem')
+        with open(self.cert_file, 'w') as f:
+            f.write('DUMMY CERT')
+        with open(self.key_file, 'w') as f:
+            f.write('DUMMY KEY')
+
+    with after.each:
+        shutil.rmtree(self.temp_dir)
+
+    with context('send_batch'):
+        with it('envia totes les factures amb una sola Cabecera'):
+            service = SiiServiceATC(
+                certificate=self.cert_file, key=self.key_file,
+                dry_run=True, persist_xml=self.request_file
+            )
+            invoices = get_invoices(3)
+
+            results = service.send_batch(invoices)
+
+            expect(results).to(have_len(3))
+            for invoice, result in results:
+                expect(result.envelope['dry_run']).to(be_true)
+            expect(
+                count_elements(self.request_file, 'Cabecera')
+            ).to(equal(1))
+            expect(
+                count_elements(self.request_file, 'RegistroLRFacturasEmitidas')
+            ).to(equal(3))
+
+        with it('retorna un resultat propi per cada registre'):
+            service = SiiServiceATC(
+                certificate=self.cert_file, key=self.key_file,
+                dry_run=True
+            )
+            invoices = get_invoices(2)
+
+            results = service.send_batch(invoices)
+            results[0][1].attempts += 1
+
+            expect(results[1][1]).not_to(be(results[0][1]))
+            expect(results[1][1].attempts).to(equal(1))
+            expect(results[1][1].envelope).to(be(results[0][1].envelope))
+
+    with context('deregister_batch'):
+        with it('dona de baixa totes les factures en un sol enviament'):
+            service = SiiDeregisterServiceATC(
+                certificate=self.cert_file, key=self.key_file,
+                dry_run=True, persist_xml=self.request_file
+            )
+            invoices = get_invoices(3)
+
+            results = service.deregister_batch(invoices)
+
+            expect([inv for inv, _ in results]).to(equal(invoices))
+            for invoice, result in results:
+                expect(result.envelope['dry_run']).to(be_true)
+            expect(
+                count_elements(self.request_file, 'BajaLRFacturasEmitidas')
+            ).to(equal(1))
+            expect(
+                count_elements(self.request_file, 'RegistroLRBajaExpedidas')
+            ).to(equal(3))
+            expect(
+                count_elements(self.request_file, 'TipoComunicacion')
+            ).to(equal(0))
+
+        with it('dona de baixa una factura amb deregister'):
+            service = SiiDeregisterServiceATC(
+                certificate=self.cert_file, key=self.key_file,
+                dry_run=True, persist_xml=self.request_file
+            )
+
+            result = service.deregister(get_invoices(1, 'in')[0])
+
+            expect(result['dry_run']).to(be_true)
+            expect(
+                count_elements(self.request_file, 'RegistroLRBajaRecibidas')
+            ).to(equal(1))
+
+    with context('submit'):
+        with it('envia sense guardar la factura ni el resultat al servei'):
+            service = SiiServiceATC(
+                certificate=self.cert_file, key=self.key_file, dry_run=True
+            )
+
+            result = service.submit(get_invoices(1)[0])
+
+            expect(result.envelope['dry_run']).to(be_true)
+            expect(service.invoice).to(be_none)
+            expect(service.result).to(equal([]))
+
+        with it('dona de baixa amb submit_deregister'):
+            service = SiiDeregisterServiceATC(
+                certificate=self.cert_file, key=self.key_file,
+                dry_run=True, persist_xml=self.request_file
+            )
+
+            result = service.submit_deregister(get_invoices(1, 'in')[0])
+
+            expect(result.envelope['dry_run']).to(be_true)
+            expect(service.invoice).to(be_none)
+            expect(
+                count_elements(self.request_file, 'RegistroLRBajaRecibidas')
+            ).to(equal(1))
@@ -0,0 +1,317 @@
+# coding=utf-8
+
+import pickle
+
+from sii.response import (
+    ACCEPTED, REJECTED, RETRYABLE, DuplicatedRegistroError, SendResult,
+    classify_outcome
+)
+from sii.resource import SII
+from sii.server import SiiService, SiiDeregisterService
+from expects import *
+from spec.testing_services import FakeSiiOperations, get_invoices
+from mamba import *
+
+
+with description('El envío de facturas en lote'):
+
+    with before.each:
+        self.service = SiiService('cert.pem', 'key.pem')
+        self.emitted = FakeSiiOperations()
+        self.received = FakeSiiOperations()
+        self.service.emitted_service = self.emitted
+        self.service.received_service = self.received
+
+    with it('debe enviar una sola cabecera con todos los registros'):
+        invoices = get_invoices(3)
+
+        self.service.send_batch(invoices)
+
+        expect(self.emitted.calls).to(have_len(1))
+        cabecera, registros = self.emitted.calls[0]
+        expect(cabecera['Titular']['NIF']).to(equal('55555555K'))
+        expect(registros).to(have_len(3))
+
+    with it('debe separar las facturas emitidas de las recibidas'):
+        invoices = get_invoices(2) + get_invoices(2, invoice_type='in')
+
+        results = self.service.send_batch(invoices)
+
+        expect(self.emitted.calls).to(have_len(1))
+        expect(self.received.calls).to(have_len(1))
+        expect(results).to(have_len(4))
+
+    with it('no debe superar el máximo de registros por envío'):
+        invoices = get_invoices(5)
+
+        self.service.send_batch(invoices, max_registros=2)
+
+        expect(
+            [len(registros) for _, registros in self.emitted.calls]
+        ).to(equal([2, 2, 1]))
+
+    with it('debe enviar los registros construidos en bloque'):
+        invoices = get_invoices(3)
+
+        self.service.send_batch(invoices)
+
+        objects, _ = SII.generate_objects(invoices)
+        obj = objects[0][1]
+        cabecera, registros = self.emitted.calls[0]
+        expect(cabecera).to(equal(obj['SuministroLRFacturasEmitidas'][
+            'Cabecera'
+        ]))
+        expect(registros).to(equal(obj['SuministroLRFacturasEmitidas'][
+            'RegistroLRFacturasEmitidas'
+        ]))
+
+    with it('debe devolver el error de las facturas que no se construyen'):
+        invoices = get_invoices(3)
+        invoices[1].period_id = None
+
+        results = self.service.send_batch(invoices)
+
+        expect([inv for inv, _ in results]).to(equal(invoices))
+        expect(results[1][1]).to(be_an(Exception))
+        expect(results[0][1]['EstadoRegistro']).to(equal('Correcto'))
+        expect(results[2][1]['EstadoRegistro']).to(equal('Correcto'))
+        cabecera, registros = self.emitted.calls[0]
+        expect(registros).to(have_len(2))
+
+    with it('debe devolver el resultado de cada factura en su orden'):
+        invoices = get_invoices(3)
+        rejected = invoices[1].number
+        self.emitted.rejected = [rejected]
+
+        results = self.service.send_batch(invoices)
+
+        expect([inv for inv, _ in results]).to(equal(invoices))
+        expect(
+            [outcome['EstadoRegistro'] for _, outcome in results]
+        ).to(equal(['Correcto', 'Incorrecto', 'Correcto']))
+        expect(results[1][1]['CodigoErrorRegistro']).to(equal(1100))
+        expect(results[1][1]['EstadoEnvio']).to(
+            equal('ParcialmenteCorrecto')
+        )
+
+    with it('debe devolver un SendResult por factura'):
+        invoices = get_invoices(3)
+        self.emitted.rejected = [invoices[2].number]
+
+        results = self.service.send_batch(invoices)
+
+        outcome = results[2][1]
+        expect(outcome).to(be_a(SendResult))
+        expect(outcome.estado_registro).to(equal('Incorrecto'))
+        expect(outcome.codigo_error).to(equal(1100))
+        expect(outcome.csv).to(equal('CSV1'))
+        expect(outcome.estado_envio).to(equal('ParcialmenteCorrecto'))
+        expect(outcome.attempts).to(equal(1))
+        expect(outcome.elapsed).to(be_above_or_equal(0))
+        expect(outcome.envelope).to(be(results[0][1].envelope))
+
+        loaded = pickle.loads(pickle.dumps(outcome, 2))
+
+        expect(loaded).to(equal(outcome))
+        expect(loaded.envelope).to(be_none)
+        expect(loaded.estado_envio).to(equal('ParcialmenteCorrecto'))
+        expect(loaded['EstadoEnvio']).to(equal('ParcialmenteCorrecto'))
+        expect(len(pickle.dumps(loaded, 2))).to(
+            be_below(len(pickle.dumps(outcome.envelope, 2)))
+        )
+
+    with it('debe devolver la excepción si el envío falla'):
+        error = Exception('Timeout')
+
+        def failing_operation(cabecera, registros):
+            raise error
+        self.emitted.SuministroLRFacturasEmitidas = failing_operation
+        invoices = get_invoices(2)
+
+        results = self.service.send_batch(invoices)
+
+        expect([outcome for _, outcome in results]).to(equal([error, error]))
+
+    with it('no debe asignar las líneas de la respuesta por su posición'):
+        def unmatched_operation(cabecera, registros):
+            return {
+                'CSV': 'CSV1',
+                'EstadoEnvio': 'Correcto',
+                'RespuestaLinea': [
+                    {
+                        'IDFactura': {'NumSerieFacturaEmisor': 'OTRA'},
+                        'EstadoRegistro': 'Correcto'
+                    }
+                    for _ in registros
+                ]
+            }
+        self.emitted.SuministroLRFacturasEmitidas = unmatched_operation
+
+        results = self.service.send_batch(get_invoices(2))
+
+        expect([
+            classify_outcome(outcome) for _, outcome in results
+        ]).to(equal([RETRYABLE, RETRYABLE]))
+
+    with it('debe rechazar las facturas repetidas en el envío'):
+        invoices = get_invoices(2) + get_invoices(1)
+
+        results = self.service.send_batch(invoices)
+
+        expect(results[0][1]).to(be_a(DuplicatedRegistroError))
+        expect(results[2][1]).to(be_a(DuplicatedRegistroError))
+        expect(results[1][1]['EstadoRegistro']).to(equal('Correcto'))
+        expect([
+            classify_outcome(outcome) for _, outcome in results
+        ]).to(equal([REJECTED, ACCEPTED, REJECTED]))
+
+
+with description('La baja de facturas en lote'):
+
+    with before.each:
+        self.service = SiiDeregisterService('cert.pem', 'key.pem')
+        self.emitted = FakeSiiOperations()
+        self.received = FakeSiiOperations()
+        self.service.emitted_service = self.emitted
+        self.service.received_service = self.received
+
+    with it('debe enviar todas las bajas con una sola cabecera'):
+        invoices = get_invoices(3, invoice_type='in')
+
+        results = self.service.deregister_batch(invoices)
+
+        expect(self.received.calls).to(have_len(1))
+        cabecera, registros = self.received.calls[0]
+        expect(cabecera).not_to(have_key('TipoComunicacion'))
+        expect(registros).to(have_len(3))
+        expect(
+            [outcome['EstadoRegistro'] for _, outcome in results]
+        ).to(equal(['Correcto'] * 3))
+
+    with it('debe devolver el resultado de cada baja'):
+        invoices = get_invoices(2)
+        self.emitted.rejected = [invoices[0].number]
+
+        results = self.service.deregister_batch(invoices)
+
+        expect(results[0][1]['EstadoRegistro']).to(equal('Incorrecto'))
+        expect(results[1][1]['EstadoRegistro']).to(equal('Correcto'))
+
+
+with description('El envío de facturas en paralelo'):
+
+    with before.each:
+        self.service = SiiService('cert.pem', 'key.pem')
+        self.emitted = FakeSiiOperations()
+        self.service.emitted_service = self.emitted
+
+    with it('debe devolver el resultado de cada factura en su orden'):
+        invoices = get_invoices(6)
+        self.emitted.rejected = [invoices[3].number]
+
+        results = list(self.service.send_many(
+            invoices, max_workers=3, ordered=True
+        ))
+
+        expect([inv for inv, _ in results]).to(equal(invoices))
+        expect(
+            [res['EstadoRegistro'] for _, res in results]
+        ).to(equal(['Correcto'] * 3 + ['Incorrecto'] + ['Correcto'] * 2))
+        expect(self.emitted.calls).to(have_len(6))
+
+    with it('debe devolver los resultados a medida que terminan'):
+        invoices = get_invoices(4)
+
+        results = list(self.service.send_many(invoices, max_workers=2))
+
+        expect(sorted([inv.number for inv, _ in results])).to(
+            equal(sorted([inv.number for inv in invoices]))
+        )
+
+    with it('no debe enviar más del doble de facturas que threads a la vez'):
+        invoices = get_invoices(10)
+        read = []
+
+        def read_invoices():
+            for invoice in invoices:
+                read.append(invoice)
+                yield invoice
+
+        in_flight = []
+        for ordered in (True, False):
+            del read[:]
+            results = self.service.send_many(
+                read_invoices(), max_workers=2, ordered=ordered
+            )
+            for position, _ in enumerate(results):
+                in_flight.append(len(read) - position)
+
+        expect(max(in_flight)).to(equal(4))
+        expect(read).to(have_len(10))
+
+    with it('debe devolver la excepción de las facturas que fallan'):
+        error = Exception('Timeout')
+
+        def failing_operation(cabecera, registro):
+            raise error
+        self.emitted.SuministroLRFacturasEmitidas = failing_operation
+        invoices = get_invoices(2)
+
+        results = list(self.service.send_many(invoices, ordered=True))
+
+        expect([res for _, res in results]).to(equal([error, error]))
+        expect(self.service.invoice).to(be_none)
+
+
+with description('El envío reentrante de facturas'):
+
+    with before.each:
+        self.service = SiiService('cert.pem', 'key.pem')
+        self.emitted = FakeSiiOperations()
+        self.received = FakeSiiOperations()
+        self.service.emitted_service = self.emitted
+        self.service.received_service = self.received
+
+    with it('no debe guardar la factura ni el resultado en el servicio'):
+        invoice = get_invoices(1)[0]
+
+        res = self.service.submit(invoice)
+
+        expect(res).to(be_a(SendResult))
+        expect(res['EstadoEnvio']).to(equal('Correcto'))
+        expect(res['EstadoRegistro']).to(equal('Correcto'))
+        expect(self.service.invoice).to(be_none)
+        expect(self.service.result).to(equal([]))
+
+    with it('debe enviar cada factura a su libro desde varios threads'):
+        from threading import Thread
+        invoices = get_invoices(5) + get_invoices(5, 'in')
+        results = {}
+
+        def submit(invoice):
+            results[invoice.number, invoice.type] = self.service.submit(
+                invoice
+            )
+        threads = [Thread(target=submit, args=(inv,)) for inv in invoices]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        expect(results).to(have_len(10))
+        expect(self.emitted.calls).to(have_len(5))
+        expect(self.received.calls).to(have_len(5))
+        for _, registros in self.received.calls:
+            expect(registros).to(have_len(1))
+            expect(registros[0]).to(have_key('IDFactura'))
+
+    with it('debe dar de baja sin guardar estado'):
+        service = SiiDeregisterService('cert.pem', 'key.pem')
+        service.emitted_service = self.emitted
+
+        res = service.submit(get_invoices(1)[0])
+
+        cabecera, registro = self.emitted.calls[0]
+        expect(res['EstadoEnvio']).to(equal('Correcto'))
+        expect(cabecera).not_to(have_key('TipoComunicacion'))
+        expect(service.invoice).to(be_none)
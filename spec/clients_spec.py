@@ -0,0 +1,211 @@
+# coding=utf-8
+
+from sii.clients import (
+    CLIENT_CACHE, ClientCache, DocumentPickler, DocumentUnpickler,
+    get_document_hash
+)
+from sii.server import SiiService, get_wsdl_path
+from io import BytesIO
+from lxml import etree
+from zeep.transports import Transport
+from zeep.wsdl import Document
+from zeep.xsd import ComplexType
+from sii.atc.server import SiiServiceATC
+from expects import *
+from spec.testing_data import DataGenerator
+from mamba import *
+import os
+import pickle
+import shutil
+import tempfile
+
+
+class PlantedDocument(object):
+    """Pickle que crea un directorio al cargarse"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __reduce__(self):
+        return os.mkdir, (self.path,)
+
+
+def plant_document(cache_dir, wsdl):
+    """Guarda un documento malicioso en la caché y devuelve lo que crearía"""
+    planted_path = os.path.join(cache_dir, 'planted')
+    document_path = os.path.join(
+        cache_dir, '{}.pickle'.format(get_document_hash(wsdl))
+    )
+    with open(document_path, 'wb') as f:
+        pickle.dump(PlantedDocument(planted_path), f)
+    return planted_path
+
+
+with description('La caché de clientes SOAP'):
+
+    with before.each:
+        CLIENT_CACHE.clear()
+        data_gen = DataGenerator()
+        self.out_invoice = data_gen.get_out_invoice()
+        self.in_invoice = data_gen.get_in_invoice()
+
+    with it('debe cargar por defecto los WSDL incluidos en la librería'):
+        service = SiiService('cert.pem', 'key.pem')
+
+        service.get_service(self.out_invoice)
+
+        expect(CLIENT_CACHE.documents).to(have_key(
+            get_wsdl_path('SuministroFactEmitidas.wsdl')
+        ))
+
+    with it('debe usar la dirección de pruebas en modo test'):
+        service = SiiService('cert.pem', 'key.pem', test_mode=True)
+
+        emitted_service = service.get_service(self.out_invoice)
+
+        expect(emitted_service._binding_options['address']).to(
+            start_with('https://prewww1.aeat.es')
+        )
+
+    with it('debe compartir el servicio entre instancias con el mismo '
+            'certificado'):
+        service_a = SiiService('cert.pem', 'key.pem')
+        service_b = SiiService('cert.pem', 'key.pem')
+
+        expect(service_a.get_service(self.out_invoice)).to(
+            be(service_b.get_service(self.out_invoice))
+        )
+
+    with it('no debe compartir el servicio entre certificados distintos'):
+        service_a = SiiService('cert.pem', 'key.pem')
+        service_b = SiiService('other_cert.pem', 'other_key.pem')
+
+        expect(service_a.get_service(self.out_invoice)).not_to(
+            be(service_b.get_service(self.out_invoice))
+        )
+        expect(CLIENT_CACHE.documents).to(have_len(1))
+
+    with it('debe crear un servicio por libro y dirección'):
+        service = SiiService('cert.pem', 'key.pem')
+        proxy_service = SiiService(
+            'cert.pem', 'key.pem', url='https://proxy:444'
+        )
+
+        service.get_service(self.out_invoice)
+        service.get_service(self.in_invoice)
+        proxy_service.get_service(self.out_invoice)
+
+        expect(CLIENT_CACHE.services).to(have_len(3))
+        expect(CLIENT_CACHE.documents).to(have_len(2))
+
+    with it('no debe compartir los servicios ATC con plugins'):
+        service_a = SiiServiceATC('cert.pem', 'key.pem', dry_run=True)
+        service_b = SiiServiceATC('cert.pem', 'key.pem', dry_run=True)
+
+        expect(service_a.get_service(self.out_invoice)).not_to(
+            be(service_b.get_service(self.out_invoice))
+        )
+        expect(CLIENT_CACHE.services).to(have_len(0))
+        expect(CLIENT_CACHE.documents).to(have_len(1))
+
+
+with description('La caché en disco de WSDL procesados'):
+
+    with before.each:
+        self.cache_dir = tempfile.mkdtemp(prefix='sii_wsdl_cache_')
+        self.wsdl = get_wsdl_path('SuministroFactEmitidas.wsdl')
+
+    with after.each:
+        shutil.rmtree(self.cache_dir)
+
+    with it('debe guardar el documento procesado en disco'):
+        ClientCache(cache_dir=self.cache_dir).get_document(
+            self.wsdl, Transport()
+        )
+
+        expect(os.listdir(self.cache_dir)).to(equal(
+            ['{}.pickle'.format(get_document_hash(self.wsdl))]
+        ))
+
+    with it('debe crear servicios equivalentes desde el documento en disco'):
+        ClientCache(cache_dir=self.cache_dir).get_document(
+            self.wsdl, Transport()
+        )
+        cache = ClientCache(cache_dir=self.cache_dir)
+
+        service = cache.create_service(
+            Transport(), self.wsdl, 'SuministroFactEmitidas', 'siiService'
+        )
+
+        expect(service._binding_options['address']).to(equal(
+            'https://www1.agenciatributaria.gob.es'
+            '/wlpl/SSII-FACT/ws/fe/SiiFactFEV1SOAP'
+        ))
+        expect(service.SuministroLRFacturasEmitidas).not_to(be_none)
+
+    with it('debe reconstruir una sola clase por cada tipo del XSD'):
+        def create_class(name):
+            return type(name, (ComplexType,), {
+                '__module__': 'zeep.xsd.dynamic_types',
+                '_xsd_name': etree.QName('{urn:sii}' + name)
+            })
+        factura, detalle = create_class('Factura'), create_class('Detalle')
+        data = BytesIO()
+        DocumentPickler(data, 2).dump([factura, detalle, factura])
+        data.seek(0)
+
+        loaded = DocumentUnpickler(data, Transport()).load()
+
+        expect(loaded[0]).to(be(loaded[2]))
+        expect(loaded[0]).not_to(be(loaded[1]))
+        expect(loaded[0]._xsd_name).to(equal(factura._xsd_name))
+
+    with it('debe invalidarse si cambia algún fichero del WSDL'):
+        data_dir = os.path.join(self.cache_dir, 'data')
+        shutil.copytree(
+            os.path.dirname(os.path.dirname(self.wsdl[len('file://'):])),
+            data_dir
+        )
+        wsdl = get_wsdl_path(
+            'SuministroFactEmitidas.wsdl', os.path.join(data_dir, 'wsdl')
+        )
+        document_hash = get_document_hash(wsdl)
+
+        with open(os.path.join(data_dir, 'xsd', 'SuministroLR.xsd'), 'a') as f:
+            f.write('\n')
+
+        expect(get_document_hash(wsdl)).not_to(equal(document_hash))
+
+    with it('no debe cargar documentos de un directorio accesible por otros'):
+        planted_path = plant_document(self.cache_dir, self.wsdl)
+        os.chmod(self.cache_dir, 0o777)
+
+        document = ClientCache(cache_dir=self.cache_dir).get_document(
+            self.wsdl, Transport()
+        )
+
+        expect(document).to(be_a(Document))
+        expect(os.path.exists(planted_path)).to(be_false)
+
+    with it('no debe cargar documentos de un directorio de otro usuario'):
+        planted_path = plant_document(self.cache_dir, self.wsdl)
+        if os.getuid() == 0:
+            os.chown(self.cache_dir, os.getuid() + 12345, -1)
+            cache_dir = self.cache_dir
+        else:
+            # Sin ser root no se puede cambiar el propietario, un enlace
+            # simbólico tampoco es un directorio del usuario
+            cache_dir = os.path.join(tempfile.mkdtemp(), 'link')
+            os.symlink(self.cache_dir, cache_dir)
+
+        document = ClientCache(cache_dir=cache_dir).get_document(
+            self.wsdl, Transport()
+        )
+
+        expect(document).to(be_a(Document))
+        expect(os.path.exists(planted_path)).to(be_false)
+
+    with it('no debe guardar en disco los WSDL remotos'):
+        expect(get_document_hash(
+            SiiService.out_inv_config['wsdl']
+        )).to(be_none)
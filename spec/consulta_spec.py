@@ -0,0 +1,247 @@
+# coding=utf-8
+
+from sii.consulta import (
+    AgrupadaClienteRecord, ConsultaPage, ConsultaRecord, InformadaClienteRecord
+)
+from sii.server import ConsultaService, iter_concurrently
+from sii.throttle import SendScheduler
+from expects import *
+from spec.testing_services import FakeConsultaLR, get_consulta_records
+from mamba import *
+from zeep.exceptions import Fault, TransportError
+
+TITULAR = {'NombreRazon': 'Titular', 'NIF': 'B12345674'}
+
+
+with description('La consulta paginada de los libros'):
+
+    with before.each:
+        self.service = ConsultaService('cert.pem', 'key.pem')
+        self.emitted = FakeConsultaLR(records=get_consulta_records(5))
+        self.service.emitted_service = self.emitted
+
+    with it('debe devolver todos los registros del periodo'):
+        records = list(
+            self.service.iter_registros('out', TITULAR, '2016', '12')
+        )
+
+        expect(records).to(have_len(5))
+        expect(self.emitted.consultas).to(have_len(1))
+        cabecera, filtro = self.emitted.consultas[0]
+        expect(cabecera['Titular']).to(equal(TITULAR))
+        expect(filtro['PeriodoLiquidacion']).to(
+            equal({'Ejercicio': '2016', 'Periodo': '12'})
+        )
+
+    with it('debe seguir la ClavePaginacion del último registro'):
+        self.emitted.page_size = 2
+
+        records = list(
+            self.service.iter_registros('out', TITULAR, '2016', '12')
+        )
+
+        expect([r.num_serie for r in records]).to(equal(
+            ['F00000', 'F00001', 'F00002', 'F00003', 'F00004']
+        ))
+        expect(self.emitted.consultas).to(have_len(3))
+        _, filtro = self.emitted.consultas[1]
+        expect(filtro['ClavePaginacion']).to(equal({
+            'IDEmisorFactura': {'NIF': 'B12345674'},
+            'NumSerieFacturaEmisor': 'F00001',
+            'FechaExpedicionFacturaEmisor': '31-12-2016'
+        }))
+
+    with it('debe pedir las páginas a medida que se consumen'):
+        self.emitted.page_size = 2
+
+        records = self.service.iter_registros('out', TITULAR, '2016', '12')
+        next(records)
+
+        expect(self.emitted.consultas).to(have_len(1))
+
+    with it('debe devolver registros compactos'):
+        self.emitted.records[0]['detalle_iva'] = [
+            ('21', '100.00', '21.00'), ('10', '10.00', '1.00')
+        ]
+
+        record = next(
+            self.service.iter_registros('out', TITULAR, '2016', '12')
+        )
+
+        expect(record).to(be_a(ConsultaRecord))
+        expect(record.key).to(equal(('B12345674', 'F00000', '31-12-2016')))
+        expect(record.importe_total).to(equal('121.00'))
+        expect(record.detalle_iva).to(equal((
+            ('21', '100.00', '21.00'), ('10', '10.00', '1.00')
+        )))
+        expect(record.contraparte).to(equal('12345678Z'))
+        expect(record.estado_registro).to(equal('Correcta'))
+        expect(record.csv).to(equal('CSVF00000'))
+        expect(record.periodo).to(equal('12'))
+        expect(record.timestamp_modificacion).to(
+            equal('01-01-2017 10:00:00')
+        )
+
+    with it('debe incluir el NombreRazon en la paginación de recibidas'):
+        received = FakeConsultaLR('in', get_consulta_records(3), 1)
+        self.service.received_service = received
+
+        records = list(
+            self.service.iter_registros('in', TITULAR, '2016', '12')
+        )
+
+        expect(records).to(have_len(3))
+        expect(records[0].detalle_iva).to(equal((('21', '100', '21'),)))
+        _, filtro = received.consultas[1]
+        expect(filtro['ClavePaginacion']['IDEmisorFactura']).to(
+            equal({'NombreRazon': 'Emisor', 'NIF': 'B12345674'})
+        )
+
+    with it('debe lanzar los Fault de la AEAT'):
+        self.emitted.fault = 'Codigo[4104].Error en la cabecera'
+
+        def consulta():
+            list(self.service.iter_registros('out', TITULAR, '2016', '12'))
+
+        expect(consulta).to(
+            raise_error(Fault, 'Codigo[4104].Error en la cabecera')
+        )
+
+    with it('debe lanzar los errores HTTP'):
+        self.emitted.status_code = 503
+
+        def consulta():
+            list(self.service.iter_registros('out', TITULAR, '2016', '12'))
+
+        expect(consulta).to(raise_error(TransportError))
+
+    with it('debe pasar las consultas por el planificador'):
+        scheduler = SendScheduler(sleep=lambda seconds: None)
+        self.service.scheduler = scheduler
+
+        list(self.service.iter_registros('out', TITULAR, '2016', '12'))
+
+        expect(scheduler.buckets).to(have_key(
+            ((None, False, 'out'), 'B12345674')
+        ))
+
+
+with description('El análisis incremental de una página'):
+
+    with it('debe indicar si quedan registros por consultar'):
+        emitted = FakeConsultaLR(records=get_consulta_records(3), page_size=2)
+        filtro = {'PeriodoLiquidacion': {'Ejercicio': '2016', 'Periodo': '12'}}
+        with emitted.settings(raw_response=True):
+            response = emitted.consulta({}, filtro)
+        page = ConsultaPage('out')
+
+        records = list(page.parse(response.content))
+
+        expect([r.num_serie for r in records]).to(
+            equal(['F00000', 'F00001'])
+        )
+        expect(page.more).to(be_true)
+        expect(page.last.num_serie).to(equal('F00001'))
+
+
+with description('Las facturas informadas por los clientes'):
+
+    with before.each:
+        self.service = ConsultaService('cert.pem', 'key.pem')
+        self.emitted = FakeConsultaLR(informadas=[
+            {'num_serie': 'F00000', 'cliente': '12345678Z'},
+            {'num_serie': 'F00001', 'cliente': '87654321X'},
+            {'num_serie': 'F00002', 'cliente': '12345678Z',
+             'imputacion': ('2017', '01')},
+            {'num_serie': 'F00003', 'cliente': '12345678Z',
+             'imputacion': ('2017', '01')},
+            {'num_serie': 'F00004', 'cliente': '12345678Z',
+             'imputacion': ('2017', '02')},
+        ])
+        self.service.emitted_service = self.emitted
+
+    with it('debe devolver las facturas informadas de un periodo'):
+        records = list(
+            self.service.iter_informadas_cliente(TITULAR, '2016', '12')
+        )
+
+        expect([r.num_serie for r in records]).to(
+            equal(['F00000', 'F00001'])
+        )
+        record = records[0]
+        expect(record).to(be_a(InformadaClienteRecord))
+        expect(record.key).to(equal(('B12345674', 'F00000', '31-12-2016')))
+        expect(record.cliente).to(equal('12345678Z'))
+        expect(record.importe_total).to(equal('121'))
+        expect(record.detalle_iva).to(equal((('21', '100', '21'),)))
+        expect(record.estado_cuadre).to(equal('2'))
+        cabecera, filtro = self.emitted.consultas[0]
+        expect(cabecera['TitularLRFE']).to(equal(TITULAR))
+        expect(filtro['PeriodoImputacion']).to(equal(
+            {'EjercicioImputacion': '2016', 'PeriodoImputacion': '12'}
+        ))
+
+    with it('debe seguir la paginación por emisor, factura y cliente'):
+        self.emitted.page_size = 1
+
+        records = list(
+            self.service.iter_informadas_cliente(TITULAR, '2016', '12')
+        )
+
+        expect(records).to(have_len(2))
+        _, filtro = self.emitted.consultas[1]
+        expect(filtro['ClavePaginacion']).to(equal({
+            'IDEmisorFactura': {'NombreRazon': 'Titular', 'NIF': 'B12345674'},
+            'NumSerieFacturaEmisor': 'F00000',
+            'FechaExpedicionFacturaEmisor': '31-12-2016',
+            'Cliente': {'NombreRazon': 'Cliente', 'NIF': '12345678Z'}
+        }))
+
+    with it('debe consultar varios periodos a la vez'):
+        self.emitted.page_size = 1
+
+        records = list(self.service.iter_informadas_cliente_periodos(
+            TITULAR, [('2016', '12'), ('2017', '01'), ('2017', '02')],
+            max_workers=3
+        ))
+
+        expect(sorted(r.num_serie for r in records)).to(equal(
+            ['F00000', 'F00001', 'F00002', 'F00003', 'F00004']
+        ))
+
+    with it('debe devolver el número de facturas informadas por cliente'):
+        records = list(
+            self.service.iter_agrupadas_cliente(TITULAR, '2017', '01')
+        )
+
+        expect(records).to(equal([
+            AgrupadaClienteRecord('12345678Z', 'Cliente', 2)
+        ]))
+
+
+with description('El consumo concurrente de varios generadores'):
+
+    with it('debe devolver los elementos de todos los generadores'):
+        sources = [lambda n=n: range(n * 10, n * 10 + 3) for n in range(4)]
+
+        items = list(iter_concurrently(sources, max_workers=2, max_queued=2))
+
+        expect(sorted(items)).to(equal(
+            [0, 1, 2, 10, 11, 12, 20, 21, 22, 30, 31, 32]
+        ))
+
+    with it('debe lanzar el error de un generador y parar el resto'):
+        def endless():
+            n = 0
+            while True:
+                yield n
+                n += 1
+
+        def broken():
+            raise TransportError(status_code=503)
+            yield
+
+        def consume():
+            list(iter_concurrently([endless, broken], max_queued=1))
+
+        expect(consume).to(raise_error(TransportError))
@@ -0,0 +1,77 @@
+# coding=utf-8
+
+from sii.error_codes import (
+    ERROR_CODES, DUPLICATE, NEEDS_A1, PERMANENT, RETRYABLE, WARNING,
+    get_error_category
+)
+from sii.atc.error_codes import ERROR_CODES as ATC_ERROR_CODES
+from sii.response import REJECTED, RETRYABLE as RETRY, classify_outcome
+from zeep.exceptions import Fault
+from expects import *
+from mamba import *
+import timeit
+
+
+with description('El catálogo de códigos de error'):
+
+    with it('debe clasificar los errores técnicos como reintentables'):
+        expect(get_error_category(4107)).to(equal(RETRYABLE))
+        expect(get_error_category('3501')).to(equal(RETRYABLE))
+
+    with it('debe reintentar los envíos que superan el límite de envíos'):
+        expect(get_error_category(4116)).to(equal(RETRYABLE))
+        expect(classify_outcome(
+            Fault('Codigo[4116].Se ha superado el límite de envíos')
+        )).to(equal(RETRY))
+
+    with it('debe clasificar las facturas duplicadas'):
+        expect(get_error_category(3000)).to(equal(NEEDS_A1))
+        expect(get_error_category(3001)).to(equal(DUPLICATE))
+
+    with it('debe listar los códigos que deciden si se reintenta'):
+        expect(ERROR_CODES.codes).to(have_keys({
+            2011: WARNING,
+            3002: PERMANENT,
+            3010: PERMANENT,
+            4102: PERMANENT,
+            4117: PERMANENT,
+            4118: PERMANENT
+        }))
+
+    with it('debe clasificar el resto de códigos por su familia'):
+        expect(ERROR_CODES.codes).not_to(have_keys(1100, 2045, 3014, 4106))
+        expect(get_error_category(1100)).to(equal(PERMANENT))
+        expect(get_error_category(2045)).to(equal(WARNING))
+        expect(get_error_category(3014)).to(equal(PERMANENT))
+        expect(get_error_category(4106)).to(equal(PERMANENT))
+        expect(get_error_category(9999)).to(equal(PERMANENT))
+        expect(get_error_category(None)).to(be_none)
+
+    with it('debe incluir los errores técnicos propios de la ATC'):
+        expect(ERROR_CODES.get_category(3502)).to(equal(PERMANENT))
+        expect(ATC_ERROR_CODES.get_category(3502)).to(equal(RETRYABLE))
+        expect(ATC_ERROR_CODES.get_category(1184)).to(equal(RETRYABLE))
+        expect(ATC_ERROR_CODES.get_category(3000)).to(equal(NEEDS_A1))
+
+    with it('no debe reintentar los códigos de la ATC que no son técnicos'):
+        expect(ATC_ERROR_CODES.get_category(3503)).to(equal(PERMANENT))
+        expect(ATC_ERROR_CODES.get_category(4116)).to(equal(PERMANENT))
+        expect(ATC_ERROR_CODES.get_category(4118)).to(equal(PERMANENT))
+
+    with it('debe usar el catálogo al clasificar los registros'):
+        outcome = {'EstadoRegistro': 'Incorrecto', 'CodigoErrorRegistro': 3504}
+
+        expect(classify_outcome(outcome)).to(equal(REJECTED))
+        expect(
+            classify_outcome(outcome, ATC_ERROR_CODES)
+        ).to(equal(RETRY))
+
+    with it('debe clasificar una respuesta de 10000 líneas rápidamente'):
+        codes = [1100, 2011, 3000, 4107] * 2500
+
+        elapsed = timeit.timeit(
+            lambda: [ERROR_CODES.get_category(code) for code in codes],
+            number=1
+        )
+
+        expect(elapsed).to(be_below(0.5))
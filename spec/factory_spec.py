@@ -6,9 +6,11 @@ Aquest fitxer conté els tests amb Mamba per verificar que el Factory
 pattern funciona correctament per crear serveis AEAT i ATC.
 """
 
+from sii.clients import CLIENT_CACHE
 from sii.factory import SiiServiceFactory
 from sii.server import SiiService, SiiDeregisterService
 from sii.atc.server import SiiServiceATC, SiiDeregisterServiceATC
+from spec.testing_data import DataGenerator
 from expects import *
 from mamba import *
 
@@ -197,3 +199,122 @@ with description('SiiServiceFactory'):
             )
             expect(service_aeat).to(have_property('deregister_invoice'))
             expect(service_atc).to(have_property('deregister_invoice'))
+    
+    with description('sessions HTTP compartides'):
+        with before.each:
+            self.certificate = '/fake/path/cert.pem'
+            self.key = '/fake/path/key.pem'
+            data_gen = DataGenerator()
+            self.out_invoice = data_gen.get_out_invoice()
+            self.in_invoice = data_gen.get_in_invoice()
+            SiiServiceFactory.configure_sessions(pool_size=4, max_idle=300)
+        
+        with it('els serveis del factory utilitzen el registre compartit'):
+            service = SiiServiceFactory.create_service(
+                SiiServiceFactory.AEAT,
+                certificate=self.certificate,
+                key=self.key
+            )
+            deregister_service = SiiServiceFactory.create_deregister_service(
+                SiiServiceFactory.ATC,
+                certificate=self.certificate,
+                key=self.key
+            )
+            expect(service.session_registry).to(
+                be(SiiServiceFactory.session_registry)
+            )
+            expect(deregister_service.session_registry).to(
+                be(SiiServiceFactory.session_registry)
+            )
+        
+        with it('factures emeses i rebudes comparteixen la sessió'):
+            service = SiiServiceFactory.create_service(
+                SiiServiceFactory.AEAT,
+                certificate=self.certificate,
+                key=self.key
+            )
+            emitted = service.get_service(self.out_invoice)
+            received = service.get_service(self.in_invoice)
+            expect(emitted._client.transport.session).to(
+                be(received._client.transport.session)
+            )
+            expect(SiiServiceFactory.session_registry.sessions).to(
+                have_len(1)
+            )
+        
+        with it('descarta els serveis del registre anterior'):
+            CLIENT_CACHE.clear()
+            standalone = SiiService(self.certificate, self.key)
+            standalone.get_service(self.out_invoice)
+            service = SiiServiceFactory.create_service(
+                SiiServiceFactory.AEAT,
+                certificate=self.certificate,
+                key=self.key
+            )
+            old_registry = service.session_registry
+            service.get_service(self.out_invoice)
+            service.get_service(self.in_invoice)
+            expect(CLIENT_CACHE.services).to(have_len(3))
+
+            SiiServiceFactory.configure_sessions()
+
+            expect(CLIENT_CACHE.services).to(have_len(1))
+            for key in CLIENT_CACHE.services:
+                expect(key[4]).not_to(contain(old_registry))
+        
+        with it('configura la mida del pool de connexions'):
+            registry = SiiServiceFactory.session_registry
+            session = registry.get_session(
+                self.certificate, self.key, True, 'proxy:444'
+            )
+            adapter = session.get_adapter('https://proxy:444/')
+            expect(adapter._pool_maxsize).to(equal(4))
+        
+        with it('tanca les connexions de les sessions inactives'):
+            registry = SiiServiceFactory.configure_sessions(max_idle=60)
+            registry.get_session(self.certificate, self.key, True)
+            for session_key in registry.last_used:
+                registry.last_used[session_key] -= 61
+            registry.evict_idle()
+            expect(registry.last_used).to(be_empty)
+            expect(registry.sessions).to(have_len(1))
+
+        with it('no tanca les connexions de les sessions que es fan servir'):
+            registry = SiiServiceFactory.configure_sessions(max_idle=60)
+            session = registry.get_session(self.certificate, self.key, True)
+            for session_key in registry.last_used:
+                registry.last_used[session_key] -= 61
+            try:
+                session.get('http://127.0.0.1:1/', timeout=1)
+            except IOError:
+                pass
+            registry.evict_idle()
+            expect(registry.last_used).to(have_len(1))
+
+        with it('no tanca les connexions amb peticions en curs'):
+            registry = SiiServiceFactory.configure_sessions(max_idle=60)
+            session = registry.get_session(self.certificate, self.key, True)
+            adapter = session.get_adapter('https://www.agenciatributaria.gob.es/')
+            adapter.on_send(True)
+            for session_key in registry.last_used:
+                registry.last_used[session_key] -= 61
+            registry.evict_idle()
+            expect(registry.last_used).to(have_len(1))
+            adapter.on_send(False)
+            for session_key in registry.last_used:
+                registry.last_used[session_key] -= 61
+            registry.evict_idle()
+            expect(registry.last_used).to(be_empty)
+
+        with it('torna a controlar les sessions tancades quan es fan servir'):
+            registry = SiiServiceFactory.configure_sessions(max_idle=60)
+            session = registry.get_session(self.certificate, self.key, True)
+            for session_key in registry.last_used:
+                registry.last_used[session_key] -= 61
+            registry.evict_idle()
+            expect(registry.last_used).to(be_empty)
+            try:
+                session.get('http://127.0.0.1:1/', timeout=1)
+            except IOError:
+                pass
+            expect(registry.last_used).to(have_len(1))
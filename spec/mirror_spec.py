@@ -0,0 +1,140 @@
+# coding=utf-8
+
+from datetime import date
+import os
+import shutil
+import tempfile
+
+from sii.mirror import SiiMirror
+from sii.server import ConsultaService
+from expects import *
+from spec.testing_services import FakeConsultaLR, get_consulta_records
+from mamba import *
+from zeep.exceptions import TransportError
+
+TITULAR = {'NombreRazon': 'Titular', 'NIF': 'B12345674'}
+
+
+with description('El espejo local de los libros'):
+
+    with before.each:
+        self.service = ConsultaService('cert.pem', 'key.pem')
+        self.emitted = FakeConsultaLR(
+            records=get_consulta_records(5), page_size=2
+        )
+        self.service.emitted_service = self.emitted
+        self.mirror = SiiMirror(self.service)
+
+    with after.each:
+        self.mirror.close()
+
+    with it('debe guardar todos los registros del periodo'):
+        fetched = self.mirror.sync(
+            'out', TITULAR, '2016', '12', today=date(2017, 1, 2)
+        )
+
+        expect(fetched).to(equal(5))
+        expect(self.emitted.consultas[0][1]).not_to(
+            have_key('FechaPresentacion')
+        )
+        records = list(
+            self.mirror.iter_registros('out', 'B12345674', '2016', '12')
+        )
+        expect(sorted(r.num_serie for r in records)).to(equal(
+            ['F00000', 'F00001', 'F00002', 'F00003', 'F00004']
+        ))
+
+    with it('debe buscar los registros por NIF, número y fecha'):
+        self.emitted.records[1]['detalle_iva'] = [('10', '10.00', '1.00')]
+        self.mirror.sync('out', TITULAR, '2016', '12')
+
+        record = self.mirror.get_registro('B12345674', 'F00001', '31-12-2016')
+
+        expect(record.importe_total).to(equal('122.00'))
+        expect(record.detalle_iva).to(equal((('10', '10.00', '1.00'),)))
+        expect(record.csv).to(equal('CSVF00001'))
+        expect(
+            self.mirror.get_registro('B12345674', 'F00001', '30-12-2016')
+        ).to(be_none)
+
+    with it('debe volver a leer el periodo entero en cada sincronización'):
+        self.mirror.sync('out', TITULAR, '2016', '12', today=date(2017, 1, 2))
+        self.emitted.records[0].update({
+            'importe': '999.00', 'presentacion': '03-01-2017'
+        })
+        self.emitted.records.append({
+            'nif': 'B12345674', 'num_serie': 'F00005',
+            'presentacion': '03-01-2017'
+        })
+        del self.emitted.records[1]
+        self.emitted.consultas = []
+
+        fetched = self.mirror.sync(
+            'out', TITULAR, '2016', '12', today=date(2017, 1, 3)
+        )
+
+        expect(fetched).to(equal(5))
+        expect(self.emitted.consultas[0][1]).not_to(
+            have_key('FechaPresentacion')
+        )
+        expect(
+            self.mirror.get_registro('B12345674', 'F00000', '31-12-2016')
+            .importe_total
+        ).to(equal('999.00'))
+        expect(
+            self.mirror.get_registro('B12345674', 'F00001', '31-12-2016')
+        ).to(be_none)
+        expect(list(
+            self.mirror.iter_registros('out', 'B12345674', '2016', '12')
+        )).to(have_len(5))
+        expect(
+            self.mirror.get_last_sync('out', 'B12345674', '2016', '12')
+        ).to(equal(date(2017, 1, 3)))
+
+    with it('debe guardar las bajas posteriores a la última sincronización'):
+        self.mirror.sync('out', TITULAR, '2016', '12', today=date(2017, 1, 2))
+        # La baja no cambia la FechaPresentacion del alta
+        self.emitted.records[2]['estado'] = 'Anulada'
+
+        self.mirror.sync('out', TITULAR, '2016', '12', today=date(2017, 1, 3))
+
+        expect(
+            self.mirror.get_registro('B12345674', 'F00002', '31-12-2016')
+            .estado_registro
+        ).to(equal('Anulada'))
+        expect(
+            self.mirror.get_registro('B12345674', 'F00001', '31-12-2016')
+            .estado_registro
+        ).to(equal('Correcta'))
+
+    with it('no debe guardar nada si la consulta falla'):
+        self.emitted.status_code = 503
+
+        def sync():
+            self.mirror.sync('out', TITULAR, '2016', '12')
+
+        expect(sync).to(raise_error(TransportError))
+        expect(
+            self.mirror.get_last_sync('out', 'B12345674', '2016', '12')
+        ).to(be_none)
+        expect(list(
+            self.mirror.iter_registros('out', 'B12345674', '2016', '12')
+        )).to(be_empty)
+
+    with it('debe persistir en disco'):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'sii.db')
+            mirror = SiiMirror(self.service, path)
+            mirror.sync('out', TITULAR, '2016', '12')
+            mirror.close()
+
+            mirror = SiiMirror(self.service, path)
+            records = list(
+                mirror.iter_registros('out', 'B12345674', '2016', '12')
+            )
+            mirror.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        expect(records).to(have_len(5))
@@ -0,0 +1,212 @@
+# coding=utf-8
+
+import os
+import shutil
+import tempfile
+
+from sii.query_cache import (
+    DiskQueryCache, MemoryQueryCache, QueryCache, get_query_key
+)
+from sii.server import ConsultaService, SiiService
+from expects import *
+from spec.testing_services import (
+    FakeClock, FakeConsultaLR, FakeSiiOperations, get_consulta_records,
+    get_invoices
+)
+from mamba import *
+
+TITULAR = {'NombreRazon': 'Titular', 'NIF': '55555555K'}
+HEADER = {'IDVersionSii': '1.1', 'Titular': TITULAR}
+FILTRO = {'PeriodoLiquidacion': {'Ejercicio': '2016', 'Periodo': '12'}}
+OPERATION = 'ConsultaLRFacturasEmitidas'
+
+
+with description('La clave de las consultas'):
+
+    with it('debe ser la misma para filtros equivalentes'):
+        filtro = {
+            'FechaPresentacion': {'Desde': '01-01-2017', 'Hasta': None},
+            'PeriodoLiquidacion': {'Periodo': 12, 'Ejercicio': 2016}
+        }
+        header = {
+            'IDVersionSii': '1.1',
+            'Titular': {'NIF': '55555555K', 'NombreRazon': 'Otro nombre'}
+        }
+        same = dict(filtro, FechaPresentacion={'Desde': '01-01-2017'})
+
+        expect(get_query_key(OPERATION, header, filtro)).to(
+            equal(get_query_key(OPERATION, HEADER, same))
+        )
+        expect(get_query_key(OPERATION, HEADER, filtro)).not_to(
+            equal(get_query_key(OPERATION, HEADER, FILTRO))
+        )
+        expect(get_query_key(OPERATION, HEADER, FILTRO)).not_to(equal(
+            get_query_key('ConsultaLRFacturasRecibidas', HEADER, FILTRO)
+        ))
+
+    with it('debe empezar por la etiqueta del periodo'):
+        key = get_query_key(OPERATION, HEADER, FILTRO)
+        filtro = {'PeriodoLiquidacion': {'Ejercicio': '2016', 'Periodo': '1'}}
+        other_key = get_query_key(OPERATION, HEADER, filtro)
+
+        expect(key.split('-')[0]).not_to(equal(other_key.split('-')[0]))
+        expect(get_query_key(
+            OPERATION, HEADER, dict(FILTRO, ClavePaginacion={'Num': 'F1'})
+        ).split('-')[0]).to(equal(key.split('-')[0]))
+
+
+def get_caches(clock, cache_dir, entries=100):
+    """Cachés en memoria y en disco con sitio para entries páginas de 10
+    bytes, en disco cada página lleva la caducidad (7 bytes) delante
+    """
+    return [
+        MemoryQueryCache(ttl=300, max_size=entries * 10 + 5, clock=clock),
+        DiskQueryCache(
+            cache_dir, ttl=300, max_size=entries * 17 + 5, clock=clock
+        )
+    ]
+
+
+with description('La caché de consultas'):
+
+    with before.each:
+        self.clock = FakeClock()
+        self.cache_dir = tempfile.mkdtemp()
+
+    with after.each:
+        shutil.rmtree(self.cache_dir)
+
+    with it('debe devolver las respuestas guardadas'):
+        for cache in get_caches(self.clock, self.cache_dir):
+            cache.store(OPERATION, HEADER, FILTRO, b'<page-01/>')
+
+            expect(cache.lookup(OPERATION, HEADER, FILTRO)).to(
+                equal(b'<page-01/>')
+            )
+            expect(
+                cache.lookup('ConsultaLRFacturasRecibidas', HEADER, FILTRO)
+            ).to(be_none)
+
+    with it('debe caducar las respuestas tras el ttl'):
+        for cache in get_caches(self.clock, self.cache_dir):
+            cache.store(OPERATION, HEADER, FILTRO, b'<page-01/>')
+            self.clock.now += 299
+
+            expect(cache.lookup(OPERATION, HEADER, FILTRO)).not_to(be_none)
+
+            self.clock.now += 1
+            expect(cache.lookup(OPERATION, HEADER, FILTRO)).to(be_none)
+            self.clock.now = 1000.0
+
+    with it('debe invalidar las consultas de un periodo'):
+        other = {'PeriodoLiquidacion': {'Ejercicio': '2017', 'Periodo': '01'}}
+        for cache in get_caches(self.clock, self.cache_dir):
+            cache.store(OPERATION, HEADER, FILTRO, b'<2016-12/>')
+            cache.store(OPERATION, HEADER, other, b'<2017-01/>')
+
+            cache.invalidate('55555555K', '2016', 12)
+
+            expect(cache.lookup(OPERATION, HEADER, FILTRO)).to(be_none)
+            expect(cache.lookup(OPERATION, HEADER, other)).to(
+                equal(b'<2017-01/>')
+            )
+
+    with it('debe descartar las respuestas menos usadas'):
+        filtros = [
+            {'PeriodoLiquidacion': {'Ejercicio': '2016', 'Periodo': p}}
+            for p in ('10', '11', '12')
+        ]
+        for cache in get_caches(self.clock, self.cache_dir, entries=2):
+            cache.store(OPERATION, HEADER, filtros[0], b'<page-10/>')
+            self.clock.now += 1
+            cache.store(OPERATION, HEADER, filtros[1], b'<page-11/>')
+            self.clock.now += 1
+            cache.lookup(OPERATION, HEADER, filtros[0])
+            self.clock.now += 1
+            cache.store(OPERATION, HEADER, filtros[2], b'<page-12/>')
+
+            expect(cache.lookup(OPERATION, HEADER, filtros[0])).not_to(
+                be_none
+            )
+            expect(cache.lookup(OPERATION, HEADER, filtros[1])).to(be_none)
+            expect(cache.lookup(OPERATION, HEADER, filtros[2])).not_to(
+                be_none
+            )
+            self.clock.now = 1000.0
+
+    with it('debe compartir las respuestas en disco entre instancias'):
+        DiskQueryCache(self.cache_dir, clock=self.clock).store(
+            OPERATION, HEADER, FILTRO, b'<page-01/>'
+        )
+
+        cache = DiskQueryCache(self.cache_dir, clock=self.clock)
+
+        expect(cache.lookup(OPERATION, HEADER, FILTRO)).to(
+            equal(b'<page-01/>')
+        )
+
+    with it('no debe usar un directorio que no sea solo del usuario'):
+        DiskQueryCache(self.cache_dir, clock=self.clock).store(
+            OPERATION, HEADER, FILTRO, b'<page-01/>'
+        )
+        link_dir = os.path.join(tempfile.mkdtemp(), 'link')
+        os.symlink(self.cache_dir, link_dir)
+        link_cache = DiskQueryCache(link_dir, clock=self.clock)
+
+        expect(link_cache.lookup(OPERATION, HEADER, FILTRO)).to(be_none)
+
+        os.chmod(self.cache_dir, 0o777)
+        cache = DiskQueryCache(self.cache_dir, clock=self.clock)
+        cache.store(
+            'ConsultaLRFacturasRecibidas', HEADER, FILTRO, b'<page-02/>'
+        )
+
+        expect(cache.lookup(OPERATION, HEADER, FILTRO)).to(be_none)
+        expect(os.listdir(self.cache_dir)).to(have_len(1))
+        shutil.rmtree(os.path.dirname(link_dir))
+
+    with it('debe obligar a implementar el almacenamiento'):
+        class IncompleteQueryCache(QueryCache):
+            def get(self, key):
+                return None
+
+        expect(IncompleteQueryCache).to(raise_error(TypeError))
+
+
+with description('La caché de los servicios'):
+
+    with before.each:
+        self.cache = MemoryQueryCache()
+        self.consulta = ConsultaService(
+            'cert.pem', 'key.pem', query_cache=self.cache
+        )
+        self.books = FakeConsultaLR(
+            records=get_consulta_records(3, '55555555K')
+        )
+        self.consulta.emitted_service = self.books
+
+    with it('no debe repetir las consultas guardadas'):
+        first = list(
+            self.consulta.iter_registros('out', TITULAR, '2016', '12')
+        )
+        second = list(
+            self.consulta.iter_registros('out', TITULAR, '2016', '12')
+        )
+
+        expect(second).to(equal(first))
+        expect(self.books.consultas).to(have_len(1))
+
+    with it('debe invalidar el periodo al enviar facturas'):
+        service = SiiService('cert.pem', 'key.pem', query_cache=self.cache)
+        service.emitted_service = FakeSiiOperations()
+        list(self.consulta.iter_registros('out', TITULAR, '2016', '12'))
+        list(self.consulta.iter_registros('out', TITULAR, '2017', '01'))
+
+        service.send_batch(get_invoices(2))
+        list(self.consulta.iter_registros('out', TITULAR, '2016', '12'))
+        list(self.consulta.iter_registros('out', TITULAR, '2017', '01'))
+
+        expect(self.books.consultas).to(have_len(3))
+        expect(
+            self.books.consultas[-1][1]['PeriodoLiquidacion']['Periodo']
+        ).to(equal('12'))
@@ -0,0 +1,114 @@
+# coding=utf-8
+
+from sii.consulta import ConsultaRecord
+from sii.reconcile import (
+    DIFFERING, ERROR, EXTRA, MATCHED, MISSING, get_registro, reconcile
+)
+from expects import *
+from spec.testing_services import get_invoices
+from mamba import *
+
+DETALLE_IVA = (('21', '300.00', '63.00'), ('4', '400.00', '16.00'))
+
+
+def get_record(nif, num_serie, fecha, **values):
+    record = {
+        'book': 'out', 'ejercicio': '2016', 'periodo': '12', 'nif': nif,
+        'id_otro': None, 'nombre': None, 'num_serie': num_serie,
+        'fecha_expedicion': fecha, 'tipo_factura': 'F1',
+        'importe_total': '6529.00', 'detalle_iva': DETALLE_IVA,
+        'contraparte': '09346536A', 'estado_registro': 'Correcta',
+        'codigo_error': None, 'estado_cuadre': '1', 'csv': 'CSV',
+        'timestamp_presentacion': '01-01-2017 10:00:00',
+        'timestamp_modificacion': '01-01-2017 10:00:00'
+    }
+    record.update(values)
+    return ConsultaRecord(**record)
+
+
+def numbers(results):
+    return [item[0].number for item in results]
+
+
+with description('La conciliación de facturas con los libros'):
+
+    with before.each:
+        self.invoices = get_invoices(4)
+        self.records = [
+            get_record('55555555K', invoice.number, '31-12-2016')
+            for invoice in self.invoices
+        ]
+
+    with it('debe casar las facturas con los mismos importes'):
+        result = reconcile(self.invoices, reversed(self.records))
+
+        expect(numbers(result[MATCHED])).to(
+            equal([invoice.number for invoice in self.invoices])
+        )
+        expect(result[MISSING] + result[DIFFERING] + result[EXTRA]).to(
+            be_empty
+        )
+
+    with it('debe informar de las facturas que faltan y las que sobran'):
+        extra = get_record('55555555K', 'FEmit99999', '31-12-2016')
+        anulada = get_record(
+            '55555555K', 'FEmit99998', '31-12-2016', estado_registro='Anulada'
+        )
+        records = self.records[1:] + [extra, anulada]
+        records[0] = records[0]._replace(estado_registro='Anulada')
+
+        result = reconcile(self.invoices, records)
+
+        expect(numbers(result[MISSING])).to(
+            equal(['FEmit00000', 'FEmit00001'])
+        )
+        _, registro = result[MISSING][0]
+        expect(registro['IDFactura']['NumSerieFacturaEmisor']).to(
+            equal('FEmit00000')
+        )
+        expect(result[EXTRA]).to(equal([extra]))
+
+    with it('debe informar de los importes que difieren'):
+        self.records[1] = self.records[1]._replace(importe_total='6529.01')
+        self.records[2] = self.records[2]._replace(
+            detalle_iva=(('21', '300.00', '63.00'),)
+        )
+
+        result = reconcile(self.invoices, self.records)
+
+        expect(numbers(result[MATCHED])).to(
+            equal(['FEmit00000', 'FEmit00003'])
+        )
+        expect([
+            (invoice.number, differences)
+            for invoice, _, differences in result[DIFFERING]
+        ]).to(equal([
+            ('FEmit00001', ['ImporteTotal']), ('FEmit00002', ['DetalleIVA'])
+        ]))
+
+    with it('debe conciliar las facturas recibidas'):
+        invoices = get_invoices(2, 'in')
+        registro = get_registro(invoices[0])
+        records = [
+            get_record(
+                '12345678Z', invoice.origin, '01-12-2016', book='in',
+                detalle_iva=(
+                    ('21', '300', '63'), ('4', '400', '16'),
+                    (None, '4150', None), (None, '1600', None)
+                )
+            )
+            for invoice in invoices
+        ]
+
+        result = reconcile(invoices, records)
+
+        expect(registro).to(have_key('FacturaRecibida'))
+        expect(result[MATCHED]).to(have_len(2))
+
+    with it('debe informar de las facturas que no se pueden generar'):
+        def get_broken_registro(invoice):
+            raise Exception('Errors were found while trying to validate')
+
+        result = reconcile(self.invoices[:1], [], get_broken_registro)
+
+        expect(numbers(result[ERROR])).to(equal(['FEmit00000']))
@@ -0,0 +1,140 @@
+# coding=utf-8
+
+import timeit
+
+from sii.clients import ClientCache
+from sii.response import ParsedResponse, ResponseLine, parse_response
+from sii.server import SiiService, get_wsdl_path
+from expects import *
+from spec.testing_services import (
+    FakeRawSiiOperations, FakeSiiOperations, get_invoices, process_reply,
+    render_full_response, render_response
+)
+from mamba import *
+from zeep.exceptions import Fault
+from zeep.helpers import serialize_object
+from zeep.transports import Transport
+
+
+def get_registros(numbers):
+    return [
+        {'IDFactura': {
+            'IDEmisorFactura': {'NIF': '55555555K'},
+            'NumSerieFacturaEmisor': 'F{:05d}'.format(number),
+            'FechaExpedicionFacturaEmisor': '31-12-2016'
+        }}
+        for number in range(numbers)
+    ]
+
+
+with description('La lectura de las respuestas con lxml'):
+
+    with it('debe leer el envío y cada una de las líneas'):
+        operations = FakeSiiOperations(rejected={'F00001': 1117})
+        content = render_response(operations.response(get_registros(3)))
+
+        response = parse_response(content)
+
+        expect(response).to(be_a(ParsedResponse))
+        expect(response.estado_envio).to(equal('ParcialmenteCorrecto'))
+        expect(response.csv).to(equal('CSV0'))
+        expect(response.get('CSV')).to(equal('CSV0'))
+        expect(response.lines).to(have_len(3))
+        expect(response.lines[1]).to(equal(ResponseLine(
+            key=('55555555K', 'F00001', '31-12-2016'),
+            estado_registro='Incorrecto', codigo_error=1117,
+            descripcion_error='Valor o tipo incorrecto', csv=None
+        )))
+        expect(response.lines[0].codigo_error).to(be_none)
+
+    with it('debe leer respuestas grandes rápidamente'):
+        content = render_response(
+            FakeSiiOperations().response(get_registros(10000))
+        )
+
+        elapsed = timeit.timeit(lambda: parse_response(content), number=1)
+
+        expect(len(parse_response(content).lines)).to(equal(10000))
+        expect(elapsed).to(be_below(2))
+
+
+with description('La lectura de las respuestas con el WSDL local'):
+
+    with before.each:
+        self.service = ClientCache(cache_dir=None).create_service(
+            Transport(), get_wsdl_path('SuministroFactEmitidas.wsdl'),
+            'SuministroFactEmitidas', 'siiService'
+        )
+        self.operations = FakeSiiOperations(rejected={'F00001': 1117})
+
+    with it('debe leer el sobre completo de la respuesta'):
+        content = render_full_response(
+            self.operations.response(get_registros(2)), tiempo_espera=60
+        )
+
+        response = serialize_object(process_reply(
+            self.service, 'SuministroLRFacturasEmitidas', content
+        ))
+
+        expect(response['TiempoEsperaEnvio']).to(equal(60))
+        expect(response['EstadoEnvio']).to(equal('ParcialmenteCorrecto'))
+        expect(response['Cabecera']['Titular']['NIF']).to(equal('55555555K'))
+        expect(response['DatosPresentacion']['NIFPresentador']).to(
+            equal('55555555K')
+        )
+        expect(dict(
+            (line['IDFactura']['NumSerieFacturaEmisor'],
+             line['CodigoErrorRegistro'])
+            for line in response['RespuestaLinea']
+        )).to(equal({'F00000': None, 'F00001': 1117}))
+
+    with it('debe leer las respuestas sin TiempoEsperaEnvio'):
+        content = render_full_response(
+            self.operations.response(get_registros(1))
+        )
+
+        response = serialize_object(process_reply(
+            self.service, 'SuministroLRFacturasEmitidas', content
+        ))
+
+        expect(response['TiempoEsperaEnvio']).to(be_none)
+        expect(response['EstadoEnvio']).to(equal('Correcto'))
+
+
+with description('El envío con raw_responses'):
+
+    with before.each:
+        self.service = SiiService('cert.pem', 'key.pem', raw_responses=True)
+        self.emitted = FakeRawSiiOperations()
+        self.service.emitted_service = self.emitted
+
+    with it('debe devolver el resultado de cada factura del lote'):
+        invoices = get_invoices(3)
+        self.emitted.rejected = [invoices[1].number]
+
+        results = self.service.send_batch(invoices)
+
+        expect(
+            [outcome['EstadoRegistro'] for _, outcome in results]
+        ).to(equal(['Correcto', 'Incorrecto', 'Correcto']))
+        expect(results[1][1]['CodigoErrorRegistro']).to(equal(1100))
+        expect(results[1][1]['EstadoEnvio']).to(
+            equal('ParcialmenteCorrecto')
+        )
+        expect(results[1][1]['RespuestaLinea']).to(be_a(ResponseLine))
+
+    with it('debe devolver la respuesta al enviar una factura'):
+        response = self.service.submit(get_invoices(1)[0])
+
+        expect(response.get('EstadoEnvio')).to(equal('Correcto'))
+        expect(response['EstadoRegistro']).to(equal('Correcto'))
+        expect(response['RespuestaLinea']).to(be_a(ResponseLine))
+
+    with it('debe lanzar los Fault de la AEAT'):
+        self.emitted.fault = 'Codigo[4102].El XML no cumple el esquema'
+        invoice = get_invoices(1)[0]
+
+        def submit():
+            self.service.submit(invoice)
+
+        expect(submit).to(raise_error(Fault))
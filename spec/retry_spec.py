@@ -0,0 +1,212 @@
+# coding=utf-8
+
+from sii.response import (
+    ACCEPTED, ACCEPTED_WITH_ERRORS, RETRYABLE, REJECTED, classify_outcome
+)
+from sii.server import SiiService, SiiDeregisterService
+from expects import *
+from spec.testing_services import FakeSiiOperations, get_invoices
+from mamba import *
+from requests.exceptions import Timeout
+from zeep.exceptions import Fault
+
+
+def numbers(results):
+    return sorted([invoice.number for invoice, _ in results])
+
+
+with description('La clasificación de los registros'):
+
+    with it('debe distinguir los registros aceptados'):
+        expect(classify_outcome(
+            {'EstadoRegistro': 'Correcto'}
+        )).to(equal(ACCEPTED))
+        expect(classify_outcome(
+            {'EstadoRegistro': 'AceptadoConErrores',
+             'CodigoErrorRegistro': 2011}
+        )).to(equal(ACCEPTED_WITH_ERRORS))
+
+    with it('debe reintentar los errores técnicos'):
+        expect(classify_outcome(
+            {'EstadoRegistro': 'Incorrecto', 'CodigoErrorRegistro': 4107}
+        )).to(equal(RETRYABLE))
+        expect(classify_outcome(Timeout())).to(equal(RETRYABLE))
+        expect(classify_outcome(
+            Fault('Codigo[4113].Error técnico al crear el trámite')
+        )).to(equal(RETRYABLE))
+
+    with it('debe rechazar los errores de validación'):
+        expect(classify_outcome(
+            {'EstadoRegistro': 'Incorrecto', 'CodigoErrorRegistro': 1100}
+        )).to(equal(REJECTED))
+        expect(classify_outcome(
+            Fault('Codigo[4102].El XML no cumple el esquema')
+        )).to(equal(REJECTED))
+        expect(classify_outcome(KeyError('Titular'))).to(equal(REJECTED))
+
+
+with description('El envío con reintentos'):
+
+    with before.each:
+        self.service = SiiService('cert.pem', 'key.pem')
+        self.invoices = get_invoices(5)
+        self.numbers = [invoice.number for invoice in self.invoices]
+        self.emitted = FakeSiiOperations(
+            rejected=self.numbers[1:2], transient=self.numbers[2:4],
+            with_errors=self.numbers[4:]
+        )
+        self.service.emitted_service = self.emitted
+
+    with it('debe reenviar sólo los registros con errores técnicos'):
+        results = self.service.send_with_retries(self.invoices)
+
+        expect(self.emitted.calls).to(have_len(2))
+        _, registros = self.emitted.calls[1]
+        expect(
+            [r['IDFactura']['NumSerieFacturaEmisor'] for r in registros]
+        ).to(equal(self.numbers[2:4]))
+        expect(numbers(results[ACCEPTED])).to(
+            equal([self.numbers[0]] + self.numbers[2:4])
+        )
+        expect(numbers(results[ACCEPTED_WITH_ERRORS])).to(
+            equal(self.numbers[4:])
+        )
+        expect(numbers(results[REJECTED])).to(equal(self.numbers[1:2]))
+        expect(results[RETRYABLE]).to(be_empty)
+        expect([
+            outcome.attempts for _, outcome in results[ACCEPTED]
+        ]).to(equal([1, 2, 2]))
+
+    with it('debe dejar de reintentar tras max_retries'):
+        self.emitted.transient = [self.numbers[2]] * 3
+
+        results = self.service.send_with_retries(
+            self.invoices, max_retries=1
+        )
+
+        expect(self.emitted.calls).to(have_len(2))
+        expect(numbers(results[RETRYABLE])).to(equal(self.numbers[2:3]))
+        _, outcome = results[RETRYABLE][0]
+        expect(outcome['CodigoErrorRegistro']).to(equal(4107))
+
+
+with description('El reenvío como A1 de las facturas duplicadas'):
+
+    with before.each:
+        self.service = SiiService('cert.pem', 'key.pem')
+        self.invoices = get_invoices(4)
+        self.numbers = [invoice.number for invoice in self.invoices]
+        self.emitted = FakeSiiOperations(
+            rejected=dict((number, 3000) for number in self.numbers[1:3])
+        )
+        self.service.emitted_service = self.emitted
+
+    with it('debe reenviar las duplicadas juntas como A1'):
+        results = self.service.send_batch(self.invoices, resend_as_a1=True)
+
+        expect(self.emitted.calls).to(have_len(2))
+        cabecera, registros = self.emitted.calls[1]
+        expect(cabecera['TipoComunicacion']).to(equal('A1'))
+        expect(
+            [r['IDFactura']['NumSerieFacturaEmisor'] for r in registros]
+        ).to(equal(self.numbers[1:3]))
+        expect(self.emitted.calls[0][0]['TipoComunicacion']).to(equal('A0'))
+
+    with it('debe indicar en el resultado que se ha enviado como A1'):
+        self.emitted.rejected = {}
+
+        def respond(cabecera, registros):
+            self.emitted.calls.append((cabecera, registros))
+            if cabecera['TipoComunicacion'] == 'A0':
+                self.emitted.rejected = dict(
+                    (number, 3000) for number in self.numbers[1:3]
+                )
+            else:
+                self.emitted.rejected = {}
+            return self.emitted.response(registros)
+        self.emitted.SuministroLRFacturasEmitidas = respond
+
+        results = self.service.send_batch(self.invoices, resend_as_a1=True)
+
+        outcomes = [outcome for _, outcome in results]
+        expect([o['EstadoRegistro'] for o in outcomes]).to(
+            equal(['Correcto'] * 4)
+        )
+        expect([o.get('TipoComunicacion') for o in outcomes]).to(
+            equal([None, 'A1', 'A1', None])
+        )
+
+    with it('no debe reenviar nada sin resend_as_a1'):
+        results = self.service.send_batch(self.invoices)
+
+        expect(self.emitted.calls).to(have_len(1))
+        expect(results[1][1]['CodigoErrorRegistro']).to(equal(3000))
+
+
+with description('La recuperación de envíos sin respuesta'):
+
+    with before.each:
+        self.service = SiiService('cert.pem', 'key.pem')
+        self.invoices = get_invoices(4)
+        self.numbers = [invoice.number for invoice in self.invoices]
+        self.emitted = FakeSiiOperations(lost=self.numbers[:1])
+        self.service.emitted_service = self.emitted
+
+    with it('debe consultar el lote entero y reenviar sólo lo que falta'):
+        self.service.send_batch(self.invoices[:2])
+
+        results = self.service.recover(self.invoices)
+
+        expect(self.emitted.consultas).to(have_len(1))
+        cabecera, filtro = self.emitted.consultas[0]
+        expect(cabecera).not_to(have_key('TipoComunicacion'))
+        expect(filtro['PeriodoLiquidacion']).to(
+            equal({'Ejercicio': '2016', 'Periodo': '12'})
+        )
+        _, registros = self.emitted.calls[-1]
+        expect(
+            [r['IDFactura']['NumSerieFacturaEmisor'] for r in registros]
+        ).to(equal(self.numbers[2:]))
+        expect(
+            [outcome['EstadoRegistro'] for _, outcome in results]
+        ).to(equal(['Correcto'] * 4))
+        expect(results[0][1]['Consulta']).not_to(be_none)
+        expect(results[2][1].consulta).to(be_none)
+
+    with it('debe seguir la paginación de la consulta'):
+        self.emitted.lost = []
+        self.emitted.page_size = 1
+        self.service.send_batch(self.invoices[:3])
+
+        results = self.service.recover(self.invoices)
+
+        expect(self.emitted.consultas).to(have_len(3))
+        expect(self.emitted.calls).to(have_len(2))
+        expect(self.emitted.calls[-1][1]).to(have_len(1))
+
+    with it('debe recuperar los timeouts al enviar con reintentos'):
+        results = self.service.send_with_retries(self.invoices)
+
+        expect(self.emitted.calls).to(have_len(1))
+        expect(self.emitted.consultas).to(have_len(1))
+        expect(numbers(results[ACCEPTED])).to(equal(sorted(self.numbers)))
+        filtro = self.emitted.consultas[0][1]
+        expect(filtro).to(have_key('FechaPresentacion'))
+
+    with it('debe comprobar las bajas por su estado anulado'):
+        service = SiiDeregisterService('cert.pem', 'key.pem')
+        service.emitted_service = self.emitted
+        self.emitted.lost = []
+        self.service.send_batch(self.invoices)
+        service.send_batch(self.invoices[:1])
+
+        results = service.recover(self.invoices[:2])
+
+        expect(self.emitted.consultas[0][1]).not_to(
+            have_key('FechaPresentacion')
+        )
+        expect(self.emitted.calls).to(have_len(3))
+        expect(self.emitted.calls[-1][1]).to(have_len(1))
+        expect(results[0][1]['Consulta']['EstadoFactura']).to(
+            equal({'EstadoRegistro': 'Anulada'})
+        )
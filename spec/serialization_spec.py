@@ -1,12 +1,17 @@
 # coding=utf-8
 
-from sii.resource import SII, SIIDeregister, get_iva_values
+from sii.resource import (
+    SII, SIIDeregister, get_iva_values, get_rectified_totals,
+    rectified_totals_memo
+)
 from sii.models.invoices_record import CRE_FACTURAS_EMITIDAS
+from sii.snapshot import normalize_amounts
 from sii.utils import unidecode_str, VAT
 from expects import *
 from datetime import datetime
 from decimal import Decimal
 from spec.testing_data import DataGenerator, Tax, InvoiceLine, InvoiceTax
+from spec.testing_services import get_invoices
 from mamba import *
 import os
 
@@ -692,7 +697,9 @@ with description('El XML Generado'):
                     self.in_invoice_obj['SuministroLRFacturasRecibidas']
                     ['RegistroLRFacturasRecibidas']
                 )
-                self.detalle_iva_isp_list = get_iva_values(in_invoice_isp, in_invoice=True)
+                self.detalle_iva_isp_list = get_iva_values(
+                    normalize_amounts(in_invoice_isp), in_invoice=True
+                )
                 self.detalle_iva_isp = (
                     self.factura_recibida['FacturaRecibida']['DesgloseFactura']
                     ['InversionSujetoPasivo']
@@ -1908,6 +1915,22 @@ with description('El XML Generado en una baja de una factura emitida'):
                     self.invoice.date_invoice
                 ))
 
+    with description('sin los datos de la alta'):
+        with before.all:
+            self.invoice = self.data_gen.get_out_invoice()
+            self.invoice.tax_line = None
+            self.invoice.amount_total = 'no es un importe'
+
+        with it('debe generar la baja sin leer los impuestos'):
+            obj = SIIDeregister(self.invoice).generate_object()
+
+            expect(
+                obj['BajaLRFacturasEmitidas']['RegistroLRBajaExpedidas']
+                ['IDFactura']['NumSerieFacturaEmisor']
+            ).to(equal(self.invoice.number))
+            expect(self.invoice.amount_total).to(equal('no es un importe'))
+
+
 with description('El XML Generado en una baja de una factura recibida'):
     with before.all:
         self.data_gen = DataGenerator()
@@ -2079,3 +2102,98 @@ with description('El XML Generado en una baja de una factura recibida'):
 
             with it('el CodigoPais debe ser "ES"'):
                 expect(self.contraparte['IDOtro']['CodigoPais']).to(equal('ES'))
+
+
+with description('La generación en lote de los SuministroLR'):
+
+    with before.each:
+        self.invoices = get_invoices(3) + get_invoices(2, 'in')
+        registered = get_invoices(1)[0]
+        registered.sii_registered = True
+        self.invoices.append(registered)
+
+    with it('debe generar una cabecera por empresa, libro y comunicación'):
+        objects, errors = SII.generate_objects(self.invoices)
+
+        expect(errors).to(be_empty)
+        expect([len(invoices) for invoices, _ in objects]).to(
+            equal([3, 2, 1])
+        )
+        cabeceras = [
+            list(obj.values())[0]['Cabecera'] for _, obj in objects
+        ]
+        expect([c['TipoComunicacion'] for c in cabeceras]).to(
+            equal(['A0', 'A0', 'A1'])
+        )
+        expect(objects[1][1]).to(have_key('SuministroLRFacturasRecibidas'))
+
+    with it('debe generar los mismos registros que generate_object'):
+        objects, _ = SII.generate_objects(self.invoices[:3])
+
+        invoices, obj = objects[0]
+        registros = (
+            obj['SuministroLRFacturasEmitidas']['RegistroLRFacturasEmitidas']
+        )
+        for invoice, registro in zip(invoices, registros):
+            expect(registro).to(equal(
+                SII(invoice).generate_object()['SuministroLRFacturasEmitidas']
+                ['RegistroLRFacturasEmitidas']
+            ))
+
+    with it('debe devolver los errores de cada factura'):
+        self.invoices[1].number = None
+        self.invoices[3].type = 'other'
+
+        objects, errors = SII.generate_objects(self.invoices)
+
+        expect([len(invoices) for invoices, _ in objects]).to(
+            equal([2, 1, 1])
+        )
+        expect([invoice for invoice, _ in errors]).to(
+            equal([self.invoices[3], self.invoices[1]])
+        )
+        expect(errors[1][1].args[1]).to(
+            equal(['NumSerieFacturaEmisor: Field may not be null.'])
+        )
+
+    with it('no debe superar el máximo de registros por objeto'):
+        objects, _ = SII.generate_objects(self.invoices, max_registros=2)
+
+        expect([len(invoices) for invoices, _ in objects]).to(
+            equal([2, 1, 2, 1])
+        )
+
+
+with description('Los totales de una factura rectificada'):
+
+    with before.each:
+        self.invoice = DataGenerator().get_out_invoice_RA()
+        self.rectificada = self.invoice.rectifying_id
+
+    with it('deben sumar la base y la cuota de su desglose'):
+        expect(get_rectified_totals(self.rectificada)).to(
+            equal((700.0, 79.0))
+        )
+
+    with it('deben calcularse una sola vez en rectified_totals_memo'):
+        with rectified_totals_memo():
+            totals = get_rectified_totals(self.rectificada)
+            self.rectificada.tax_line = []
+
+            expect(get_rectified_totals(self.rectificada)).to(equal(totals))
+
+        expect(get_rectified_totals(self.rectificada)).to(equal((0, 0)))
+
+    with it('deben compartirse entre objetos del mismo registro'):
+        other = DataGenerator().get_out_invoice_RA().rectifying_id
+        for rectificada in (self.rectificada, other):
+            rectificada._name = 'account.invoice'
+            rectificada.id = 7
+        other.tax_line = []
+
+        with rectified_totals_memo():
+            totals = get_rectified_totals(self.rectificada)
+
+            expect(get_rectified_totals(other)).to(equal(totals))
+
+        expect(get_rectified_totals(other)).to(equal((0, 0)))
@@ -0,0 +1,219 @@
+# coding=utf-8
+
+import pickle
+import random
+from decimal import Decimal
+
+from sii.atc.resource import SIIATC
+from sii.resource import SII
+from sii.snapshot import (
+    AmountsView, InvoiceSnapshot, SnapshotReader, from_browse,
+    normalize_amounts
+)
+from expects import *
+from spec.testing_data import DataGenerator
+from spec.testing_data_atc import DataGeneratorATC
+from spec.testing_services import FakePool
+from mamba import *
+
+
+def get_random_invoice(generator, method, **kwargs):
+    """Genera la misma factura en cada llamada (los números son aleatorios)"""
+    random.seed(1)
+    return getattr(generator(**kwargs), method)()
+
+
+with description('Las instantáneas de las facturas'):
+
+    with it('deben generar los mismos objetos que las facturas'):
+        for method in ('get_out_invoice', 'get_in_invoice',
+                       'get_out_invoice_RA', 'get_in_invoice_RA',
+                       'get_in_refund_invoice'):
+            expected = SII(
+                get_random_invoice(DataGenerator, method)
+            ).generate_object()
+
+            snapshot = from_browse(get_random_invoice(DataGenerator, method))
+
+            expect(SII(snapshot).generate_object()).to(equal(expected))
+
+    with it('deben generar los mismos objetos del ATC que las facturas'):
+        for method in ('get_out_invoice', 'get_in_refund'):
+            expected = SIIATC(
+                get_random_invoice(DataGeneratorATC, method)
+            ).generate_object()
+
+            snapshot = from_browse(
+                get_random_invoice(DataGeneratorATC, method)
+            )
+
+            expect(SIIATC(snapshot).generate_object()).to(equal(expected))
+
+    with it('deben guardar los importes como Decimal sin tocar la factura'):
+        invoice = DataGenerator().get_out_invoice()
+        amount_total = invoice.amount_total
+
+        snapshot = from_browse(invoice)
+        SII(snapshot).generate_object()
+
+        expect(snapshot.amount_total).to(equal(Decimal(str(amount_total))))
+        expect(snapshot.tax_line[0].tax_id.amount).to(be_a(Decimal))
+        expect(invoice.amount_total).to(be(amount_total))
+
+    with it('deben ser inmutables'):
+        snapshot = from_browse(DataGenerator().get_out_invoice())
+
+        def set_number():
+            snapshot.number = 'F1'
+
+        expect(set_number).to(raise_error(AttributeError))
+        expect(hasattr(snapshot, '__dict__')).to(be_false)
+
+    with it('deben compartir los registros relacionados'):
+        data_gen = DataGenerator()
+        snapshots = {}
+        invoices = [
+            from_browse(data_gen.get_out_invoice(), snapshots=snapshots)
+            for _ in range(2)
+        ]
+
+        expect(invoices[0]).not_to(be(invoices[1]))
+        expect(invoices[0].company_id).to(be(invoices[1].company_id))
+
+    with it('deben guardar el resultado de los métodos de la factura'):
+        invoice = DataGenerator().get_out_invoice()
+        invoice.issued_by_others = True
+        invoice.get_notify_issued_by_others = lambda: False
+        invoice.get_clave_regimen_especial_atc = (
+            lambda is_out_invoice=True: '01' if is_out_invoice else '02'
+        )
+
+        snapshot = from_browse(invoice)
+
+        expect(snapshot.get_notify_issued_by_others()).to(be_false)
+        expect(snapshot.get_clave_regimen_especial_atc()).to(equal('01'))
+        expect(snapshot.get_clave_regimen_especial_atc(
+            is_out_invoice=False
+        )).to(equal('02'))
+        expect(snapshot.get_values_taxes_non_current_tax_rate()).to(
+            equal(invoice.get_values_taxes_non_current_tax_rate())
+        )
+
+    with it('deben poder serializarse con pickle'):
+        snapshot = from_browse(DataGenerator().get_out_invoice_RA())
+
+        loaded = pickle.loads(pickle.dumps(snapshot))
+
+        expect(loaded).to(be_a(InvoiceSnapshot))
+        expect(SII(loaded).generate_object()).to(
+            equal(SII(snapshot).generate_object())
+        )
+
+
+with description('La normalización de los importes'):
+
+    with it('no debe modificar las facturas'):
+        invoice = DataGenerator().get_out_invoice_RA()
+        rectified = invoice.rectifying_id
+
+        SII(invoice).generate_object()
+
+        expect(invoice.amount_total).not_to(be_a(Decimal))
+        expect(invoice.tax_line[0].base).not_to(be_a(Decimal))
+        expect(invoice.tax_line[0].tax_id.amount).not_to(be_a(Decimal))
+        expect(rectified.amount_untaxed).not_to(be_a(Decimal))
+
+    with it('debe dar los importes como Decimal y el resto de la factura'):
+        invoice = DataGenerator().get_out_invoice_RA()
+
+        view = normalize_amounts(invoice)
+
+        expect(view).to(be_a(AmountsView))
+        expect(view.amount_total).to(equal(Decimal(str(invoice.amount_total))))
+        expect(view.tax_line[0].tax_id.amount).to(be_a(Decimal))
+        expect(view.rectifying_id.amount_total).to(be_a(Decimal))
+        expect(view.number).to(equal(invoice.number))
+        expect(normalize_amounts(view)).to(be(view))
+
+    with it('debe generar el mismo objeto al construir la factura dos veces'):
+        invoice = DataGenerator().get_in_invoice_RA()
+
+        expect(SII(invoice).generate_object()).to(
+            equal(SII(invoice).generate_object())
+        )
+
+    with it('debe normalizar una sola vez las facturas compartidas'):
+        data_gen = DataGenerator()
+        first = data_gen.get_out_invoice_RA()
+        second = data_gen.get_out_invoice_RA()
+        second.rectifying_id = first.rectifying_id
+        views = {}
+
+        first_view = normalize_amounts(first, views)
+        second_view = normalize_amounts(second, views)
+
+        expect(second_view.rectifying_id).to(be(first_view.rectifying_id))
+
+    with it('debe reconocer los objetos de la misma factura del ERP'):
+        data_gen = DataGenerator()
+        first = data_gen.get_out_invoice_RA()
+        second = data_gen.get_out_invoice_RA()
+        for invoice in (first.rectifying_id, second.rectifying_id):
+            invoice._name = 'account.invoice'
+            invoice.id = 7
+        views = {}
+
+        first_view = normalize_amounts(first, views)
+        second_view = normalize_amounts(second, views)
+
+        expect(second_view.rectifying_id).to(be(first_view.rectifying_id))
+        expect(second_view).not_to(be(first_view))
+
+
+with description('La lectura de las instantáneas del ERP'):
+
+    with before.each:
+        data_gen = DataGenerator()
+        self.invoices = []
+        for number in range(50):
+            data_gen.invoice_number = str(number).zfill(5)
+            self.invoices.append(data_gen.get_out_invoice())
+        self.pool = FakePool()
+        self.ids = [self.pool.add(invoice) for invoice in self.invoices]
+
+    with it('debe hacer las mismas lecturas para cualquier número de facturas'):
+        reader = SnapshotReader(self.pool, None, 1)
+        reader.get_snapshots(self.ids[:2])
+        reads = len(self.pool.reads)
+        self.pool.reads = []
+
+        snapshots = reader.get_snapshots(self.ids)
+
+        expect(snapshots).to(have_len(50))
+        expect(self.pool.reads).to(have_len(reads))
+        expect(self.pool.reads[0]).to(equal(('account.invoice', self.ids)))
+        expect(snapshots[0].company_id).to(be(snapshots[1].company_id))
+
+    with it('debe llamar una vez a los métodos de cada factura'):
+        snapshots = SnapshotReader(self.pool, None, 1).get_snapshots(
+            self.ids
+        )
+
+        expect(self.pool.calls).to(have_len(
+            len(self.ids) * len(InvoiceSnapshot.METHODS)
+        ))
+        expect(snapshots[0].get_clave_regimen_especial_atc()).to(equal(
+            self.invoices[0].get_clave_regimen_especial_atc()
+        ))
+
+    with it('debe generar los mismos objetos que las facturas'):
+        snapshots = SnapshotReader(self.pool, None, 1).get_snapshots(
+            self.ids
+        )
+
+        expect([
+            invoice.number for invoice in snapshots
+        ]).to(equal([invoice.number for invoice in self.invoices]))
+        expect(SII(snapshots[3]).generate_object()).to(
+            equal(SII(self.invoices[3]).generate_object())
+        )
@@ -0,0 +1,716 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+from datetime import datetime
+from threading import local
+
+from requests.exceptions import Timeout
+
+from sii.response import get_factura_key
+from sii import snapshot
+from spec.testing_data import DataGenerator
+
+
+class FakeSiiOperations(object):
+    """Servicio falso que responde a los SuministroLR sin llamar a la AEAT
+
+    :param rejected: números de factura rechazadas (lista) o diccionario
+        {número: código de error}
+    :param transient: números de factura rechazadas con un error técnico
+        sólo la primera vez que se envían
+    :param with_errors: números de factura aceptadas con errores
+    :param lost: números de factura que se registran pero cuya respuesta se
+        pierde (Timeout) la primera vez que se envían
+    :param page_size: registros por página de las consultas
+    """
+
+    def __init__(self, rejected=None, transient=None, with_errors=None,
+                 lost=None, page_size=10000):
+        self.calls = []
+        self.consultas = []
+        self.rejected = rejected or []
+        self.transient = list(transient or [])
+        self.with_errors = with_errors or []
+        self.lost = list(lost or [])
+        self.page_size = page_size
+        self.books = {}
+
+    def get_line(self, registro):
+        num_serie = registro['IDFactura']['NumSerieFacturaEmisor']
+        line = {'IDFactura': registro['IDFactura']}
+        if num_serie in self.transient:
+            self.transient.remove(num_serie)
+            line.update({
+                'EstadoRegistro': 'Incorrecto',
+                'CodigoErrorRegistro': 4107,
+                'DescripcionErrorRegistro': 'Error técnico al obtener el CSV'
+            })
+        elif num_serie in self.rejected:
+            code = 1100
+            if isinstance(self.rejected, dict):
+                code = self.rejected[num_serie]
+            line.update({
+                'EstadoRegistro': 'Incorrecto',
+                'CodigoErrorRegistro': code,
+                'DescripcionErrorRegistro': 'Valor o tipo incorrecto'
+            })
+        elif num_serie in self.with_errors:
+            line.update({
+                'EstadoRegistro': 'AceptadoConErrores',
+                'CodigoErrorRegistro': 2011,
+                'DescripcionErrorRegistro': 'El NIF de la contraparte no '
+                                            'está censado'
+            })
+        else:
+            line['EstadoRegistro'] = 'Correcto'
+        return line
+
+    def response(self, registros):
+        if isinstance(registros, dict):
+            registros = [registros]
+        lineas = [self.get_line(registro) for registro in registros]
+        rejected = [
+            linea for linea in lineas
+            if linea['EstadoRegistro'] == 'Incorrecto'
+        ]
+        if not rejected:
+            estado = 'Correcto'
+        elif len(rejected) == len(registros):
+            estado = 'Incorrecto'
+        else:
+            estado = 'ParcialmenteCorrecto'
+        return {
+            'CSV': 'CSV{}'.format(len(self.calls)),
+            'EstadoEnvio': estado,
+            'RespuestaLinea': list(reversed(lineas))
+        }
+
+    def respond(self, cabecera, registros, estado_libro=None):
+        self.calls.append((cabecera, registros))
+        response = self.response(registros)
+        for line in response['RespuestaLinea']:
+            if line['EstadoRegistro'] == 'Incorrecto':
+                continue
+            if estado_libro is None:
+                estado = {'Correcto': 'Correcta'}.get(
+                    line['EstadoRegistro'], 'AceptadaConErrores'
+                )
+            else:
+                estado = estado_libro
+            self.books[get_factura_key(line['IDFactura'])] = {
+                'IDFactura': line['IDFactura'],
+                'DatosPresentacion': {'CSV': response['CSV']},
+                'EstadoFactura': {'EstadoRegistro': estado}
+            }
+        if isinstance(registros, dict):
+            registros = [registros]
+        lost = [
+            r for r in registros
+            if r['IDFactura']['NumSerieFacturaEmisor'] in self.lost
+        ]
+        for registro in lost:
+            self.lost.remove(registro['IDFactura']['NumSerieFacturaEmisor'])
+        if lost:
+            raise Timeout('Read timed out')
+        return response
+
+    def consulta(self, cabecera, filtro, records_item):
+        self.consultas.append((cabecera, filtro))
+        records = list(self.books.values())
+        if 'ClavePaginacion' in filtro:
+            keys = [get_factura_key(r['IDFactura']) for r in records]
+            start = keys.index(get_factura_key(filtro['ClavePaginacion'])) + 1
+            records = records[start:]
+        page = records[:self.page_size]
+        return {
+            'IndicadorPaginacion': 'S' if len(records) > len(page) else 'N',
+            'ResultadoConsulta': 'ConDatos' if page else 'SinDatos',
+            records_item: page
+        }
+
+    def SuministroLRFacturasEmitidas(self, cabecera, registros):
+        return self.respond(cabecera, registros)
+
+    def SuministroLRFacturasRecibidas(self, cabecera, registros):
+        return self.respond(cabecera, registros)
+
+    def AnulacionLRFacturasEmitidas(self, cabecera, registros):
+        return self.respond(cabecera, registros, 'Anulada')
+
+    def AnulacionLRFacturasRecibidas(self, cabecera, registros):
+        return self.respond(cabecera, registros, 'Anulada')
+
+    def ConsultaLRFacturasEmitidas(self, cabecera, filtro):
+        return self.consulta(
+            cabecera, filtro, 'RegistroRespuestaConsultaLRFacturasEmitidas'
+        )
+
+    def ConsultaLRFacturasRecibidas(self, cabecera, filtro):
+        return self.consulta(
+            cabecera, filtro, 'RegistroRespuestaConsultaLRFacturasRecibidas'
+        )
+
+
+SOAP_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+RESPUESTA_NS = (
+    'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/'
+    'aplicaciones/es/aeat/ssii/fact/ws/RespuestaConsultaLR.xsd'
+)
+SII_NS = (
+    'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/'
+    'aplicaciones/es/aeat/ssii/fact/ws/SuministroInformacion.xsd'
+)
+
+CONSULTA_PAGE = u"""<?xml version="1.0" encoding="UTF-8"?>
+<env:Envelope xmlns:env="{soap}" xmlns:siiR="{respuesta}" xmlns:sii="{sii}">
+<env:Body><siiR:{response}>
+<siiR:PeriodoLiquidacion><sii:Ejercicio>{ejercicio}</sii:Ejercicio>\
+<sii:Periodo>{periodo}</sii:Periodo></siiR:PeriodoLiquidacion>
+<siiR:IndicadorPaginacion>{indicador}</siiR:IndicadorPaginacion>
+<siiR:ResultadoConsulta>{resultado}</siiR:ResultadoConsulta>
+{registros}
+</siiR:{response}></env:Body></env:Envelope>"""
+
+CONSULTA_REGISTRO = u"""<siiR:{registro}>
+<siiR:IDFactura><sii:IDEmisorFactura>{emisor}</sii:IDEmisorFactura>
+<sii:NumSerieFacturaEmisor>{num_serie}</sii:NumSerieFacturaEmisor>
+<sii:FechaExpedicionFacturaEmisor>{fecha}</sii:FechaExpedicionFacturaEmisor>
+</siiR:IDFactura>
+<siiR:{datos}><sii:TipoFactura>F1</sii:TipoFactura>
+<sii:ImporteTotal>{importe}</sii:ImporteTotal>
+<sii:Contraparte><sii:NombreRazon>Contraparte</sii:NombreRazon>
+<sii:NIF>{contraparte}</sii:NIF></sii:Contraparte>
+<sii:DesgloseFactura><sii:Sujeta><sii:NoExenta><sii:DesgloseIVA>
+{detalles}
+</sii:DesgloseIVA></sii:NoExenta></sii:Sujeta></sii:DesgloseFactura>
+</siiR:{datos}>
+<siiR:DatosPresentacion><sii:NIFPresentador>{contraparte}</sii:NIFPresentador>
+<sii:TimestampPresentacion>{presentacion} 10:00:00</sii:TimestampPresentacion>
+<sii:CSV>CSV{num_serie}</sii:CSV></siiR:DatosPresentacion>
+<siiR:EstadoFactura><siiR:EstadoCuadre>1</siiR:EstadoCuadre>
+<siiR:TimestampUltimaModificacion>{presentacion} 10:00:00\
+</siiR:TimestampUltimaModificacion>
+<siiR:EstadoRegistro>{estado}</siiR:EstadoRegistro></siiR:EstadoFactura>
+</siiR:{registro}>"""
+
+CONSULTA_DETALLE = u"""<sii:DetalleIVA><sii:TipoImpositivo>{0}</sii:TipoImpositivo>
+<sii:BaseImponible>{1}</sii:BaseImponible><sii:{cuota}>{2}</sii:{cuota}>
+</sii:DetalleIVA>"""
+
+CONSULTA_FAULT = u"""<?xml version="1.0" encoding="UTF-8"?>
+<env:Envelope xmlns:env="{soap}"><env:Body><env:Fault>
+<faultcode>env:Client</faultcode><faultstring>{message}</faultstring>
+</env:Fault></env:Body></env:Envelope>"""
+
+
+RESPUESTA_SUMINISTRO_NS = (
+    'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/'
+    'aplicaciones/es/aeat/ssii/fact/ws/RespuestaSuministro.xsd'
+)
+
+RESPUESTA_LR = u"""<?xml version="1.0" encoding="UTF-8"?>
+<env:Envelope xmlns:env="{soap}" xmlns:siiR="{respuesta}" xmlns:sii="{sii}">
+<env:Body><siiR:RespuestaLRFacturasEmitidas>
+<siiR:EstadoEnvio>{estado}</siiR:EstadoEnvio>
+<siiR:CSV>{csv}</siiR:CSV>
+{lineas}
+</siiR:RespuestaLRFacturasEmitidas></env:Body></env:Envelope>"""
+
+RESPUESTA_LINEA = u"""<siiR:RespuestaLinea>
+<siiR:IDFactura><sii:IDEmisorFactura><sii:NIF>{nif}</sii:NIF>\
+</sii:IDEmisorFactura>
+<sii:NumSerieFacturaEmisor>{num_serie}</sii:NumSerieFacturaEmisor>
+<sii:FechaExpedicionFacturaEmisor>{fecha}</sii:FechaExpedicionFacturaEmisor>
+</siiR:IDFactura>
+<siiR:EstadoRegistro>{estado}</siiR:EstadoRegistro>{error}
+</siiR:RespuestaLinea>"""
+
+RESPUESTA_ERROR = u"""
+<siiR:CodigoErrorRegistro>{0}</siiR:CodigoErrorRegistro>
+<siiR:DescripcionErrorRegistro>{1}</siiR:DescripcionErrorRegistro>"""
+
+
+def render_lines(response):
+    """Devuelve el XML de las RespuestaLinea de una respuesta"""
+    lineas = []
+    for linea in response['RespuestaLinea']:
+        id_factura = linea['IDFactura']
+        error = u''
+        if linea.get('CodigoErrorRegistro'):
+            error = RESPUESTA_ERROR.format(
+                linea['CodigoErrorRegistro'],
+                linea['DescripcionErrorRegistro']
+            )
+        lineas.append(RESPUESTA_LINEA.format(
+            nif=id_factura['IDEmisorFactura']['NIF'],
+            num_serie=id_factura['NumSerieFacturaEmisor'],
+            fecha=id_factura['FechaExpedicionFacturaEmisor'],
+            estado=linea['EstadoRegistro'],
+            error=error
+        ))
+    return u'\n'.join(lineas)
+
+
+def render_response(response):
+    """Devuelve el XML de la respuesta de FakeSiiOperations.response"""
+    return RESPUESTA_LR.format(
+        soap=SOAP_NS, respuesta=RESPUESTA_SUMINISTRO_NS, sii=SII_NS,
+        estado=response['EstadoEnvio'], csv=response['CSV'],
+        lineas=render_lines(response)
+    ).encode('utf-8')
+
+
+RESPUESTA_LR_COMPLETA = u"""<?xml version="1.0" encoding="UTF-8"?>
+<env:Envelope xmlns:env="{soap}" xmlns:siiR="{respuesta}" xmlns:sii="{sii}">
+<env:Body><siiR:RespuestaLRFacturasEmitidas>
+<siiR:CSV>{csv}</siiR:CSV>
+<siiR:DatosPresentacion><sii:NIFPresentador>55555555K</sii:NIFPresentador>
+<sii:TimestampPresentacion>31-01-2017 10:00:00</sii:TimestampPresentacion>
+</siiR:DatosPresentacion>
+<siiR:Cabecera><sii:IDVersionSii>1.1</sii:IDVersionSii>
+<sii:Titular><sii:NombreRazon>Titular</sii:NombreRazon>
+<sii:NIF>55555555K</sii:NIF></sii:Titular>
+<sii:TipoComunicacion>A0</sii:TipoComunicacion></siiR:Cabecera>
+{tiempo_espera}<siiR:EstadoEnvio>{estado}</siiR:EstadoEnvio>
+{lineas}
+</siiR:RespuestaLRFacturasEmitidas></env:Body></env:Envelope>"""
+
+RESPUESTA_TIEMPO_ESPERA = u"""<siiR:TiempoEsperaEnvio>{0}</siiR:TiempoEsperaEnvio>
+"""
+
+
+def render_full_response(response, tiempo_espera=None):
+    """Devuelve la respuesta de FakeSiiOperations.response como el sobre
+    SOAP completo que envía la AEAT, en el orden del XSD
+    """
+    tiempo = u''
+    if tiempo_espera is not None:
+        tiempo = RESPUESTA_TIEMPO_ESPERA.format(tiempo_espera)
+    return RESPUESTA_LR_COMPLETA.format(
+        soap=SOAP_NS, respuesta=RESPUESTA_SUMINISTRO_NS, sii=SII_NS,
+        estado=response['EstadoEnvio'], csv=response['CSV'],
+        tiempo_espera=tiempo, lineas=render_lines(response)
+    ).encode('utf-8')
+
+
+def render_fault(message):
+    """Devuelve el XML de un SOAP Fault con message como faultstring"""
+    return CONSULTA_FAULT.format(soap=SOAP_NS, message=message).encode('utf-8')
+
+
+def process_reply(service, operation_name, content, status_code=200):
+    """Lee con zeep la respuesta de una operación como lo hace el servicio"""
+    binding = service._binding
+    return binding.process_reply(
+        service._client, binding.get(operation_name),
+        FakeRawResponse(status_code, content)
+    )
+
+
+class FakeRawSiiOperations(FakeSiiOperations):
+    """FakeSiiOperations que devuelve el XML de la respuesta cuando se llama
+    con raw_response, como un zeep service
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(FakeRawSiiOperations, self).__init__(*args, **kwargs)
+        self.local = local()
+        self.fault = None
+        self._client = self
+
+    @contextmanager
+    def settings(self, raw_response=False):
+        self.local.raw_response = raw_response
+        try:
+            yield
+        finally:
+            self.local.raw_response = False
+
+    def respond(self, cabecera, registros, estado_libro=None):
+        if self.fault:
+            return FakeRawResponse(500, render_fault(self.fault))
+        response = super(FakeRawSiiOperations, self).respond(
+            cabecera, registros, estado_libro
+        )
+        if not getattr(self.local, 'raw_response', False):
+            return response
+        return FakeRawResponse(200, render_response(response))
+
+
+def in_range(fecha, fechas):
+    def parse(value):
+        return datetime.strptime(value, '%d-%m-%Y').date()
+    desde = fechas.get('Desde')
+    hasta = fechas.get('Hasta')
+    return (
+        (desde is None or parse(desde) <= parse(fecha)) and
+        (hasta is None or parse(fecha) <= parse(hasta))
+    )
+
+
+CONSULTA_CLIENTE_PAGE = u"""<?xml version="1.0" encoding="UTF-8"?>
+<env:Envelope xmlns:env="{soap}" xmlns:siiR="{respuesta}" xmlns:sii="{sii}">
+<env:Body><siiR:{response}>
+<sii:Cabecera><sii:IDVersionSii>1.1</sii:IDVersionSii><sii:TitularLRFE>\
+<sii:NombreRazon>Titular</sii:NombreRazon><sii:NIF>B12345674</sii:NIF>\
+</sii:TitularLRFE></sii:Cabecera>
+{paginacion}
+<siiR:ResultadoConsulta>{resultado}</siiR:ResultadoConsulta>
+{registros}
+</siiR:{response}></env:Body></env:Envelope>"""
+
+CONSULTA_INFORMADA = u"""<siiR:RegistroRespuestaConsultaLRFactInformadasCliente>
+<siiR:IDFactura><sii:IDEmisorFactura><sii:NombreRazon>Titular</sii:NombreRazon>
+<sii:NIF>{nif}</sii:NIF></sii:IDEmisorFactura>
+<sii:NumSerieFacturaEmisor>{num_serie}</sii:NumSerieFacturaEmisor>
+<sii:FechaExpedicionFacturaEmisor>{fecha}</sii:FechaExpedicionFacturaEmisor>
+</siiR:IDFactura>
+<siiR:PeriodoLiquidacion><sii:Ejercicio>2017</sii:Ejercicio>\
+<sii:Periodo>01</sii:Periodo></siiR:PeriodoLiquidacion>
+<siiR:DatosFacturaInformadaCliente><sii:TipoFactura>F1</sii:TipoFactura>
+<sii:ImporteTotal>{importe}</sii:ImporteTotal>
+<siiR:DesgloseFactura><sii:DesgloseIVA>{detalles}</sii:DesgloseIVA>
+</siiR:DesgloseFactura>
+<siiR:FechaRegContable>02-01-2017</siiR:FechaRegContable>
+</siiR:DatosFacturaInformadaCliente>
+<siiR:Cliente><sii:NombreRazon>Cliente</sii:NombreRazon>\
+<sii:NIF>{cliente}</sii:NIF></siiR:Cliente>
+<siiR:EstadoFactura><siiR:EstadoCuadre>2</siiR:EstadoCuadre>\
+</siiR:EstadoFactura>
+</siiR:RegistroRespuestaConsultaLRFactInformadasCliente>"""
+
+CONSULTA_AGRUPADA = u"""\
+<siiR:RegistroRespuestaConsultaLRFactInformadasAgrupadasCliente>
+<siiR:Cliente><sii:NombreRazon>Cliente</sii:NombreRazon>\
+<sii:NIF>{cliente}</sii:NIF></siiR:Cliente>
+<siiR:NumeroFacturas>{numero}</siiR:NumeroFacturas>
+</siiR:RegistroRespuestaConsultaLRFactInformadasAgrupadasCliente>"""
+
+
+class FakeRawResponse(object):
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {'Content-Type': 'text/xml; charset=utf-8'}
+
+
+class FakeConsultaLR(object):
+    """Servicio falso que responde a las ConsultaLR con el XML de la AEAT
+
+    Sirve como zeep service y como su cliente: sólo se admiten llamadas con
+    raw_response, como las de sii.server.ConsultaService.
+
+    :param book: 'out' (emitidas) o 'in' (recibidas)
+    :param records: lista de diccionarios con num_serie, nif, fecha,
+        importe, detalle_iva, presentacion (dd-mm-yyyy) y estado
+    :param page_size: registros por página
+    """
+
+    def __init__(self, book='out', records=None, page_size=10000,
+                 informadas=None):
+        self.book = book
+        self.records = list(records or [])
+        self.informadas = list(informadas or [])
+        self.page_size = page_size
+        self.consultas = []
+        self.local = local()
+        self.status_code = 200
+        self.fault = None
+        self._client = self
+
+    @contextmanager
+    def settings(self, raw_response=False):
+        self.local.raw_response = raw_response
+        try:
+            yield
+        finally:
+            self.local.raw_response = False
+
+    def get_error_response(self):
+        if self.fault:
+            return FakeRawResponse(500, render_fault(self.fault))
+        if self.status_code != 200:
+            return FakeRawResponse(self.status_code, b'Service Unavailable')
+
+    def get_registro(self, record):
+        if self.book == 'out':
+            emisor = u'<sii:NIF>{}</sii:NIF>'.format(record['nif'])
+        else:
+            emisor = (
+                u'<sii:NombreRazon>Emisor</sii:NombreRazon>'
+                u'<sii:NIF>{}</sii:NIF>'.format(record['nif'])
+            )
+        cuota = 'CuotaRepercutida' if self.book == 'out' else 'CuotaSoportada'
+        detalles = u''.join(
+            CONSULTA_DETALLE.format(*detalle, cuota=cuota)
+            for detalle in record.get('detalle_iva', [('21', '100', '21')])
+        )
+        return CONSULTA_REGISTRO.format(
+            registro='RegistroRespuestaConsultaLRFacturas{}'.format(
+                'Emitidas' if self.book == 'out' else 'Recibidas'
+            ),
+            datos='DatosFactura{}'.format(
+                'Emitida' if self.book == 'out' else 'Recibida'
+            ),
+            emisor=emisor,
+            num_serie=record['num_serie'],
+            fecha=record.get('fecha', '31-12-2016'),
+            importe=record.get('importe', '121'),
+            contraparte=record.get('contraparte', '12345678Z'),
+            detalles=detalles,
+            presentacion=record.get('presentacion', '01-01-2017'),
+            estado=record.get('estado', 'Correcta')
+        )
+
+    def consulta(self, cabecera, filtro):
+        assert self.local.raw_response
+        self.consultas.append((cabecera, dict(filtro)))
+        error = self.get_error_response()
+        if error:
+            return error
+        records = self.records
+        fechas = filtro.get('FechaPresentacion')
+        if fechas:
+            records = [
+                r for r in records
+                if in_range(r.get('presentacion', '01-01-2017'), fechas)
+            ]
+        clave = filtro.get('ClavePaginacion')
+        if clave:
+            keys = [
+                (r['nif'], r['num_serie'], r.get('fecha', '31-12-2016'))
+                for r in records
+            ]
+            start = keys.index((
+                clave['IDEmisorFactura']['NIF'],
+                clave['NumSerieFacturaEmisor'],
+                clave['FechaExpedicionFacturaEmisor']
+            )) + 1
+            records = records[start:]
+        page = records[:self.page_size]
+        periodo = filtro['PeriodoLiquidacion']
+        content = CONSULTA_PAGE.format(
+            soap=SOAP_NS, respuesta=RESPUESTA_NS, sii=SII_NS,
+            response='RespuestaConsultaLRFacturas{}'.format(
+                'Emitidas' if self.book == 'out' else 'Recibidas'
+            ),
+            ejercicio=periodo['Ejercicio'], periodo=periodo['Periodo'],
+            indicador='S' if len(records) > len(page) else 'N',
+            resultado='ConDatos' if page else 'SinDatos',
+            registros=u'\n'.join(self.get_registro(r) for r in page)
+        )
+        return FakeRawResponse(200, content.encode('utf-8'))
+
+    def ConsultaLRFacturasEmitidas(self, cabecera, filtro):
+        return self.consulta(cabecera, filtro)
+
+    def ConsultaLRFacturasRecibidas(self, cabecera, filtro):
+        return self.consulta(cabecera, filtro)
+
+    def get_informadas(self, filtro):
+        periodo = filtro['PeriodoImputacion']
+        imputacion = (
+            periodo['EjercicioImputacion'], periodo['PeriodoImputacion']
+        )
+        return [
+            r for r in self.informadas
+            if r.get('imputacion', ('2016', '12')) == imputacion
+        ]
+
+    def get_informada(self, record):
+        detalles = u''.join(
+            CONSULTA_DETALLE.format(*detalle, cuota='CuotaSoportada')
+            for detalle in record.get('detalle_iva', [('21', '100', '21')])
+        )
+        return CONSULTA_INFORMADA.format(
+            nif=record.get('nif', 'B12345674'),
+            num_serie=record['num_serie'],
+            fecha=record.get('fecha', '31-12-2016'),
+            importe=record.get('importe', '121'),
+            cliente=record.get('cliente', '12345678Z'),
+            detalles=detalles
+        )
+
+    def ConsultaLRFactInformadasCliente(self, cabecera, filtro):
+        assert self.local.raw_response
+        self.consultas.append((cabecera, dict(filtro)))
+        error = self.get_error_response()
+        if error:
+            return error
+        records = self.get_informadas(filtro)
+        clave = filtro.get('ClavePaginacion')
+        if clave:
+            keys = [
+                (r['num_serie'], r.get('cliente', '12345678Z'))
+                for r in records
+            ]
+            start = keys.index((
+                clave['NumSerieFacturaEmisor'], clave['Cliente']['NIF']
+            )) + 1
+            records = records[start:]
+        page = records[:self.page_size]
+        content = CONSULTA_CLIENTE_PAGE.format(
+            soap=SOAP_NS, respuesta=RESPUESTA_NS, sii=SII_NS,
+            response='RespuestaConsultaLRFactInformadasCliente',
+            paginacion=u'<siiR:IndicadorPaginacion>{}'
+                       u'</siiR:IndicadorPaginacion>'.format(
+                           'S' if len(records) > len(page) else 'N'
+                       ),
+            resultado='ConDatos' if page else 'SinDatos',
+            registros=u'\n'.join(self.get_informada(r) for r in page)
+        )
+        return FakeRawResponse(200, content.encode('utf-8'))
+
+    def ConsultaLRFactInformadasAgrupadasCliente(self, cabecera, filtro):
+        assert self.local.raw_response
+        self.consultas.append((cabecera, dict(filtro)))
+        clientes = {}
+        for record in self.get_informadas(filtro):
+            cliente = record.get('cliente', '12345678Z')
+            clientes[cliente] = clientes.get(cliente, 0) + 1
+        content = CONSULTA_CLIENTE_PAGE.format(
+            soap=SOAP_NS, respuesta=RESPUESTA_NS, sii=SII_NS,
+            response='RespuestaConsultaLRFactInformadasAgrupadasCliente',
+            paginacion=u'',
+            resultado='ConDatos' if clientes else 'SinDatos',
+            registros=u'\n'.join(
+                CONSULTA_AGRUPADA.format(cliente=cliente, numero=numero)
+                for cliente, numero in sorted(clientes.items())
+            )
+        )
+        return FakeRawResponse(200, content.encode('utf-8'))
+
+
+def get_consulta_records(number, nif='B12345674'):
+    return [
+        {'nif': nif, 'num_serie': 'F{}'.format(str(i).zfill(5)),
+         'importe': '{}.00'.format(121 + i)}
+        for i in range(number)
+    ]
+
+
+class FakeClock(object):
+    """Reloj falso que avanza con las esperas del scheduler"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def get_invoices(number, invoice_type='out'):
+    invoices = []
+    for i in range(number):
+        data_gen = DataGenerator()
+        data_gen.invoice_number = str(i).zfill(5)
+        if invoice_type == 'out':
+            invoices.append(data_gen.get_out_invoice())
+        else:
+            invoices.append(data_gen.get_in_invoice())
+    return invoices
+
+
+SNAPSHOT_MODELS = {
+    snapshot.InvoiceSnapshot: 'account.invoice',
+    snapshot.TaxLineSnapshot: 'account.invoice.tax',
+    snapshot.TaxSnapshot: 'account.tax',
+    snapshot.CompanySnapshot: 'res.company',
+    snapshot.PartnerSnapshot: 'res.partner',
+    snapshot.CountrySnapshot: 'res.country',
+    snapshot.AddressSnapshot: 'res.partner.address',
+    snapshot.StateSnapshot: 'res.country.state',
+    snapshot.ComunidadAutonomaSnapshot: 'res.comunitat_autonoma',
+    snapshot.PeriodSnapshot: 'account.period',
+    snapshot.JournalSnapshot: 'account.journal',
+    snapshot.ArticleSnapshot: 'account.journal.article',
+    snapshot.FiscalPositionSnapshot: 'account.fiscal.position'
+}
+
+
+class FakeModel(object):
+    """Modelo de OpenERP falso que lee los registros de un FakePool"""
+
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+
+    def read(self, cursor, uid, ids, fields, context=None):
+        self.pool.reads.append((self.name, sorted(ids)))
+        table = self.pool.tables[self.name]
+        return [
+            dict([('id', record_id)] + [
+                (field, table[record_id][field]) for field in fields
+            ])
+            for record_id in ids
+        ]
+
+    def fields_get(self, cursor, uid, fields, context=None):
+        return dict(
+            (field, {'relation': self.pool.relations[(self.name, field)]})
+            for field in fields
+        )
+
+    def __getattr__(self, name):
+        """Los métodos get_* llaman al del registro guardado"""
+        records = [
+            record for (model, _), record in self.pool.records.items()
+            if model == self.name and hasattr(record, name)
+        ]
+        if not name.startswith('get_') or not records:
+            raise AttributeError(name)
+
+        def call(cursor, uid, ids, context=None, **kwargs):
+            self.pool.calls.append((self.name, name, ids))
+            record = self.pool.records[(self.name, ids[0])]
+            return getattr(record, name)(**kwargs)
+        return call
+
+
+class FakePool(object):
+    """Pool de OpenERP falso con las facturas de los tests guardadas como
+    los valores que devuelve read
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self.relations = {}
+        self.ids = {}
+        self.records = {}
+        self.reads = []
+        self.calls = []
+
+    def get(self, model):
+        return FakeModel(self, model)
+
+    def add(self, record, snapshot_class=snapshot.InvoiceSnapshot):
+        if id(record) in self.ids:
+            return self.ids[id(record)][1]
+        model = SNAPSHOT_MODELS[snapshot_class]
+        table = self.tables.setdefault(model, {})
+        record_id = len(table) + 1
+        self.ids[id(record)] = (record, record_id)
+        self.records[(model, record_id)] = record
+        values = {}
+        for name in snapshot_class.FIELDS + snapshot_class.AMOUNTS:
+            values[name] = getattr(record, name, False)
+        for name, related_class in snapshot_class.RELATIONS.items():
+            self.relations[(model, name)] = SNAPSHOT_MODELS[related_class]
+            related = getattr(record, name, None)
+            if name in snapshot_class.X2MANY:
+                values[name] = [
+                    self.add(item, related_class) for item in related or []
+                ]
+            elif related:
+                values[name] = [
+                    self.add(related, related_class), 'Registro'
+                ]
+            else:
+                values[name] = False
+        table[record_id] = values
+        return record_id
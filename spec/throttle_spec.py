@@ -0,0 +1,127 @@
+# coding=utf-8
+
+from sii.clients import ClientCache
+from sii.server import SiiService, get_wsdl_path
+from sii.throttle import (
+    SendScheduler, get_wait_time, is_transient_error, should_back_off
+)
+from expects import *
+from spec.testing_services import (
+    FakeClock, FakeSiiOperations, get_invoices, process_reply, render_fault
+)
+from mamba import *
+from requests.exceptions import Timeout
+from zeep.exceptions import Fault, TransportError
+from zeep.transports import Transport
+
+
+with description('El scheduler de envíos'):
+
+    with before.each:
+        self.clock = FakeClock()
+        self.scheduler = SendScheduler(
+            rate=2, burst=2, clock=self.clock, sleep=self.clock.sleep
+        )
+        self.key = ('aeat', '12345678Z')
+
+    with it('debe permitir una ráfaga y después limitar el ritmo'):
+        for _ in range(4):
+            self.scheduler.call(self.key, dict)
+
+        expect(self.clock.sleeps).to(equal([0.5, 0.5]))
+
+    with it('debe limitar cada titular por separado'):
+        for _ in range(2):
+            self.scheduler.call(self.key, dict)
+        self.scheduler.call(('aeat', '87654321X'), dict)
+
+        expect(self.clock.sleeps).to(be_empty)
+
+    with it('debe esperar el TiempoEsperaEnvio antes del siguiente envío'):
+        self.scheduler.call(self.key, dict, {'TiempoEsperaEnvio': 60})
+        self.scheduler.call(self.key, dict)
+
+        expect(self.clock.sleeps).to(equal([60]))
+
+    with it('debe esperar cada vez más tras errores del servidor'):
+        def fail():
+            raise TransportError(status_code=503)
+
+        for _ in range(3):
+            expect(
+                lambda: self.scheduler.call(self.key, fail)
+            ).to(raise_error(TransportError))
+
+        expect(self.clock.sleeps).to(equal([1, 2]))
+
+    with it('debe reiniciar la espera tras una respuesta correcta'):
+        self.scheduler.on_error(self.key, Timeout())
+        self.scheduler.on_error(self.key, Timeout())
+        self.scheduler.on_response(self.key, {})
+
+        expect(self.scheduler.backoff).not_to(have_key(self.key))
+
+    with it('no debe esperar tras errores de validación'):
+        def fail():
+            raise Fault('Codigo[4102]')
+
+        expect(
+            lambda: self.scheduler.call(self.key, fail)
+        ).to(raise_error(Fault))
+        self.scheduler.call(self.key, dict)
+
+        expect(self.clock.sleeps).to(be_empty)
+
+    with it('debe esperar cada vez más tras superar el límite de envíos'):
+        service = ClientCache(cache_dir=None).create_service(
+            Transport(), get_wsdl_path('SuministroFactEmitidas.wsdl'),
+            'SuministroFactEmitidas', 'siiService'
+        )
+        content = render_fault(
+            u'Codigo[4116].Se ha superado el límite de envíos permitido'
+        )
+
+        def send():
+            return process_reply(
+                service, 'SuministroLRFacturasEmitidas', content, 500
+            )
+
+        for _ in range(3):
+            expect(
+                lambda: self.scheduler.call(self.key, send)
+            ).to(raise_error(Fault))
+
+        expect(self.clock.sleeps).to(equal([1, 2]))
+
+    with it('debe esperar sólo tras los Fault con códigos reintentables'):
+        expect(should_back_off(Fault('Codigo[4116].Error'))).to(be_true)
+        expect(should_back_off(Fault('Codigo[4107].Error'))).to(be_true)
+        expect(should_back_off(Fault('Codigo[4102].Error'))).to(be_false)
+        expect(should_back_off(Fault('Error'))).to(be_false)
+        expect(should_back_off(Timeout())).to(be_true)
+
+    with it('debe distinguir los errores transitorios'):
+        expect(is_transient_error(Timeout())).to(be_true)
+        expect(is_transient_error(TransportError(status_code=500))).to(be_true)
+        expect(is_transient_error(TransportError(status_code=404))).to(be_false)
+        expect(is_transient_error(Fault('Error'))).to(be_false)
+
+    with it('debe leer el TiempoEsperaEnvio sólo si existe'):
+        expect(get_wait_time({'TiempoEsperaEnvio': '60'})).to(equal(60))
+        expect(get_wait_time({'EstadoEnvio': 'Correcto'})).to(be_none)
+        expect(get_wait_time(None)).to(be_none)
+
+    with it('debe limitar los envíos del servicio por titular'):
+        service = SiiService('cert.pem', 'key.pem', scheduler=self.scheduler)
+        emitted = FakeSiiOperations()
+        service.emitted_service = emitted
+        invoices = get_invoices(3)
+
+        for invoice in invoices:
+            service.submit(invoice)
+        service.send_batch(invoices)
+
+        expect(emitted.calls).to(have_len(4))
+        expect(self.clock.sleeps).to(equal([0.5, 0.5]))
+        key = service.get_scheduler_key(invoices[0], emitted.calls[0][0])
+        expect(self.scheduler.buckets).to(have_key(key))